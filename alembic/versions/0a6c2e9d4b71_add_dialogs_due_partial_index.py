@@ -0,0 +1,42 @@
+"""Add partial index on due dialogs for the dispatcher queue
+
+Revision ID: 0a6c2e9d4b71
+Revises: f3b8d6a2c915
+Create Date: 2026-10-18 19:04:11.528310
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0a6c2e9d4b71'
+down_revision: Union[str, Sequence[str], None] = 'f3b8d6a2c915'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Диалоги, переданные менеджеру, диспетчер больше не забирает — их очередь раньше просто отбрасывалась
+    op.execute(
+        "DELETE FROM pending_messages WHERE dialog_id IN "
+        "(SELECT id FROM dialogs WHERE current_state = 'escalated')"
+    )
+    op.execute(
+        "UPDATE dialogs SET due_at = NULL, pending_started_at = NULL "
+        "WHERE current_state = 'escalated' AND due_at IS NOT NULL"
+    )
+    # CONCURRENTLY: индекс строится без блокировки записи в большую таблицу dialogs
+    with op.get_context().autocommit_block():
+        op.create_index('ix_dialogs_due_at', 'dialogs', ['due_at'], unique=False,
+                        postgresql_where=sa.text("due_at IS NOT NULL AND current_state <> 'escalated'"),
+                        postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_dialogs_due_at', table_name='dialogs', postgresql_concurrently=True)
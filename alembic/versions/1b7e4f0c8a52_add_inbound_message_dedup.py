@@ -0,0 +1,35 @@
+"""Add inbound_messages table for Wazzup message dedup
+
+Revision ID: 1b7e4f0c8a52
+Revises: 0a6c2e9d4b71
+Create Date: 2026-10-18 20:12:37.184906
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '1b7e4f0c8a52'
+down_revision: Union[str, Sequence[str], None] = '0a6c2e9d4b71'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('inbound_messages',
+    sa.Column('message_id', sa.String(), nullable=False),
+    sa.Column('chat_id', sa.String(), nullable=False),
+    sa.Column('received_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('message_id')
+    )
+    op.create_index('ix_inbound_messages_received_at', 'inbound_messages', ['received_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_inbound_messages_received_at', table_name='inbound_messages')
+    op.drop_table('inbound_messages')
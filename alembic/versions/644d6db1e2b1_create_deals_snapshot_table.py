@@ -0,0 +1,38 @@
+"""Create deals snapshot table
+
+Revision ID: 644d6db1e2b1
+Revises: 6fa8b1f8017e
+Create Date: 2026-10-18 12:41:09.551870
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '644d6db1e2b1'
+down_revision: Union[str, Sequence[str], None] = '6fa8b1f8017e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('deals',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('category_id', sa.String(), nullable=True),
+    sa.Column('stage_id', sa.String(), nullable=True),
+    sa.Column('contact_id', sa.Integer(), nullable=True),
+    sa.Column('assigned_by_id', sa.Integer(), nullable=True),
+    sa.Column('date_modify', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('handled_stage_id', sa.String(), nullable=True),
+    sa.Column('synced_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('deals')
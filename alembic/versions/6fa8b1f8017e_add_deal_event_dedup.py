@@ -0,0 +1,38 @@
+"""Add job dedup key and deal stage triggers
+
+Revision ID: 6fa8b1f8017e
+Revises: 62bc130edc57
+Create Date: 2026-10-18 11:20:41.902113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '6fa8b1f8017e'
+down_revision: Union[str, Sequence[str], None] = '62bc130edc57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('jobs', sa.Column('dedup_key', sa.String(), nullable=True))
+    op.create_index('uq_jobs_pending_dedup_key', 'jobs', ['dedup_key'], unique=True,
+                    postgresql_where=sa.text("status = 'pending'"))
+    op.create_table('deal_stage_triggers',
+    sa.Column('deal_id', sa.Integer(), nullable=False),
+    sa.Column('stage_id', sa.String(), nullable=False),
+    sa.Column('triggered_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('deal_id', 'stage_id')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('deal_stage_triggers')
+    op.drop_index('uq_jobs_pending_dedup_key', table_name='jobs')
+    op.drop_column('jobs', 'dedup_key')
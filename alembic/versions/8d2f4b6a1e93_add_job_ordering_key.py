@@ -0,0 +1,31 @@
+"""Add ordering_key to jobs for in-order delivery per chat
+
+Revision ID: 8d2f4b6a1e93
+Revises: 5c9a3e1d7f20
+Create Date: 2026-10-18 23:12:07.381954
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8d2f4b6a1e93'
+down_revision: Union[str, Sequence[str], None] = '5c9a3e1d7f20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('jobs', sa.Column('ordering_key', sa.String(), nullable=True))
+    op.create_index('ix_jobs_ordering_key_active', 'jobs', ['queue', 'ordering_key', 'id'],
+                    postgresql_where=sa.text("ordering_key IS NOT NULL AND status IN ('pending', 'running')"))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_jobs_ordering_key_active', table_name='jobs')
+    op.drop_column('jobs', 'ordering_key')
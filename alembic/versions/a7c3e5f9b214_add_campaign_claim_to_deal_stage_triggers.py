@@ -0,0 +1,28 @@
+"""Add campaign claim lease to deal_stage_triggers
+
+Revision ID: a7c3e5f9b214
+Revises: 8d2f4b6a1e93
+Create Date: 2026-10-18 23:41:26.519307
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7c3e5f9b214'
+down_revision: Union[str, Sequence[str], None] = '8d2f4b6a1e93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('deal_stage_triggers', sa.Column('campaign_claimed_until', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('deal_stage_triggers', 'campaign_claimed_until')
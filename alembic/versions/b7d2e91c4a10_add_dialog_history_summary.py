@@ -0,0 +1,30 @@
+"""Add rolling history summary to dialogs
+
+Revision ID: b7d2e91c4a10
+Revises: 644d6db1e2b1
+Create Date: 2026-10-18 14:05:37.218406
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7d2e91c4a10'
+down_revision: Union[str, Sequence[str], None] = '644d6db1e2b1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('dialogs', sa.Column('summary', sa.Text(), nullable=True))
+    op.add_column('dialogs', sa.Column('summary_message_count', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('dialogs', 'summary_message_count')
+    op.drop_column('dialogs', 'summary')
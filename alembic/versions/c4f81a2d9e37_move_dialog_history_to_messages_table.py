@@ -0,0 +1,76 @@
+"""Move dialog history to append-only dialog_messages table
+
+Revision ID: c4f81a2d9e37
+Revises: b7d2e91c4a10
+Create Date: 2026-10-18 15:22:48.604117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4f81a2d9e37'
+down_revision: Union[str, Sequence[str], None] = 'b7d2e91c4a10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('dialog_messages',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('dialog_id', sa.Integer(), nullable=False),
+    sa.Column('role', sa.String(), nullable=False),
+    sa.Column('content', sa.Text(), server_default='', nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['dialog_id'], ['dialogs.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_dialog_messages_dialog_id_id', 'dialog_messages', ['dialog_id', 'id'], unique=False)
+
+    # Переносим существующую историю, сохраняя порядок сообщений внутри диалога
+    op.execute("""
+        INSERT INTO dialog_messages (dialog_id, role, content, created_at)
+        SELECT d.id, COALESCE(m.value->>'role', 'user'), COALESCE(m.value->>'content', ''), COALESCE(d.updated_at, now())
+        FROM dialogs d
+        CROSS JOIN LATERAL jsonb_array_elements(d.history) WITH ORDINALITY AS m(value, position)
+        ORDER BY d.id, m.position
+    """)
+
+    # Курсор краткого содержания: вместо количества сообщений — ID последнего вошедшего в него сообщения
+    op.add_column('dialogs', sa.Column('summary_message_id', sa.BigInteger(), nullable=True))
+    op.execute("""
+        UPDATE dialogs d SET summary_message_id = (
+            SELECT dm.id FROM dialog_messages dm
+            WHERE dm.dialog_id = d.id
+            ORDER BY dm.id
+            OFFSET d.summary_message_count - 1 LIMIT 1
+        )
+        WHERE d.summary_message_count > 0
+    """)
+    op.drop_column('dialogs', 'summary_message_count')
+    op.drop_column('dialogs', 'history')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.add_column('dialogs', sa.Column('history', postgresql.JSONB(astext_type=sa.Text()), server_default='[]', nullable=False))
+    op.add_column('dialogs', sa.Column('summary_message_count', sa.Integer(), server_default='0', nullable=False))
+    op.execute("""
+        UPDATE dialogs d SET
+            history = COALESCE((
+                SELECT jsonb_agg(jsonb_build_object('role', dm.role, 'content', dm.content) ORDER BY dm.id)
+                FROM dialog_messages dm WHERE dm.dialog_id = d.id
+            ), '[]'::jsonb),
+            summary_message_count = (
+                SELECT count(*) FROM dialog_messages dm
+                WHERE dm.dialog_id = d.id AND dm.id <= d.summary_message_id
+            )
+    """)
+    op.drop_column('dialogs', 'summary_message_id')
+    op.drop_index('ix_dialog_messages_dialog_id_id', table_name='dialog_messages')
+    op.drop_table('dialog_messages')
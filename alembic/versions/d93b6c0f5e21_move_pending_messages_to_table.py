@@ -0,0 +1,61 @@
+"""Move pending messages queue to pending_messages table
+
+Revision ID: d93b6c0f5e21
+Revises: c4f81a2d9e37
+Create Date: 2026-10-18 16:10:05.337902
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd93b6c0f5e21'
+down_revision: Union[str, Sequence[str], None] = 'c4f81a2d9e37'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('pending_messages',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('dialog_id', sa.Integer(), nullable=False),
+    sa.Column('content', sa.Text(), server_default='', nullable=False),
+    sa.Column('file_url', sa.String(), nullable=True),
+    sa.Column('file_name', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['dialog_id'], ['dialogs.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_pending_messages_dialog_id_id', 'pending_messages', ['dialog_id', 'id'], unique=False)
+
+    # Переносим сообщения, которые еще ждут обработки, сохраняя их порядок
+    op.execute("""
+        INSERT INTO pending_messages (dialog_id, content, file_url, file_name)
+        SELECT d.id, COALESCE(m.value->>'content', ''), m.value->>'file_url', m.value->>'file_name'
+        FROM dialogs d
+        CROSS JOIN LATERAL jsonb_array_elements(d.pending_messages) WITH ORDINALITY AS m(value, position)
+        ORDER BY d.id, m.position
+    """)
+    op.drop_column('dialogs', 'pending_messages')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.add_column('dialogs', sa.Column('pending_messages', postgresql.JSONB(astext_type=sa.Text()), server_default='[]', nullable=False))
+    op.execute("""
+        UPDATE dialogs d SET pending_messages = sub.messages
+        FROM (
+            SELECT dialog_id, jsonb_agg(jsonb_strip_nulls(jsonb_build_object(
+                'role', 'user', 'content', content, 'file_url', file_url, 'file_name', file_name
+            )) ORDER BY id) AS messages
+            FROM pending_messages GROUP BY dialog_id
+        ) sub
+        WHERE d.id = sub.dialog_id
+    """)
+    op.drop_index('ix_pending_messages_dialog_id_id', table_name='pending_messages')
+    op.drop_table('pending_messages')
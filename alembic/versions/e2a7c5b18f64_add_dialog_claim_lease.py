@@ -0,0 +1,32 @@
+"""Add dispatcher claim lease columns to dialogs
+
+Revision ID: e2a7c5b18f64
+Revises: d93b6c0f5e21
+Create Date: 2026-10-18 16:58:21.740553
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2a7c5b18f64'
+down_revision: Union[str, Sequence[str], None] = 'd93b6c0f5e21'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('dialogs', sa.Column('claimed_until', sa.DateTime(), nullable=True))
+    op.add_column('dialogs', sa.Column('claimed_by', sa.String(), nullable=True))
+    op.add_column('dialogs', sa.Column('claim_attempts', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('dialogs', 'claim_attempts')
+    op.drop_column('dialogs', 'claimed_by')
+    op.drop_column('dialogs', 'claimed_until')
@@ -0,0 +1,37 @@
+"""Add adaptive debounce columns to dialogs
+
+Revision ID: f3b8d6a2c915
+Revises: e2a7c5b18f64
+Create Date: 2026-10-18 18:12:47.305918
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3b8d6a2c915'
+down_revision: Union[str, Sequence[str], None] = 'e2a7c5b18f64'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('dialogs', sa.Column('pending_started_at', sa.DateTime(), nullable=True))
+    op.add_column('dialogs', sa.Column('due_at', sa.DateTime(), nullable=True))
+    op.add_column('dialogs', sa.Column('typing_gap_seconds', sa.Float(), nullable=True))
+    # Уже ожидающие диалоги созревают по прежнему правилу: 10 секунд после последнего сообщения
+    op.execute(
+        "UPDATE dialogs SET pending_started_at = pending_since, "
+        "due_at = pending_since + interval '10 seconds' WHERE pending_since IS NOT NULL"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('dialogs', 'typing_gap_seconds')
+    op.drop_column('dialogs', 'due_at')
+    op.drop_column('dialogs', 'pending_started_at')
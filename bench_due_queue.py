@@ -0,0 +1,104 @@
+# bench_due_queue.py
+"""
+Замер выборки созревших диалогов (db_service.due_dialogs_query) на большой таблице dialogs.
+Создает отдельную схему с копией таблиц dialogs/pending_messages, наполняет ее синтетическими
+диалогами (по умолчанию 500 000) и сравнивает план и время запроса с частичным индексом
+ix_dialogs_due_at и без него. Рабочие таблицы не затрагиваются; схема удаляется в конце.
+
+  python bench_due_queue.py --dialogs 500000 --due-ratio 0.005 --runs 20
+Нужен DATABASE_URL в .env.
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import statistics
+from dotenv import load_dotenv
+
+load_dotenv()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+from sqlalchemy import text
+from database.db import engine, Base
+from database.models import Dialog, PendingMessage
+from database import db_service
+
+BENCH_SCHEMA = "dialog_queue_bench"
+
+
+def fill(conn, dialogs: int, due_ratio: float, escalated_ratio: float):
+    due_every = max(1, round(1 / due_ratio)) if due_ratio else 0
+    escalated_every = max(1, round(1 / escalated_ratio)) if escalated_ratio else 0
+    # Краткое содержание ~1 КБ — строки "тяжелые", как у живых диалогов
+    conn.execute(text("""
+        INSERT INTO dialogs (chat_id, current_state, summary, pending_since, due_at, claim_attempts)
+        SELECT
+            'bench-' || g,
+            CASE WHEN :escalated_every > 0 AND g % :escalated_every = 0 THEN 'escalated' ELSE 'idle' END,
+            repeat('краткое содержание ', 50),
+            now() - random() * interval '30 days',
+            CASE WHEN :due_every > 0 AND g % :due_every = 0 THEN now() - random() * interval '60 seconds' END,
+            0
+        FROM generate_series(1, :dialogs) AS g
+    """), {"dialogs": dialogs, "due_every": due_every, "escalated_every": escalated_every})
+    conn.execute(text("ANALYZE dialogs"))
+    conn.commit()
+
+
+def measure(conn, statement: str, runs: int) -> tuple[float, str]:
+    """Медиана времени выполнения (мс) по EXPLAIN ANALYZE и план последнего запуска."""
+    timings, plan = [], ""
+    for _ in range(runs):
+        rows = conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {statement}")).scalars().all()
+        conn.rollback()  # FOR UPDATE в EXPLAIN ANALYZE действительно блокирует строки
+        plan = "\n".join(rows)
+        match = re.search(r"Execution Time: ([\d.]+) ms", plan)
+        timings.append(float(match.group(1)))
+    return statistics.median(timings), plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер очереди диспетчера на большой таблице dialogs")
+    parser.add_argument("--dialogs", type=int, default=500_000)
+    parser.add_argument("--due-ratio", type=float, default=0.005, help="доля созревших диалогов")
+    parser.add_argument("--escalated-ratio", type=float, default=0.1, help="доля переданных менеджеру")
+    parser.add_argument("--limit", type=int, default=10, help="размер пачки (DISPATCHER_CONCURRENCY)")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--keep", action="store_true", help="не удалять схему после замера")
+    args = parser.parse_args()
+
+    statement = str(db_service.due_dialogs_query(args.limit).compile(
+        dialect=engine.dialect, compile_kwargs={"literal_binds": True}
+    ))
+
+    with engine.connect() as conn:
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA {BENCH_SCHEMA}"))
+        conn.execute(text(f"SET search_path TO {BENCH_SCHEMA}"))
+        Base.metadata.create_all(conn, tables=[Dialog.__table__, PendingMessage.__table__])
+        conn.commit()
+        try:
+            print(f"Наполняю {args.dialogs} диалогов...")
+            started = time.monotonic()
+            fill(conn, args.dialogs, args.due_ratio, args.escalated_ratio)
+            print(f"Готово за {time.monotonic() - started:.1f} с.\n")
+
+            with_index, plan = measure(conn, statement, args.runs)
+            print(f"С частичным индексом: {with_index:.3f} мс (медиана из {args.runs})\n{plan}\n")
+
+            conn.execute(text("DROP INDEX ix_dialogs_due_at"))
+            conn.commit()
+            without_index, plan = measure(conn, statement, args.runs)
+            print(f"Без индекса: {without_index:.3f} мс (медиана из {args.runs})\n{plan}\n")
+
+            print(f"Ускорение: x{without_index / with_index:.1f}")
+        finally:
+            conn.rollback()
+            if not args.keep:
+                conn.execute(text(f"DROP SCHEMA {BENCH_SCHEMA} CASCADE"))
+                conn.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# bench_wazzup_webhook.py
+"""
+Нагрузочный замер вебхука Wazzup (/webhook/wazzup).
+Шлет --payloads вызовов по --messages сообщений в каждом с параллельностью --concurrency;
+доля --status-share вызовов содержит только статусы доставки (как в подписке messagesAndStatuses).
+Печатает вызовы/с, сообщения/с и задержку ответа (p50/p95/max).
+
+  python bench_wazzup_webhook.py --payloads 2000 --messages 3 --concurrency 50
+По умолчанию приложение поднимается в этом же процессе (без lifespan — диспетчер и фоновые
+задачи не запускаются), нужна только БД из DATABASE_URL. С --url вызовы идут на живой сервер:
+используйте стенд с отключенным диспетчером, иначе бот начнет отвечать тестовым чатам.
+Тестовые чаты имеют номера 79000000000+; --cleanup удаляет их диалоги и отметки о принятых сообщениях.
+messageId содержат метку запуска, иначе защита от повторной доставки отбросила бы
+сообщения повторного замера, и он мерил бы только путь дедупликации.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import statistics
+import uuid
+from dotenv import load_dotenv
+
+load_dotenv()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+import httpx
+
+BENCH_CHAT_BASE = 79000000000
+# Метка запуска в messageId: сообщения прошлых замеров еще лежат в inbound_messages
+RUN_ID = uuid.uuid4().hex[:8]
+
+
+def make_payload(index: int, messages: int, chats: int, status_only: bool) -> dict:
+    if status_only:
+        return {"statuses": [{"messageId": f"bench-{RUN_ID}-{index}", "timestamp": "2024-01-01T00:00:00.000Z", "status": "delivered"}]}
+    payload = []
+    for i in range(messages):
+        chat_id = str(BENCH_CHAT_BASE + random.randrange(chats))
+        payload.append({
+            "messageId": f"bench-{RUN_ID}-{index}-{i}",
+            "chatId": chat_id,
+            "chatType": "whatsapp",
+            "isEcho": False,
+            "text": f"Тестовое сообщение {index}-{i}",
+        })
+    return {"messages": payload}
+
+
+async def run(client: httpx.AsyncClient, args) -> tuple[list[float], int, float]:
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for index in range(args.payloads):
+        queue.put_nowait(make_payload(index, args.messages, args.chats, random.random() < args.status_share))
+
+    async def sender():
+        nonlocal errors
+        while not queue.empty():
+            payload = queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                response = await client.post("/webhook/wazzup", json=payload)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                errors += 1
+                print(f"❌ {e}")
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(args.concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def cleanup(chats: int):
+    from sqlalchemy import delete
+    from database.db import SessionLocal
+    from database.models import Dialog, InboundMessage
+
+    bench_ids = [str(BENCH_CHAT_BASE + i) for i in range(chats)]
+    db = SessionLocal()
+    try:
+        # pending_messages удаляются каскадом
+        deleted = db.execute(delete(Dialog).where(Dialog.chat_id.in_(bench_ids))).rowcount
+        deleted_ids = db.execute(delete(InboundMessage).where(InboundMessage.chat_id.in_(bench_ids))).rowcount
+        db.commit()
+    finally:
+        db.close()
+    print(f"Удалено тестовых диалогов: {deleted}, отметок о принятых сообщениях: {deleted_ids}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный замер вебхука Wazzup")
+    parser.add_argument("--payloads", type=int, default=2000, help="число вызовов вебхука")
+    parser.add_argument("--messages", type=int, default=3, help="сообщений в одном вызове")
+    parser.add_argument("--chats", type=int, default=500, help="число тестовых чатов")
+    parser.add_argument("--status-share", type=float, default=0.5, help="доля вызовов только со статусами")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--url", default=None, help="адрес живого сервера (по умолчанию — в этом процессе)")
+    parser.add_argument("--cleanup", action="store_true", help="удалить тестовые диалоги и отметки о сообщениях после замера")
+    args = parser.parse_args()
+
+    if args.url:
+        transport, base_url = None, args.url.rstrip("/")
+    else:
+        from app import app
+        transport, base_url = httpx.ASGITransport(app=app), "http://bench"
+
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=60) as client:
+        latencies, errors, elapsed = await run(client, args)
+
+    message_payloads = round(args.payloads * (1 - args.status_share))
+    latencies.sort()
+    print(f"\nВызовов: {args.payloads} (с сообщениями ~{message_payloads}), ошибок: {errors}, за {elapsed:.1f} с")
+    print(f"Пропускная способность: {args.payloads / elapsed:.0f} вызовов/с, "
+          f"~{message_payloads * args.messages / elapsed:.0f} сообщений/с")
+    print(f"Задержка: p50 {statistics.median(latencies) * 1000:.1f} мс, "
+          f"p95 {latencies[int(0.95 * (len(latencies) - 1))] * 1000:.1f} мс, max {latencies[-1] * 1000:.1f} мс")
+
+    if not args.url:
+        from database.db import async_engine, get_pool_stats
+        print(f"Пул БД: {get_pool_stats()}")
+        await async_engine.dispose()
+    if args.cleanup:
+        cleanup(args.chats)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,176 @@
+# evaluate_debounce.py
+"""
+Офлайн-сравнение политик ожидания серии сообщений (src/services/debounce_policy.py).
+Проигрывает записанные моменты прихода сообщений клиентов и для каждой политики считает:
+  - задержку ответа: сколько проходит от последнего сообщения пачки до того, как диалог забирается в работу;
+  - долю разорванных серий: как часто "настоящая" серия (сообщения с паузами не больше --burst-gap)
+    уходит в LLM несколькими пачками.
+
+Источники данных:
+  python evaluate_debounce.py messages.jsonl        # строки {"chat_id": ..., "timestamp": ..., "text": ...}
+  python evaluate_debounce.py messages.csv          # колонки chat_id,timestamp,text
+  python evaluate_debounce.py --from-db --days 14   # сообщения клиентов из dialog_messages
+timestamp — ISO-строка или unix-время в секундах.
+Время обработки самим ботом не моделируется: пачка считается отвеченной в момент, когда созрела.
+"""
+import os
+import sys
+import csv
+import json
+import argparse
+import statistics
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+
+def parse_timestamp(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return datetime.fromisoformat(str(value)).timestamp()
+
+
+def load_file(path: str) -> dict[str, list[tuple[float, str]]]:
+    chats = {}
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    for row in rows:
+        chats.setdefault(str(row["chat_id"]), []).append((parse_timestamp(row["timestamp"]), row.get("text") or ""))
+    return chats
+
+
+def load_from_db(days: int) -> dict[str, list[tuple[float, str]]]:
+    """Сообщения клиентов за последние `days` дней. Точное время прихода хранится с введения адаптивного ожидания."""
+    from sqlalchemy import select
+    from database.db import SessionLocal
+    from database.models import Dialog, DialogMessage
+
+    chats = {}
+    db = SessionLocal()
+    try:
+        rows = db.execute(
+            select(Dialog.chat_id, DialogMessage.created_at, DialogMessage.content)
+            .join(Dialog, Dialog.id == DialogMessage.dialog_id)
+            .where(DialogMessage.role == "user", DialogMessage.created_at >= datetime.now() - timedelta(days=days))
+            .order_by(DialogMessage.dialog_id, DialogMessage.id)
+        ).all()
+    finally:
+        db.close()
+    for chat_id, created_at, content in rows:
+        chats.setdefault(chat_id, []).append((created_at.timestamp(), content or ""))
+    return chats
+
+
+def true_bursts(messages: list[tuple[float, str]], burst_gap: float) -> list[int]:
+    """Номер настоящей серии для каждого сообщения."""
+    labels, current = [], 0
+    for i, (ts, _) in enumerate(messages):
+        if i and ts - messages[i - 1][0] > burst_gap:
+            current += 1
+        labels.append(current)
+    return labels
+
+
+def simulate_chat(policy, messages: list[tuple[float, str]]) -> list[tuple[float, list[int]]]:
+    """
+    Проигрывает сообщения одного чата так же, как add_pending_message и диспетчер.
+    Возвращает пачки: (момент, когда диалог созрел, индексы сообщений).
+    """
+    from services.debounce_policy import ChatTiming
+
+    batches = []
+    typical_gap = None
+    pending, last_message_at, started_at, due_at = [], None, None, None
+    for i, (ts, text) in enumerate(messages):
+        if pending and ts >= due_at:
+            batches.append((due_at, pending))
+            pending, started_at = [], None
+        timing = ChatTiming(
+            since_last_message=ts - last_message_at if last_message_at is not None else None,
+            burst_elapsed=ts - started_at if pending else None,
+            typical_gap=typical_gap,
+        )
+        decision = policy.decide(timing, text)
+        typical_gap = decision.typical_gap
+        pending.append(i)
+        last_message_at = ts
+        started_at = started_at if started_at is not None else ts
+        due_at = ts + decision.delay_seconds
+    if pending:
+        batches.append((due_at, pending))
+    return batches
+
+
+def evaluate(policy, chats: dict, burst_gap: float) -> dict:
+    latencies, total_bursts, split_bursts, total_batches = [], 0, 0, 0
+    for messages in chats.values():
+        messages = sorted(messages)
+        labels = true_bursts(messages, burst_gap)
+        batches = simulate_chat(policy, messages)
+        total_batches += len(batches)
+
+        batches_per_burst = {}
+        for flushed_at, indexes in batches:
+            latencies.append(flushed_at - messages[indexes[-1]][0])
+            for label in {labels[i] for i in indexes}:
+                batches_per_burst[label] = batches_per_burst.get(label, 0) + 1
+
+        sizes = {}
+        for label in labels:
+            sizes[label] = sizes.get(label, 0) + 1
+        multi = [label for label, size in sizes.items() if size > 1]
+        total_bursts += len(multi)
+        split_bursts += sum(1 for label in multi if batches_per_burst.get(label, 0) > 1)
+
+    latencies.sort()
+    return {
+        "batches": total_batches,
+        "mean": statistics.mean(latencies) if latencies else 0.0,
+        "median": statistics.median(latencies) if latencies else 0.0,
+        "p90": latencies[int(0.9 * (len(latencies) - 1))] if latencies else 0.0,
+        "bursts": total_bursts,
+        "split": split_bursts,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение политик ожидания серии сообщений на записанных данных")
+    parser.add_argument("path", nargs="?", help="JSONL или CSV с полями chat_id, timestamp, text")
+    parser.add_argument("--from-db", action="store_true", help="взять сообщения клиентов из dialog_messages")
+    parser.add_argument("--days", type=int, default=14, help="глубина выборки из БД, дней")
+    parser.add_argument("--burst-gap", type=float, default=20.0,
+                        help="максимальная пауза внутри настоящей серии, секунд")
+    parser.add_argument("--policies", default=None, help="политики через запятую (по умолчанию все)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    from services.debounce_policy import POLICIES
+
+    if args.from_db:
+        chats = load_from_db(args.days)
+    elif args.path:
+        chats = load_file(args.path)
+    else:
+        parser.error("Укажите файл с сообщениями или --from-db")
+
+    total = sum(len(messages) for messages in chats.values())
+    print(f"Чатов: {len(chats)}, сообщений: {total}, граница серии: {args.burst_gap} с\n")
+
+    names = args.policies.split(",") if args.policies else list(POLICIES)
+    print(f"{'Политика':<12}{'Пачек':>8}{'Сред.':>9}{'Медиана':>9}{'p90':>9}{'Разорвано серий':>22}")
+    for name in names:
+        result = evaluate(POLICIES[name](), chats, args.burst_gap)
+        split_rate = result["split"] / result["bursts"] if result["bursts"] else 0.0
+        print(
+            f"{name:<12}{result['batches']:>8}{result['mean']:>8.1f}с{result['median']:>8.1f}с{result['p90']:>8.1f}с"
+            f"{result['split']:>9} из {result['bursts']:<5} ({split_rate:.0%})"
+        )
+
+
+if __name__ == "__main__":
+    main()
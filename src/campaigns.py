@@ -0,0 +1,224 @@
+# src/campaigns.py
+"""
+Кампании: массовый перевод сделок на стадию "Новый лот" или "Касание сегодня".
+Вместо сотен отдельных сценариев (у каждого свои запросы к Битрикс24, вызов LLM и отправка)
+события по стадии склеиваются в одну задачу очереди scenarios.CAMPAIGN_QUEUE, которая:
+1. закрепляет за собой пачку ожидающих сделок стадии (db_service.claim_campaign_deals), поэтому
+   второй запуск кампании (в том числе повтор задачи после истечения аренды) эти сделки не возьмет;
+2. получает контакты, менеджеров и дела несколькими batch-запросами (bitrix_service.get_deal_contexts);
+3. генерирует первые сообщения параллельно, не больше CAMPAIGN_LLM_CONCURRENCY вызовов LLM сразу;
+4. ставит отправки в outbox по расписанию общего лимита рассылок (CAMPAIGN_SENDS_PER_MINUTE),
+   поэтому канал WhatsApp не получает сотни сообщений разом, а ответы в живых диалогах не ждут рассылку.
+Каждая сделка сохраняется одной транзакцией (диалог + outbox + отметка о решении по стадии),
+поэтому повтор упавшей кампании обрабатывает только оставшиеся сделки.
+Пачка ограничена CAMPAIGN_MAX_DEALS и временем CAMPAIGN_BATCH_SECONDS, чтобы укладываться в закрепление
+сделок (CAMPAIGN_CLAIM_SECONDS); остаток забирает следующая задача кампании.
+"""
+import os
+import time
+import asyncio
+import traceback
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import db_service
+from database.db import AsyncSessionLocal
+from services import bitrix_service, llm_service, rate_limiter
+import deal_sync
+import outbox
+import scenarios
+
+# --- НАСТРОЙКИ КАМПАНИЙ ---
+CAMPAIGN_LLM_CONCURRENCY = int(os.getenv("CAMPAIGN_LLM_CONCURRENCY", "5"))
+# Больше сделок за один запуск не берем; остальные заберет следующая задача кампании.
+# 100 сделок при 5 параллельных вызовах LLM по ~10 с — около 200 с
+CAMPAIGN_MAX_DEALS = int(os.getenv("CAMPAIGN_MAX_DEALS", "100"))
+# Через столько секунд после начала пачки новые сделки не начинаем — они вернутся в очередь кампании
+CAMPAIGN_BATCH_SECONDS = int(os.getenv("CAMPAIGN_BATCH_SECONDS", "180"))
+# На сколько сделки закрепляются за запуском кампании: с запасом больше CAMPAIGN_BATCH_SECONDS
+# плюс обработка уже начатых сделок
+CAMPAIGN_CLAIM_SECONDS = int(os.getenv("CAMPAIGN_CLAIM_SECONDS", "600"))
+
+# Прогресс последней кампании по каждой стадии
+progress: dict[str, dict] = {}
+
+
+def get_stats() -> dict:
+    """Прогресс кампаний с оценкой оставшегося времени (генерация и расписание отправок)."""
+    now = time.time()
+    send_rate = rate_limiter.RATE_LIMITS["wazzup_campaign"][0]
+    result = {}
+    for stage_id, item in progress.items():
+        done = item["scheduled"] + item["skipped"] + item["errors"] + item["deferred"]
+        remaining = item["total"] - done
+        elapsed = (item["finished_at"] or now) - item["started_at"]
+        # Оставшиеся сообщения встанут в расписание после уже запланированных
+        sends_left = max(0.0, item["last_send_at"] - now) if item["last_send_at"] else 0.0
+        sends_left += remaining / send_rate if send_rate else 0.0
+        generation_left = elapsed / done * remaining if done else None
+        result[stage_id] = {
+            **{key: value for key, value in item.items() if key not in ("started_at", "finished_at", "last_send_at")},
+            "done": done,
+            "elapsed_seconds": round(elapsed, 1),
+            "eta_seconds": round(max(generation_left or 0.0, sends_left), 1) if remaining or sends_left else 0.0,
+        }
+    return result
+
+
+async def _save_greeting(deal_id: int, manager_id: int, funnel_id: str, stage_id: str, client_phone: str,
+                         decision: dict, item: dict):
+    """Сохраняет первое сообщение сделки: диалог, отложенная отправка и отметка о стадии — одна транзакция."""
+    response_text = decision.get("response_text")
+    action_params = decision.get("action_params", {})
+    async with AsyncSessionLocal() as db:
+        if response_text:
+            # Место в расписании рассылок, общее для всех процессов
+            send_in = await rate_limiter.reserve("wazzup_campaign")
+            await outbox.enqueue_reply(db, client_phone, response_text, delay_seconds=send_in)
+            item["last_send_at"] = max(item["last_send_at"] or 0.0, time.time() + send_in)
+        if decision.get("action") == "LOG_COMMENT" and action_params.get("comment_text"):
+            await outbox.enqueue_crm_action(db, "LOG_COMMENT", deal_id, manager_id, action_params)
+        await db_service.mark_deal_stage_handled(db, deal_id, stage_id, commit=False)
+        await db_service.get_or_create_dialog(db, client_phone, deal_id, manager_id, funnel_id, commit=False)
+        new_messages = [{"role": "assistant", "content": response_text}] if response_text else []
+        await db_service.update_dialog(db, client_phone, decision.get("new_state"), new_messages)
+    outbox.notify_senders()
+
+
+async def _skip_deal(deal_id: int, manager_id: int, stage_id: str, comment: str = None):
+    """Сценарий для сделки не запускается, но решение по стадии принято (как в scenarios.handle_deal_update)."""
+    async with AsyncSessionLocal() as db:
+        if comment:
+            await outbox.enqueue_crm_action(db, "LOG_COMMENT", deal_id, manager_id, {"comment_text": comment})
+        await db_service.mark_deal_stage_handled(db, deal_id, stage_id, commit=False)
+        await db.commit()
+    if comment:
+        outbox.notify_senders()
+
+
+async def _process_deal(stage_id: str, deal_context: dict, item: dict):
+    deal = deal_context['deal']
+    deal_id = int(deal["ID"])
+    manager_id = int(deal["ASSIGNED_BY_ID"]) if deal.get("ASSIGNED_BY_ID") else None
+    try:
+        contact = deal_context['contact']
+        if not (contact and contact.get("PHONE")):
+            print(f"⚠️ Кампания: у контакта сделки {deal_id} нет номера телефона.")
+            await _skip_deal(deal_id, manager_id, stage_id)
+            item["skipped"] += 1
+            return
+        client_name, client_phone, manager_name = scenarios.contact_card(deal_context)
+
+        debtor_name_info = None
+        if stage_id == scenarios.NEW_LOT_STAGE_ID:
+            activity = deal_context['activity']
+            if not activity or not activity.get("DESCRIPTION"):
+                print(f"⚠️ Кампания: не найдено дело с описанием для сделки {deal_id}.")
+                await _skip_deal(deal_id, manager_id, stage_id, "Ошибка: не удалось запустить сценарий 'Новый лот', "
+                                                                "т.к. к сделке не привязано дело с описанием.")
+                item["skipped"] += 1
+                return
+            debtor_name_info = activity["DESCRIPTION"]
+
+        instruction, prompt_state = scenarios.scenario_instruction(stage_id, client_name, manager_name, debtor_name_info)
+        decision = await llm_service.get_bot_decision([instruction], state=prompt_state)
+        if not decision:
+            print(f"❌ Кампания: LLM не вернул решение для сделки {deal_id}.")
+            await _skip_deal(deal_id, manager_id, stage_id)
+            item["skipped"] += 1
+            return
+        if decision.get("new_state") == db_service.ESCALATED_STATE or decision.get("action") == "ESCALATE_TO_MANAGER":
+            # Так get_bot_decision отвечает при сбое OpenAI (извинение + эскалация). Первым сообщением
+            # рассылки это уходить не должно: сделка вернется в очередь и будет повторена
+            raise RuntimeError("вместо приветствия LLM вернул эскалацию (вероятно, сбой OpenAI)")
+
+        await _save_greeting(deal_id, manager_id, str(deal.get("CATEGORY_ID")), stage_id, client_phone, decision, item)
+        item["scheduled"] += 1
+    except Exception as e:
+        # Сделка остается необработанной — снимаем закрепление, ее заберет повтор задачи кампании
+        item["errors"] += 1
+        print(f"❌ Кампания: ошибка по сделке {deal_id}: {e}")
+        traceback.print_exc()
+        await _release_deals(stage_id, [deal_id])
+
+
+async def _release_deals(stage_id: str, deal_ids: list[int]):
+    try:
+        async with AsyncSessionLocal() as db:
+            await db_service.release_campaign_deals(db, stage_id, deal_ids)
+    except Exception as e:
+        # Закрепление истечет само через CAMPAIGN_CLAIM_SECONDS
+        print(f"❌ Кампания: не удалось вернуть в очередь сделки {deal_ids}: {e}")
+
+
+async def _process_limited(stage_id: str, deal_context: dict, semaphore: asyncio.Semaphore, item: dict,
+                           deadline: float, deferred: list[int]):
+    # Ограничение на всю обработку сделки: и вызовы LLM, и записи в БД идут не больше CAMPAIGN_LLM_CONCURRENCY сразу
+    async with semaphore:
+        if time.monotonic() > deadline:
+            # Время пачки вышло: сделку заберет следующая задача кампании
+            deferred.append(int(deal_context['deal']["ID"]))
+            item["deferred"] += 1
+            return
+        await _process_deal(stage_id, deal_context, item)
+
+
+async def _enqueue_next(db: AsyncSession, stage_id: str, delay_seconds: float = 0):
+    await db_service.enqueue_job(
+        db, scenarios.CAMPAIGN_QUEUE, {"stage_id": stage_id}, delay_seconds=delay_seconds, dedup_key=f"campaign:{stage_id}"
+    )
+
+
+async def handle_campaign(db: AsyncSession, payload: dict) -> dict:
+    """Задача кампании по стадии: пачка ожидающих сделок стадии обрабатывается за один запуск."""
+    stage_id = payload["stage_id"]
+    snapshots = await db_service.claim_campaign_deals(db, stage_id, CAMPAIGN_MAX_DEALS, CAMPAIGN_CLAIM_SECONDS)
+    if not snapshots:
+        # Оставшиеся сделки закреплены за другим запуском; если он упал, забираем их после истечения закрепления
+        expire_in = await db_service.campaign_claims_expire_in(db, stage_id)
+        if expire_in is not None:
+            await _enqueue_next(db, stage_id, delay_seconds=int(expire_in) + 1)
+        return {"status": "ok", "message": "No deals waiting for campaign"}
+
+    item = progress[stage_id] = {
+        "status": "prefetching",
+        "total": len(snapshots),
+        "scheduled": 0,   # первое сообщение сгенерировано и поставлено в расписание отправки
+        "skipped": 0,     # нет телефона/дела или LLM не ответил — решение по стадии принято без сообщения
+        "errors": 0,      # сбой при обработке; сделка будет повторена
+        "deferred": 0,    # не успели за CAMPAIGN_BATCH_SECONDS; сделку заберет следующая задача
+        "started_at": time.time(),
+        "finished_at": None,
+        "last_send_at": None,
+    }
+    print(f"📣 Кампания по стадии '{stage_id}': {len(snapshots)} сделок.")
+    deadline = time.monotonic() + CAMPAIGN_BATCH_SECONDS
+
+    deals = [deal_sync.snapshot_to_deal(snapshot) for snapshot in snapshots]
+    try:
+        contexts = await bitrix_service.get_deal_contexts(deals, include_activity=stage_id == scenarios.NEW_LOT_STAGE_ID)
+    except Exception:
+        # Ни одна сделка не начата — возвращаем всю пачку для повтора задачи
+        await _release_deals(stage_id, [int(deal["ID"]) for deal in deals])
+        raise
+
+    item["status"] = "generating"
+    semaphore = asyncio.Semaphore(max(1, CAMPAIGN_LLM_CONCURRENCY))
+    deferred: list[int] = []
+    await asyncio.gather(*(
+        _process_limited(stage_id, contexts[int(deal["ID"])], semaphore, item, deadline, deferred) for deal in deals
+    ))
+    item["status"] = "sending"
+    item["finished_at"] = time.time()
+
+    sends_in = max(0.0, item["last_send_at"] - time.time()) if item["last_send_at"] else 0.0
+    print(f"📣 Кампания по стадии '{stage_id}' подготовлена: {item['scheduled']} сообщений в расписании "
+          f"(последнее через {sends_in:.0f} с), пропущено {item['skipped']}, отложено {item['deferred']}, "
+          f"ошибок {item['errors']}.")
+    if deferred:
+        await _release_deals(stage_id, deferred)
+    if item["errors"]:
+        raise RuntimeError(f"{item['errors']} сделок кампании не обработаны")
+    if deferred or len(snapshots) == CAMPAIGN_MAX_DEALS:
+        # Сделок больше, чем вошло в пачку, — остаток забирает следующая задача
+        await _enqueue_next(db, stage_id)
+    return {"status": "ok", "scheduled": item["scheduled"], "skipped": item["skipped"], "deferred": item["deferred"]}
@@ -1,12 +1,86 @@
 # src/database/db.py
 import os
-from sqlalchemy import create_engine
+import time
+from sqlalchemy import create_engine, make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 # Берем URL из .env, чтобы не дублировать информацию
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Приложение работает через asyncpg; по умолчанию URL тот же, меняется только драйвер
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or make_url(DATABASE_URL).set(drivername="postgresql+asyncpg")
 
+# --- НАСТРОЙКИ ПУЛА СОЕДИНЕНИЙ ---
+# Постоянные соединения процесса и сколько можно открыть сверх них при пиковой нагрузке
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Соединения старше этого пересоздаются (защита от обрывов на стороне прокси/балансировщика)
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))
+# Сколько запрос ждет свободного соединения, прежде чем упасть с ошибкой
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
+
+pool_stats = {
+    "checkouts": 0,
+    "timeouts": 0,          # запросы, не дождавшиеся соединения за DB_POOL_TIMEOUT_SECONDS
+    "wait_seconds_total": 0.0,
+    "max_wait_seconds": 0.0,
+    "peak_checked_out": 0,
+}
+
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    """Пул asyncpg, который замеряет, сколько запросы ждут соединения (включая открытие нового)."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_stats["timeouts"] += 1
+            raise
+        waited = time.perf_counter() - started
+        pool_stats["checkouts"] += 1
+        pool_stats["wait_seconds_total"] += waited
+        pool_stats["max_wait_seconds"] = max(pool_stats["max_wait_seconds"], waited)
+        pool_stats["peak_checked_out"] = max(pool_stats["peak_checked_out"], self.checkedout())
+        return connection
+
+
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    poolclass=MeteredPool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_recycle=DB_POOL_RECYCLE_SECONDS,
+    pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+    pool_pre_ping=True,
+)
+# expire_on_commit=False: после коммита объекты остаются читаемыми без ленивой догрузки из БД
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# Синхронный движок — только для Alembic и служебных скриптов; приложение его не использует
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
+
+
+def get_pool_stats() -> dict:
+    """Загрузка пула и ожидание соединений в текущем процессе — по ним подбираются DB_POOL_SIZE/DB_MAX_OVERFLOW."""
+    pool = async_engine.sync_engine.pool
+    capacity = DB_POOL_SIZE + DB_MAX_OVERFLOW
+    checkouts = pool_stats["checkouts"]
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_out": pool.checkedout(),
+        "overflow": max(0, pool.overflow()),
+        "utilization": round(pool.checkedout() / capacity, 3) if capacity else None,
+        "peak_utilization": round(pool_stats["peak_checked_out"] / capacity, 3) if capacity else None,
+        "checkouts": checkouts,
+        "timeouts": pool_stats["timeouts"],
+        "avg_wait_ms": round(pool_stats["wait_seconds_total"] / checkouts * 1000, 2) if checkouts else 0.0,
+        "max_wait_ms": round(pool_stats["max_wait_seconds"] * 1000, 2),
+    }
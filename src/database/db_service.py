@@ -1,114 +1,727 @@
 # src/database/db_service.py
-from sqlalchemy.orm import Session
-from sqlalchemy.orm.attributes import flag_modified
-from sqlalchemy import func, and_
+import os
+import json
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, and_, or_, case, text, cast, bindparam, column, literal, literal_column, select, insert, update, delete, values, DateTime, Integer, String, Text
+from sqlalchemy.dialects.postgresql import insert as pg_insert, JSONB
+from sqlalchemy.orm import aliased
 from datetime import datetime, timedelta
-from .models import Dialog
+from services.cache_service import TTLCache
+from services.debounce_policy import ChatTiming, get_policy as get_debounce_policy
+from .models import Dialog, DialogMessage, PendingMessage, InboundMessage, Job, DealStageTrigger, DealSnapshot, RateLimitBucket
 
-def get_or_create_dialog(db: Session, chat_id: str, deal_id: int = None, manager_id: int = None, funnel_id: str = None) -> Dialog:
+async def get_or_create_dialog(db: AsyncSession, chat_id: str, deal_id: int = None, manager_id: int = None,
+                               funnel_id: str = None, commit: bool = True) -> Dialog:
     """
-    Находит диалог по chat_id. Если не находит - создает новый.
-    Если находит, может обновить информацию о сделке.
+    Находит диалог по chat_id или создает новый — одной командой INSERT ... ON CONFLICT ... RETURNING,
+    поэтому одновременные первые сообщения нового чата не упираются в уникальность chat_id.
+    Переданные ID сделки, менеджера и воронки обновляют существующий диалог, пустые — не трогают.
+    При `commit=False` диалог остается в транзакции вызывающего кода.
     """
-    dialog = db.query(Dialog).filter(Dialog.chat_id == chat_id).first()
-    if not dialog:
-        dialog = Dialog(
-            chat_id=chat_id,
-            deal_id=deal_id,
-            manager_id=manager_id,
-            funnel_id=funnel_id
-        )
-        db.add(dialog)
+    stmt = pg_insert(Dialog).values(chat_id=chat_id, deal_id=deal_id, manager_id=manager_id, funnel_id=funnel_id)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Dialog.chat_id],
+        set_={
+            "deal_id": func.coalesce(stmt.excluded.deal_id, Dialog.deal_id),
+            "manager_id": func.coalesce(stmt.excluded.manager_id, Dialog.manager_id),
+            "funnel_id": func.coalesce(stmt.excluded.funnel_id, Dialog.funnel_id),
+            "updated_at": func.now(),
+        },
+    ).returning(Dialog, literal_column("xmax = 0").label("inserted"))
+    # populate_existing: объект из identity map сессии получает значения, только что записанные в БД
+    dialog, inserted = (await db.execute(stmt, execution_options={"populate_existing": True})).one()
+    if commit:
+        await db.commit()
+
+    if inserted:
         print(f"Создан новый диалог в БД для chat_id: {chat_id} (Сделка: {deal_id})")
     else:
-        # Если диалог уже есть, обновляем ID сделки и менеджера, если они переданы
-        if deal_id: dialog.deal_id = deal_id
-        if manager_id: dialog.manager_id = manager_id
-        if funnel_id: dialog.funnel_id = funnel_id
         print(f"Найден существующий диалог для chat_id: {chat_id}. Информация о сделке обновлена.")
-
-    db.commit()
-    db.refresh(dialog)
     return dialog
 
-def update_dialog(db: Session, chat_id: str, new_state: str, new_history: list):
+def _message_rows(dialog_id: int, messages: list) -> list[dict]:
+    return [
+        {
+            "dialog_id": dialog_id,
+            "role": msg.get("role", "user"),
+            "content": msg.get("content") or "",
+            "created_at": msg.get("created_at"),
+        }
+        for msg in messages
+    ]
+
+# Сообщение клиента датируется моментом прихода (по нему разбираются паузы клиента), остальные — моментом записи
+_insert_dialog_message = insert(DialogMessage).values(
+    dialog_id=bindparam("dialog_id"),
+    role=bindparam("role"),
+    content=bindparam("content"),
+    created_at=func.coalesce(bindparam("created_at", type_=DateTime), func.now()),
+)
+
+async def update_dialog(db: AsyncSession, chat_id: str, new_state: str, new_messages: list, commit: bool = True):
     """
-    Комплексно обновляет диалог: устанавливает новое состояние и перезаписывает историю.
+    Комплексно обновляет диалог: устанавливает новое состояние и дописывает новые сообщения хода.
+    Состояние меняется командой UPDATE ... RETURNING id (без предварительного чтения диалога),
+    а сообщения добавляются одним INSERT — прежняя история не перезаписывается.
+    При `commit=False` коммитит вызывающий (диспетчер — вместе с закрытием аренды диалога).
     """
-    dialog = db.query(Dialog).filter(Dialog.chat_id == chat_id).first()
-    if dialog:
-        dialog.current_state = new_state
-        dialog.history = new_history
-        flag_modified(dialog, "history")
-        db.commit()
-        print(f"Диалог {chat_id} обновлен. Новое состояние: '{new_state}'.")
+    dialog_id = (await db.execute(
+        update(Dialog).where(Dialog.chat_id == chat_id).values(current_state=new_state).returning(Dialog.id)
+    )).scalar()
+    if dialog_id is not None:
+        if new_messages:
+            await db.execute(_insert_dialog_message, _message_rows(dialog_id, new_messages))
+        if commit:
+            await db.commit()
+        print(f"Диалог {chat_id} обновлен. Новое состояние: '{new_state}'. Новых сообщений: {len(new_messages)}.")
     else:
         print(f"⚠️ Попытка обновить несуществующий диалог: {chat_id}")
 
 
-def add_message_to_history(db: Session, chat_id: str, role: str, content: str):
+async def add_message_to_history(db: AsyncSession, chat_id: str, role: str, content: str):
     """
     Добавляет одно сообщение в историю диалога.
     ВАЖНО: Эта функция теперь менее предпочтительна, чем update_dialog.
     """
-    dialog = get_or_create_dialog(db, chat_id)
-    dialog.history.append({"role": role, "content": content})
-    flag_modified(dialog, "history")
-    db.commit()
+    dialog = await get_or_create_dialog(db, chat_id, commit=False)
+    await db.execute(_insert_dialog_message, _message_rows(dialog.id, [{"role": role, "content": content}]))
+    await db.commit()
     print(f"Сообщение от '{role}' сохранено в историю для chat_id: {chat_id}")
 
-def get_dialog_history(db: Session, chat_id: str) -> list:
+async def get_dialog_messages(db: AsyncSession, dialog_id: int, after_id: int = None, before_id: int = None,
+                        limit: int = None, newest: bool = False) -> list[dict]:
+    """
+    Читает часть переписки в хронологическом порядке: сообщения с ID в (after_id, before_id).
+    limit ограничивает выборку самыми старыми (newest=False) или самыми новыми (newest=True) сообщениями.
+    """
+    query = select(DialogMessage.id, DialogMessage.role, DialogMessage.content).where(DialogMessage.dialog_id == dialog_id)
+    if after_id is not None:
+        query = query.where(DialogMessage.id > after_id)
+    if before_id is not None:
+        query = query.where(DialogMessage.id < before_id)
+    query = query.order_by(DialogMessage.id.desc() if newest else DialogMessage.id)
+    if limit is not None:
+        query = query.limit(limit)
+    rows = (await db.execute(query)).all()
+    if newest:
+        rows.reverse()
+    return [{"id": row.id, "role": row.role, "content": row.content} for row in rows]
+
+async def get_dialog_history(db: AsyncSession, chat_id: str, limit: int = None) -> list:
+    """
+    Получает историю диалога для указанного chat_id (при заданном limit — только последние сообщения).
+    Один запрос по dialog_messages с соединением по chat_id — диалог отдельно не читается и не создается.
+    """
+    query = select(DialogMessage.role, DialogMessage.content).join(Dialog, Dialog.id == DialogMessage.dialog_id)
+    query = query.where(Dialog.chat_id == chat_id).order_by(DialogMessage.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    rows = (await db.execute(query)).all()
+    return [{"role": row.role, "content": row.content} for row in reversed(rows)]
+
+async def get_dialog(db: AsyncSession, chat_id: str) -> Dialog | None:
+    """Находит диалог по chat_id без создания и без лишнего коммита."""
+    return (await db.execute(select(Dialog).where(Dialog.chat_id == chat_id))).scalar_one_or_none()
+
+async def update_dialog_summary(db: AsyncSession, chat_id: str, summary: str, summary_message_id: int):
+    """Сохраняет сжатое содержание старой части истории вместе с диалогом."""
+    await db.execute(update(Dialog).where(Dialog.chat_id == chat_id).values(
+        summary=summary, summary_message_id=summary_message_id
+    ))
+    await db.commit()
+
+# --- ОЧЕРЕДЬ ВХОДЯЩИХ СООБЩЕНИЙ (pending_messages, аренда диалогов диспетчером) ---
+# Канал LISTEN/NOTIFY, в который сообщается chat_id каждого нового входящего сообщения
+PENDING_MESSAGES_CHANNEL = "pending_messages"
+# Диалог передан менеджеру: бот его больше не обрабатывает, входящие сообщения в очередь не ставятся
+ESCALATED_STATE = "escalated"
+# Литерал, а не параметр: иначе Postgres не сопоставит условие с частичным индексом ix_dialogs_due_at
+_not_escalated = text(f"dialogs.current_state <> '{ESCALATED_STATE}'")
+
+# Недавно принятые messageId Wazzup: повторы доставки отсеиваются без обращения к БД.
+# Кэш только ускоряет проверку — источник истины таблица inbound_messages
+_accepted_message_ids = TTLCache("wazzup_message_ids",
+                                 ttl_seconds=float(os.getenv("WAZZUP_DEDUP_CACHE_TTL_SECONDS", "3600")),
+                                 max_size=int(os.getenv("WAZZUP_DEDUP_CACHE_SIZE", "50000")))
+
+inbound_stats = {
+    "duplicates_in_memory": 0,  # повторы, отсеянные кэшем или внутри одной пачки
+    "duplicates_in_db": 0,      # повторы, найденные по inbound_messages
+}
+
+
+def get_inbound_stats() -> dict:
+    return {**inbound_stats, "duplicates_suppressed": inbound_stats["duplicates_in_memory"] + inbound_stats["duplicates_in_db"]}
+
+
+async def add_pending_message(db: AsyncSession, chat_id: str, content: str, file_url: str = None, file_name: str = None,
+                              debounce_policy=None, message_id: str = None):
+    """Добавляет одно входящее сообщение в очередь ожидания (см. add_pending_messages)."""
+    await add_pending_messages(
+        db, [{"chat_id": chat_id, "content": content, "file_url": file_url, "file_name": file_name, "message_id": message_id}],
+        debounce_policy,
+    )
+
+
+async def _drop_duplicate_messages(db: AsyncSession, messages: list[dict]) -> tuple[list[dict], list[str]]:
     """
-    Получает историю диалога для указанного chat_id.
+    Отсеивает повторные доставки по message_id (сообщения без него пропускаются как есть).
+    Сначала — по кэшу недавно принятых ID, затем одной вставкой в inbound_messages: уже известные ID
+    ON CONFLICT не вставляет и не возвращает. Отметки коммитятся вместе с очередью — если транзакция
+    откатится, повтор доставки не будет ошибочно отброшен. Возвращает новые сообщения и их ID.
     """
-    dialog = get_or_create_dialog(db, chat_id)
-    return dialog.history
+    candidates = {}
+    for message in messages:
+        message_id = message.get("message_id")
+        if not message_id:
+            continue
+        if message_id in candidates or _accepted_message_ids.get(message_id):
+            inbound_stats["duplicates_in_memory"] += 1
+            continue
+        candidates[message_id] = message
+    if not candidates:
+        return [message for message in messages if not message.get("message_id")], []
 
-# --- Функции для работы с очередью остаются без изменений ---
-def add_pending_message(db: Session, chat_id: str, content: str, file_url: str = None, file_name: str = None):
+    # Вставка в порядке ID: параллельные повторы одной пачки не ждут друг друга по кругу
+    stmt = pg_insert(InboundMessage).values([
+        {"message_id": message_id, "chat_id": candidates[message_id]["chat_id"]} for message_id in sorted(candidates)
+    ]).on_conflict_do_nothing(index_elements=[InboundMessage.message_id]).returning(InboundMessage.message_id)
+    accepted = set((await db.execute(stmt)).scalars().all())
+    inbound_stats["duplicates_in_db"] += len(candidates) - len(accepted)
+
+    fresh = [
+        message for message in messages
+        if not message.get("message_id") or (message["message_id"] in accepted and candidates[message["message_id"]] is message)
+    ]
+    return fresh, list(accepted)
+
+
+async def add_pending_messages(db: AsyncSession, messages: list[dict], debounce_policy=None) -> int:
     """
-    Добавляет входящее сообщение в очередь ожидания.
-    Теперь также принимает информацию о файле.
+    Ставит в очередь ожидания пачку входящих сообщений (ключи: chat_id, content, file_url, file_name,
+    message_id) одной транзакцией. Повторно доставленные сообщения (тот же message_id) отбрасываются.
+    Сообщения группируются по чатам с сохранением порядка; на каждый чат —
+    две команды и одно NOTIFY, сколько бы его сообщений ни пришло в пачке.
+    Возвращает число поставленных в очередь сообщений.
     """
-    dialog = get_or_create_dialog(db, chat_id)
-    
-    # Создаем более богатый объект сообщения
-    message_data = {"role": "user", "content": content}
-    if file_url:
-        message_data["file_url"] = file_url
-    if file_name:
-        message_data["file_name"] = file_name
+    debounce_policy = debounce_policy or get_debounce_policy()
+    messages, accepted_ids = await _drop_duplicate_messages(db, messages)
+    by_chat = {}
+    for message in messages:
+        by_chat.setdefault(message["chat_id"], []).append(message)
+
+    queued = 0
+    # Строки диалогов блокируются в порядке chat_id — параллельные пачки не ждут друг друга по кругу
+    for chat_id in sorted(by_chat):
+        queued += await _enqueue_chat_messages(db, chat_id, by_chat[chat_id], debounce_policy)
+    await db.commit()
+    for message_id in accepted_ids:
+        _accepted_message_ids.set(message_id, True)
+    return queued
 
-    dialog.pending_messages.append(message_data)
-    dialog.pending_since = func.now() 
-    
-    flag_modified(dialog, "pending_messages")
-    db.commit()
-    print(f"Сообщение для {chat_id} добавлено в очередь.")
-    
 
-def get_and_clear_pending_dialogs(db: Session, delay_seconds: int = 10) -> list[dict]:
+async def _enqueue_chat_messages(db: AsyncSession, chat_id: str, messages: list[dict], debounce_policy) -> int:
     """
-    Находит диалоги, ожидающие обработки, "забирает" их сообщения и очищает очередь.
-    Возвращает список словарей, содержащих объект диалога и его сообщения.
+    Сообщения одного чата (без коммита). Строка диалога (создается при необходимости) блокируется
+    до конца транзакции, поэтому паузы клиента считаются согласованно даже для параллельных вебхуков.
+    Политика ожидания решает, когда диалог созреет (due_at); несколько сообщений одной пачки
+    для нее — одна реплика, законченность оценивается по последнему.
     """
-    time_filter = Dialog.pending_since <= (func.now() - timedelta(seconds=delay_seconds))
-    
-    dialogs_to_process = db.query(Dialog).filter(
-        func.jsonb_array_length(Dialog.pending_messages) > 0,
-        time_filter
-    ).all()
+    # 1. Создаем или блокируем диалог и узнаем паузы клиента (по часам БД)
+    locked = pg_insert(Dialog).values(chat_id=chat_id)
+    locked = locked.on_conflict_do_update(
+        index_elements=[Dialog.chat_id], set_={"chat_id": locked.excluded.chat_id}
+    ).returning(
+        Dialog.id,
+        func.extract("epoch", func.now() - Dialog.pending_since).label("since_last_message"),
+        func.extract("epoch", func.now() - Dialog.pending_started_at).label("burst_elapsed"),
+        Dialog.typing_gap_seconds,
+        Dialog.current_state,
+    )
+    row = (await db.execute(locked)).one()
+    if row.current_state == ESCALATED_STATE:
+        print(f"Диалог {chat_id} находится в состоянии '{ESCALATED_STATE}'. Сообщения не ставятся в очередь.")
+        return 0
+    timing = ChatTiming(
+        since_last_message=float(row.since_last_message) if row.since_last_message is not None else None,
+        burst_elapsed=float(row.burst_elapsed) if row.burst_elapsed is not None else None,
+        typical_gap=row.typing_gap_seconds,
+    )
+    decision = debounce_policy.decide(timing, messages[-1]["content"])
+
+    # 2. Одна команда: сдвинуть сроки диалога и вставить все сообщения чата
+    dialog = update(Dialog).where(Dialog.id == row.id).values(
+        pending_since=func.now(),
+        pending_started_at=func.coalesce(Dialog.pending_started_at, func.now()),
+        due_at=func.now() + timedelta(seconds=decision.delay_seconds),
+        typing_gap_seconds=decision.typical_gap,
+    ).returning(Dialog.id).cte("dialog")
+
+    incoming = values(
+        column("position", Integer), column("content", Text), column("file_url", String), column("file_name", String),
+        name="incoming",
+    ).data([
+        (position, message["content"] or "", message.get("file_url"), message.get("file_name"))
+        for position, message in enumerate(messages)
+    ])
+    message = insert(PendingMessage).from_select(
+        ["dialog_id", "content", "file_url", "file_name"],
+        select(dialog.c.id, incoming.c.content, incoming.c.file_url, incoming.c.file_name).order_by(incoming.c.position),
+    ).returning(PendingMessage.id).cte("message")
+
+    # Уведомление уходит слушающим диспетчерам в момент коммита (одно на чат)
+    payload = json.dumps({"chat_id": chat_id, "delay": decision.delay_seconds})
+    await db.execute(select(func.pg_notify(PENDING_MESSAGES_CHANNEL, payload)).select_from(message).limit(1))
+    print(f"Сообщений для {chat_id} добавлено в очередь: {len(messages)}. "
+          f"Ожидание: {decision.delay_seconds} с ({debounce_policy.name}).")
+    return len(messages)
 
-    if not dialogs_to_process:
+
+def due_dialogs_query(limit: int):
+    """
+    ID созревших диалогов, которые можно взять в аренду (переданные менеджеру отсеиваются в SQL).
+    Условия совпадают с частичным индексом ix_dialogs_due_at, поэтому читается только он, а не вся таблица.
+    """
+    return select(Dialog.id).where(
+        Dialog.due_at <= func.now(),
+        _not_escalated,
+        or_(Dialog.claimed_until.is_(None), Dialog.claimed_until < func.now()),
+    ).order_by(Dialog.due_at).limit(limit).with_for_update(skip_locked=True)
+
+
+async def claim_pending_dialogs(db: AsyncSession, worker_id: str, limit: int, lease_seconds: int = 300) -> list[dict]:
+    """
+    Забирает до `limit` созревших диалогов (наступил due_at) в аренду на `lease_seconds`.
+    FOR UPDATE SKIP LOCKED позволяет любому числу процессов делить очередь без двойной обработки,
+    а диалоги упавшего воркера снова становятся доступны после истечения аренды.
+    Сообщения при этом НЕ удаляются — это делает ack_dialog_claim после успешной обработки.
+    Возвращает список словарей с полями диалога, его сообщениями и ID последнего из них.
+    """
+    if limit <= 0:
         return []
 
-    results = []
-    for dialog in dialogs_to_process:
-        pending = list(dialog.pending_messages)
-        dialog.pending_messages.clear()
-        dialog.pending_since = None
-        flag_modified(dialog, "pending_messages")
-        results.append({'dialog': dialog, 'pending': pending})
-    
-    db.commit()
-    return results
\ No newline at end of file
+    claimable = due_dialogs_query(limit).cte("claimable")
+
+    claimed = update(Dialog).where(Dialog.id == claimable.c.id).values(
+        # Сообщения, пришедшие во время обработки, начнут новую серию
+        pending_started_at=None,
+        claimed_until=func.now() + timedelta(seconds=lease_seconds),
+        claimed_by=worker_id,
+        claim_attempts=Dialog.claim_attempts + 1,
+    ).returning(
+        Dialog.id, Dialog.chat_id, Dialog.current_state, Dialog.deal_id, Dialog.manager_id, Dialog.claim_attempts,
+        Dialog.summary, Dialog.summary_message_id,
+    ).cte("claimed")
+
+    rows = (await db.execute(
+        select(claimed, PendingMessage.id.label("message_id"), PendingMessage.content, PendingMessage.file_url,
+               PendingMessage.file_name, PendingMessage.created_at)
+        .outerjoin(PendingMessage, PendingMessage.dialog_id == claimed.c.id)
+        .order_by(claimed.c.id, PendingMessage.id)
+    )).all()
+    await db.commit()
+
+    results = {}
+    for row in rows:
+        batch = results.get(row.id)
+        if batch is None:
+            batch = results[row.id] = {
+                'dialog_id': row.id,
+                'chat_id': row.chat_id,
+                'current_state': row.current_state,
+                'deal_id': row.deal_id,
+                'manager_id': row.manager_id,
+                # Краткое содержание истории — чтобы ход не перечитывал диалог
+                'summary': row.summary,
+                'summary_message_id': row.summary_message_id,
+                'attempts': row.claim_attempts,
+                'last_message_id': None,
+                'pending': [],
+            }
+        if row.message_id is None:
+            continue
+        message = {"role": "user", "content": row.content, "created_at": row.created_at}
+        if row.file_url:
+            message["file_url"] = row.file_url
+        if row.file_name:
+            message["file_name"] = row.file_name
+        batch['pending'].append(message)
+        batch['last_message_id'] = row.message_id
+    return list(results.values())
+
+
+async def ack_dialog_claim(db: AsyncSession, dialog_id: int, last_message_id: int | None, commit: bool = True) -> float | None:
+    """
+    Завершает аренду: удаляет обработанные сообщения (ID <= last_message_id) и снимает сроки ожидания,
+    только если за время обработки не пришло новых сообщений. Если такие сообщения есть,
+    возвращает, через сколько секунд диалог созреет снова, иначе None.
+    Если диалог передан менеджеру, очередь очищается целиком.
+    Диспетчер вызывает его с `commit=False` в транзакции хода (update_dialog + outbox), чтобы ход
+    и удаление его сообщений из очереди фиксировались вместе: иначе сбой между ними повторил бы ход.
+    """
+    # Блокируем строку диалога: параллельная постановка сообщения дождется нас (или мы — ее),
+    # поэтому проверка "остались ли сообщения" ниже видит все закоммиченные вставки
+    state = (await db.execute(select(Dialog.current_state).where(Dialog.id == dialog_id).with_for_update())).scalar()
+    if state == ESCALATED_STATE:
+        await db.execute(delete(PendingMessage).where(PendingMessage.dialog_id == dialog_id))
+    elif last_message_id is not None:
+        await db.execute(delete(PendingMessage).where(
+            PendingMessage.dialog_id == dialog_id, PendingMessage.id <= last_message_id
+        ))
+    has_more = select(PendingMessage.id).where(PendingMessage.dialog_id == dialog_id).exists()
+    due_in = (await db.execute(update(Dialog).where(Dialog.id == dialog_id).values(
+        claimed_until=None,
+        claimed_by=None,
+        claim_attempts=0,
+        pending_started_at=case((has_more, Dialog.pending_started_at), else_=None),
+        due_at=case((has_more, Dialog.due_at), else_=None),
+    ).returning(func.extract("epoch", Dialog.due_at - func.now())))).scalar()
+    if commit:
+        await db.commit()
+    return max(0.0, float(due_in)) if due_in is not None else None
+
+
+async def release_dialog_claim(db: AsyncSession, dialog_id: int, retry_delay_seconds: int = 0):
+    """Возвращает диалог в очередь (после ошибки): сообщения остаются, повтор не раньше чем через паузу."""
+    await db.execute(update(Dialog).where(Dialog.id == dialog_id).values(
+        claimed_until=func.now() + timedelta(seconds=retry_delay_seconds), claimed_by=None
+    ))
+    await db.commit()
+
+
+# --- ФОНОВЫЕ ЗАДАЧИ (очередь jobs) ---
+async def enqueue_job(db: AsyncSession, queue: str, payload: dict, delay_seconds: int = 0, max_attempts: int = 5,
+                dedup_key: str = None, replace_pending: bool = False, commit: bool = True,
+                ordering_key: str = None) -> int | None:
+    """
+    Ставит задачу в очередь. Запись в БД делает задачу "долговечной":
+    она будет выполнена даже после перезапуска приложения.
+    В payload сервер БД добавляет 'enqueued_at' — момент постановки в очередь.
+    Если передан `dedup_key` и в очереди уже ждет задача с таким ключом, новая не создается;
+    при `replace_pending=True` ожидающая задача получает новый payload и новый срок запуска.
+    При `commit=False` задача коммитится вместе с остальными изменениями вызывающего (outbox).
+    Задачи с одним `ordering_key` выполняются по одной в порядке постановки (см. claim_jobs).
+    Возвращает ID созданной задачи или None, если задача была склеена с существующей.
+    """
+    stamped_payload = cast(payload, JSONB).op("||")(
+        func.jsonb_build_object(literal_column("'enqueued_at'"), func.now())
+    )
+    stmt = pg_insert(Job).values(
+        queue=queue,
+        payload=stamped_payload,
+        max_attempts=max_attempts,
+        dedup_key=dedup_key,
+        ordering_key=ordering_key,
+        run_after=func.now() + timedelta(seconds=delay_seconds),
+    )
+    if dedup_key:
+        # Литерал, а не параметр: иначе Postgres не сопоставит условие с частичным индексом
+        pending_only = text("status = 'pending'")
+        if replace_pending:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Job.dedup_key],
+                index_where=pending_only,
+                set_={"payload": stmt.excluded.payload, "run_after": stmt.excluded.run_after},
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=[Job.dedup_key], index_where=pending_only)
+    # xmax = 0 только у только что вставленной строки, у обновленной при конфликте — нет
+    row = (await db.execute(stmt.returning(Job.id, literal_column("xmax = 0").label("inserted")))).first()
+    if commit:
+        await db.commit()
+    if row is None or not row.inserted:
+        return None
+    return row.id
+
+
+async def claim_jobs(db: AsyncSession, queue: str, limit: int, lease_seconds: int = 300) -> list[dict]:
+    """
+    Забирает до `limit` готовых задач очереди и закрепляет их за текущим воркером на `lease_seconds`.
+    FOR UPDATE SKIP LOCKED позволяет нескольким воркерам безопасно делить очередь,
+    а задачи упавшего воркера снова становятся доступны после истечения аренды.
+    Задача с ключом порядка не выдается, пока более ранняя задача с тем же ключом ждет
+    (в том числе паузы перед повтором) или выполняется: ответы одного чата уходят строго по порядку.
+    """
+    if limit <= 0:
+        return []
+
+    earlier = aliased(Job)
+    earlier_active = select(earlier.id).where(
+        earlier.queue == Job.queue,
+        earlier.ordering_key == Job.ordering_key,
+        earlier.id < Job.id,
+        earlier.status.in_(('pending', 'running')),
+    ).exists()
+    jobs = (await db.execute(select(Job).where(
+        Job.queue == queue,
+        or_(
+            and_(Job.status == 'pending', Job.run_after <= func.now()),
+            and_(Job.status == 'running', Job.locked_until < func.now()),
+        ),
+        or_(Job.ordering_key.is_(None), ~earlier_active),
+    ).order_by(Job.run_after, Job.id).limit(limit).with_for_update(skip_locked=True))).scalars().all()
+
+    claimed = []
+    for job in jobs:
+        job.status = 'running'
+        job.attempts += 1
+        job.locked_until = func.now() + timedelta(seconds=lease_seconds)
+        claimed.append({'id': job.id, 'payload': dict(job.payload), 'attempts': job.attempts, 'max_attempts': job.max_attempts})
+    await db.commit()
+    return claimed
+
+
+async def complete_job(db: AsyncSession, job_id: int):
+    """Отмечает задачу выполненной."""
+    await db.execute(update(Job).where(Job.id == job_id).values(status='done', locked_until=None, last_error=None))
+    await db.commit()
+
+
+async def fail_job(db: AsyncSession, job_id: int, error: str, retry_delay_seconds: int = None):
+    """
+    Фиксирует ошибку задачи. Если задан `retry_delay_seconds`, задача вернется в очередь
+    после паузы, иначе будет помечена как окончательно проваленная.
+    """
+    values = {Job.locked_until: None, Job.last_error: error}
+    if retry_delay_seconds is not None:
+        values[Job.status] = 'pending'
+        values[Job.run_after] = func.now() + timedelta(seconds=retry_delay_seconds)
+        # Если за время выполнения пришло новое событие с тем же ключом, повтор не нужен —
+        # ожидающая задача и так обработает актуальное состояние
+        job = await db.get(Job, job_id)
+        if job and job.dedup_key and (await db.execute(select(Job.id).where(
+            Job.dedup_key == job.dedup_key, Job.status == 'pending', Job.id != job_id
+        ).limit(1))).first():
+            values[Job.status] = 'superseded'
+    else:
+        values[Job.status] = 'failed'
+    await db.execute(update(Job).where(Job.id == job_id).values(values))
+    await db.commit()
+
+
+async def get_job_counts(db: AsyncSession) -> dict:
+    """Количество задач по очередям и статусам: {'bitrix_webhook': {'pending': 3, ...}}."""
+    rows = (await db.execute(select(Job.queue, Job.status, func.count(Job.id)).group_by(Job.queue, Job.status))).all()
+    counts = {}
+    for queue, status, count in rows:
+        counts.setdefault(queue, {})[status] = count
+    return counts
+
+
+async def purge_finished_jobs(db: AsyncSession, older_than_hours: int = 72, failed_older_than_hours: int = 720) -> int:
+    """
+    Удаляет завершенные задачи старше указанного срока, чтобы таблица не росла бесконечно:
+    выполненные и замененные более новой задачей ('done', 'superseded') — через `older_than_hours`,
+    окончательно проваленные ('failed') хранятся дольше, `failed_older_than_hours`, для разбора ошибок.
+    """
+    result = await db.execute(delete(Job).where(or_(
+        and_(Job.status.in_(('done', 'superseded')),
+             Job.updated_at < func.now() - timedelta(hours=older_than_hours)),
+        and_(Job.status == 'failed',
+             Job.updated_at < func.now() - timedelta(hours=failed_older_than_hours)),
+    )))
+    await db.commit()
+    return result.rowcount
+
+
+async def purge_inbound_messages(db: AsyncSession, older_than_hours: int = 72) -> int:
+    """Удаляет старые отметки о принятых сообщениях: Wazzup повторяет доставку лишь в течение короткого времени."""
+    result = await db.execute(delete(InboundMessage).where(
+        InboundMessage.received_at < func.now() - timedelta(hours=older_than_hours)
+    ))
+    await db.commit()
+    return result.rowcount
+
+
+# --- ЗАЩИТА ОТ ПОВТОРНЫХ СОБЫТИЙ ПО СДЕЛКАМ ---
+async def claim_deal_stage_trigger(db: AsyncSession, deal_id: int, stage_id: str, window_seconds: int) -> bool:
+    """
+    Атомарно "занимает" запуск сценария для пары (сделка, стадия).
+    Возвращает True, если сценарий можно запускать, и False, если он уже запускался за последние `window_seconds`.
+    """
+    stmt = pg_insert(DealStageTrigger).values(deal_id=deal_id, stage_id=stage_id, triggered_at=func.now())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DealStageTrigger.deal_id, DealStageTrigger.stage_id],
+        set_={"triggered_at": func.now(), "campaign_claimed_until": None},
+        where=DealStageTrigger.triggered_at < func.now() - timedelta(seconds=window_seconds),
+    )
+    claimed = (await db.execute(stmt.returning(DealStageTrigger.deal_id))).first() is not None
+    await db.commit()
+    return claimed
+
+
+async def release_deal_stage_trigger(db: AsyncSession, deal_id: int, stage_id: str):
+    """Снимает отметку о запуске (например, если сценарий упал и будет повторен)."""
+    await db.execute(delete(DealStageTrigger).where(
+        DealStageTrigger.deal_id == deal_id,
+        DealStageTrigger.stage_id == stage_id
+    ))
+    await db.commit()
+
+
+# --- ЛОКАЛЬНОЕ ЗЕРКАЛО СДЕЛОК ---
+async def upsert_deal_snapshots(db: AsyncSession, snapshots: list[dict], mark_handled: bool = False):
+    """
+    Сохраняет снимки сделок (ключи как у модели DealSnapshot).
+    При `mark_handled=True` новые сделки считаются уже обработанными на текущей стадии —
+    так первичное наполнение не запускает сценарии по сделкам, которые давно стоят на стадиях-триггерах.
+    """
+    if not snapshots:
+        return
+    rows = [dict(item, handled_stage_id=item['stage_id'] if mark_handled else None) for item in snapshots]
+    stmt = pg_insert(DealSnapshot).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DealSnapshot.id],
+        set_={
+            "category_id": stmt.excluded.category_id,
+            "stage_id": stmt.excluded.stage_id,
+            "contact_id": stmt.excluded.contact_id,
+            "assigned_by_id": stmt.excluded.assigned_by_id,
+            "date_modify": stmt.excluded.date_modify,
+            "synced_at": func.now(),
+        },
+    )
+    await db.execute(stmt)
+    await db.commit()
+
+
+async def get_deal_snapshot(db: AsyncSession, deal_id: int, fresh_since: str = None) -> tuple[DealSnapshot | None, bool]:
+    """
+    Возвращает (снимок сделки, свежий_ли_он). Снимок свежий, если синхронизирован
+    не раньше момента `fresh_since` (например, времени получения события).
+    """
+    if fresh_since:
+        # asyncpg не приводит строки к timestamptz сам — передаем готовое значение
+        is_fresh = DealSnapshot.synced_at >= literal(datetime.fromisoformat(fresh_since), DateTime(timezone=True))
+    else:
+        is_fresh = literal_column("false")
+    row = (await db.execute(select(DealSnapshot, is_fresh.label("fresh")).where(DealSnapshot.id == deal_id))).first()
+    if row is None:
+        return None, False
+    return row[0], bool(row[1])
+
+
+async def mark_deal_stage_handled(db: AsyncSession, deal_id: int, stage_id: str, commit: bool = True):
+    """Запоминает, что решение по сделке на этой стадии уже принято."""
+    await db.execute(update(DealSnapshot).where(DealSnapshot.id == deal_id).values(handled_stage_id=stage_id))
+    if commit:
+        await db.commit()
+
+
+def _campaign_pending(stage_id: str):
+    """Условие "сделка ждет кампании": запуск занят (без срока давности), сделка на стадии, решение не принято."""
+    return and_(
+        DealStageTrigger.stage_id == stage_id,
+        DealSnapshot.stage_id == stage_id,
+        DealSnapshot.handled_stage_id.is_distinct_from(stage_id),
+    )
+
+
+async def claim_campaign_deals(db: AsyncSession, stage_id: str, limit: int, lease_seconds: int) -> list[DealSnapshot]:
+    """
+    Забирает до `limit` сделок, ожидающих кампании на стадии `stage_id`, и закрепляет их за текущим
+    запуском на `lease_seconds` (deal_stage_triggers.campaign_claimed_until) — одной командой UPDATE ... RETURNING
+    с SKIP LOCKED. Другой запуск кампании (в том числе повтор задачи, чья аренда истекла) эти сделки не возьмет.
+    Ожидание определяется занятым запуском, а не окном защиты от повторов: сделка, которую кампания
+    не успела взять за DEAL_STAGE_DEDUP_WINDOW_SECONDS, все равно будет обработана.
+    Обработанные сделки помечаются handled_stage_id, поэтому повтор упавшей кампании берет только оставшиеся.
+    """
+    pending = (
+        select(DealStageTrigger.deal_id)
+        .join(DealSnapshot, DealSnapshot.id == DealStageTrigger.deal_id)
+        .where(
+            _campaign_pending(stage_id),
+            or_(DealStageTrigger.campaign_claimed_until.is_(None), DealStageTrigger.campaign_claimed_until < func.now()),
+        )
+        .order_by(DealStageTrigger.triggered_at, DealStageTrigger.deal_id)
+        .limit(limit)
+        .with_for_update(of=DealStageTrigger, skip_locked=True)
+    )
+    claimed_ids = (await db.execute(
+        update(DealStageTrigger)
+        .where(DealStageTrigger.stage_id == stage_id, DealStageTrigger.deal_id.in_(pending.scalar_subquery()))
+        .values(campaign_claimed_until=func.now() + timedelta(seconds=lease_seconds))
+        .returning(DealStageTrigger.deal_id)
+    )).scalars().all()
+    snapshots = []
+    if claimed_ids:
+        snapshots = (await db.execute(
+            select(DealSnapshot).where(DealSnapshot.id.in_(claimed_ids)).order_by(DealSnapshot.id)
+        )).scalars().all()
+    await db.commit()
+    return snapshots
+
+
+async def release_campaign_deals(db: AsyncSession, stage_id: str, deal_ids: list[int]):
+    """Снимает закрепление сделок за кампанией: их заберет следующий запуск (повтор или продолжение)."""
+    if not deal_ids:
+        return
+    await db.execute(update(DealStageTrigger).where(
+        DealStageTrigger.stage_id == stage_id,
+        DealStageTrigger.deal_id.in_(deal_ids),
+    ).values(campaign_claimed_until=None))
+    await db.commit()
+
+
+async def campaign_claims_expire_in(db: AsyncSession, stage_id: str) -> float | None:
+    """
+    Через сколько секунд истечет ближайшее закрепление еще не обработанной сделки стадии
+    (ее обрабатывает другой запуск кампании или он упал). None — таких сделок нет.
+    """
+    seconds = (await db.execute(
+        select(func.extract("epoch", func.min(DealStageTrigger.campaign_claimed_until) - func.now()))
+        .select_from(DealStageTrigger)
+        .join(DealSnapshot, DealSnapshot.id == DealStageTrigger.deal_id)
+        .where(_campaign_pending(stage_id), DealStageTrigger.campaign_claimed_until >= func.now())
+    )).scalar()
+    return max(0.0, float(seconds)) if seconds is not None else None
+
+
+# --- ОБЩИЕ ЛИМИТЫ ЗАПРОСОВ К ВНЕШНИМ API ---
+def _refilled_tokens():
+    """Токены ведра на текущий момент: пополнение с updated_at со скоростью rate * rate_factor, не выше capacity."""
+    elapsed = func.extract("epoch", func.now() - RateLimitBucket.updated_at)
+    return func.least(
+        RateLimitBucket.capacity,
+        RateLimitBucket.tokens + elapsed * RateLimitBucket.rate * RateLimitBucket.rate_factor,
+    )
+
+
+async def take_rate_limit_tokens(db: AsyncSession, name: str, rate: float, capacity: float, count: int = 1) -> list[float]:
+    """
+    Берет `count` токенов из ведра `name` (создает его при первом обращении) одной командой и возвращает
+    для каждого, через сколько секунд по нему можно делать запрос. Токены берутся всегда: ведро уходит
+    в минус, и следующие вызовы встают в очередь за предыдущими (ожидание = долг / скорость).
+    Блок токенов за один запрос к БД процесс раздает своим вызовам сам (rate_limiter.reserve).
+    Скорость и емкость берутся из настроек вызывающего, множитель rate_factor — общий из БД.
+    """
+    stmt = pg_insert(RateLimitBucket).values(name=name, tokens=capacity - count, rate=rate, capacity=capacity, updated_at=func.now())
+    stmt = stmt.on_conflict_do_update(index_elements=[RateLimitBucket.name], set_={
+        "tokens": _refilled_tokens() - count,
+        "updated_at": func.now(),
+        "rate": stmt.excluded.rate,
+        "capacity": stmt.excluded.capacity,
+    }).returning(RateLimitBucket.tokens, RateLimitBucket.rate * RateLimitBucket.rate_factor)
+    tokens, effective_rate = (await db.execute(stmt)).one()
+    await db.commit()
+    if effective_rate <= 0:
+        return [0.0] * count
+    # Остаток в ведре после k-го токена блока: tokens + count - k
+    return [max(0.0, -(tokens + count - k)) / effective_rate for k in range(1, count + 1)]
+
+
+async def delay_rate_limit_bucket(db: AsyncSession, name: str, seconds: float):
+    """Сервис ответил "слишком много запросов": следующий вызов из любого процесса пойдет не раньше чем через `seconds`."""
+    await db.execute(update(RateLimitBucket).where(RateLimitBucket.name == name).values(
+        tokens=func.least(_refilled_tokens(), -seconds * RateLimitBucket.rate * RateLimitBucket.rate_factor),
+        updated_at=func.now(),
+    ))
+    await db.commit()
+
+
+async def set_rate_limit_factor(db: AsyncSession, name: str, rate_factor: float):
+    """Меняет множитель скорости ведра (накопленные токены пересчитываются по прежней скорости)."""
+    await db.execute(update(RateLimitBucket).where(RateLimitBucket.name == name).values(
+        tokens=_refilled_tokens(), updated_at=func.now(), rate_factor=rate_factor,
+    ))
+    await db.commit()
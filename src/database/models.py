@@ -1,5 +1,5 @@
 # src/database/models.py
-from sqlalchemy import Column, Integer, String, DateTime, func
+from sqlalchemy import Column, Integer, BigInteger, Float, String, DateTime, Text, Index, ForeignKey, func, text
 from sqlalchemy.dialects.postgresql import JSONB
 from .db import Base
 
@@ -16,10 +16,172 @@ class Dialog(Base):
     # ------------------------------------
 
     current_state = Column(String, default='idle', nullable=False)
-    history = Column(JSONB, nullable=False, server_default='[]')
+    # Сама переписка хранится в dialog_messages; здесь — сжатое содержание ее старой части
+    # и ID последнего сообщения, которое в него вошло
+    summary = Column(Text, nullable=True)
+    summary_message_id = Column(BigInteger, nullable=True)
     
-    pending_messages = Column(JSONB, nullable=False, server_default='[]')
+    # Момент последнего входящего сообщения (после обработки не сбрасывается: по нему учатся паузы клиента;
+    # сами ожидающие сообщения — в pending_messages)
     pending_since = Column(DateTime, nullable=True)
+    # Начало текущей серии сообщений и момент, когда диалог созреет для обработки (считает политика ожидания)
+    pending_started_at = Column(DateTime, nullable=True)
+    due_at = Column(DateTime, nullable=True)
+    # Выученная типичная пауза клиента между сообщениями одной серии, в секундах
+    typing_gap_seconds = Column(Float, nullable=True)
+    # Аренда диалога воркером-диспетчером: пока она не истекла, другие процессы диалог не берут
+    claimed_until = Column(DateTime, nullable=True)
+    claimed_by = Column(String, nullable=True)
+    claim_attempts = Column(Integer, nullable=False, server_default='0')
     
     created_at = Column(DateTime, server_default=func.now())
-    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
\ No newline at end of file
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        # Очередь диспетчера: в индексе только ожидающие диалоги, которые бот еще ведет,
+        # поэтому выборка созревших не зависит от общего числа диалогов
+        Index('ix_dialogs_due_at', 'due_at',
+              postgresql_where=text("due_at IS NOT NULL AND current_state <> 'escalated'")),
+    )
+
+
+class DialogMessage(Base):
+    """
+    Одно сообщение переписки. Новые ходы только дописываются (INSERT),
+    а для LLM читается лишь последнее окно по индексу (dialog_id, id).
+    """
+    __tablename__ = 'dialog_messages'
+
+    id = Column(BigInteger, primary_key=True)
+    dialog_id = Column(Integer, ForeignKey('dialogs.id', ondelete='CASCADE'), nullable=False)
+    role = Column(String, nullable=False)
+    content = Column(Text, nullable=False, server_default='')
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index('ix_dialog_messages_dialog_id_id', 'dialog_id', 'id'),
+    )
+
+
+class PendingMessage(Base):
+    """
+    Входящее сообщение клиента, ожидающее обработки диспетчером.
+    Каждое сообщение — отдельная строка: параллельные вебхуки одного чата не перезаписывают друг друга.
+    """
+    __tablename__ = 'pending_messages'
+
+    id = Column(BigInteger, primary_key=True)
+    dialog_id = Column(Integer, ForeignKey('dialogs.id', ondelete='CASCADE'), nullable=False)
+    content = Column(Text, nullable=False, server_default='')
+    file_url = Column(String, nullable=True)
+    file_name = Column(String, nullable=True)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index('ix_pending_messages_dialog_id_id', 'dialog_id', 'id'),
+    )
+
+
+class InboundMessage(Base):
+    """
+    Отметка о принятом входящем сообщении Wazzup (по его messageId).
+    Wazzup повторяет вебхук, если мы ответили медленно; повтор с тем же ID в очередь не ставится.
+    """
+    __tablename__ = 'inbound_messages'
+
+    message_id = Column(String, primary_key=True)
+    chat_id = Column(String, nullable=False)
+    received_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        # Для удаления старых отметок
+        Index('ix_inbound_messages_received_at', 'received_at'),
+    )
+
+
+class Job(Base):
+    """
+    Фоновая задача в очереди на базе Postgres (например, обработка вебхука Битрикс24).
+    Задачи забираются воркерами через SELECT ... FOR UPDATE SKIP LOCKED и переживают перезапуск.
+    """
+    __tablename__ = 'jobs'
+
+    id = Column(Integer, primary_key=True)
+    queue = Column(String, nullable=False)
+    payload = Column(JSONB, nullable=False, server_default='{}')
+
+    # pending -> running -> done / failed (superseded — повтор не нужен, ждет более новая задача с тем же ключом)
+    status = Column(String, nullable=False, server_default='pending')
+    attempts = Column(Integer, nullable=False, server_default='0')
+    max_attempts = Column(Integer, nullable=False, server_default='5')
+    run_after = Column(DateTime, nullable=False, server_default=func.now())
+    # Пока задача "running", она закреплена за воркером до этого момента
+    locked_until = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    # Ключ склейки: пока есть ожидающая задача с таким ключом, новая не создается
+    dedup_key = Column(String, nullable=True)
+    # Ключ порядка: задачи с одним ключом выполняются строго по очереди создания (сообщения одного чата)
+    ordering_key = Column(String, nullable=True)
+
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        # Быстрый выбор готовых к запуску задач конкретной очереди
+        Index('ix_jobs_queue_status_run_after', 'queue', 'status', 'run_after'),
+        Index('uq_jobs_pending_dedup_key', 'dedup_key', unique=True,
+              postgresql_where=text("status = 'pending'")),
+        # Поиск более ранней незавершенной задачи с тем же ключом порядка
+        Index('ix_jobs_ordering_key_active', 'queue', 'ordering_key', 'id',
+              postgresql_where=text("ordering_key IS NOT NULL AND status IN ('pending', 'running')")),
+    )
+
+
+class DealStageTrigger(Base):
+    """
+    Отметка о запуске сценария для пары (сделка, стадия).
+    Хранится в БД, чтобы защита от повторов работала во всех процессах uvicorn.
+    """
+    __tablename__ = 'deal_stage_triggers'
+
+    deal_id = Column(Integer, primary_key=True)
+    stage_id = Column(String, primary_key=True)
+    triggered_at = Column(DateTime, nullable=False, server_default=func.now())
+    # Сделку обрабатывает кампания (campaigns.py) до этого момента; другие запуски кампании ее не берут
+    campaign_claimed_until = Column(DateTime, nullable=True)
+
+
+class DealSnapshot(Base):
+    """
+    Локальное зеркало сделок целевой воронки (id совпадает с ID сделки в Битрикс24).
+    Наполняется постраничным crm.deal.list и поддерживается инкрементальной синхронизацией по DATE_MODIFY.
+    """
+    __tablename__ = 'deals'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    category_id = Column(String, nullable=True)
+    stage_id = Column(String, nullable=True)
+    contact_id = Column(Integer, nullable=True)
+    assigned_by_id = Column(Integer, nullable=True)
+    date_modify = Column(DateTime(timezone=True), nullable=True)
+
+    # Стадия, для которой бот уже принял решение (запустил сценарий или решил, что он не нужен).
+    # Реальный переход = текущая стадия отличается от обработанной.
+    handled_stage_id = Column(String, nullable=True)
+    synced_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
+class RateLimitBucket(Base):
+    """
+    Ведро токенов для запросов к внешнему API (Битрикс24, Wazzup), общее для всех процессов.
+    tokens может уходить в минус: это очередь вызовов, ожидающих своей доли скорости.
+    """
+    __tablename__ = 'rate_limit_buckets'
+
+    name = Column(String, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    rate = Column(Float, nullable=False)           # токенов в секунду (из настроек)
+    capacity = Column(Float, nullable=False)       # сколько вызовов можно сделать подряд без пауз
+    # Множитель скорости, который подстраивается по ответам сервиса (нагрузка на Битрикс24)
+    rate_factor = Column(Float, nullable=False, server_default='1')
+    updated_at = Column(DateTime, nullable=False, server_default=func.now())
@@ -0,0 +1,99 @@
+# src/deal_sync.py
+import os
+from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import db_service
+from services import bitrix_service
+from utils import parse_bitrix_id
+
+# --- НАСТРОЙКИ СИНХРОНИЗАЦИИ ЗЕРКАЛА СДЕЛОК ---
+TARGET_FUNNEL_ID = os.getenv("TARGET_FUNNEL_ID")
+DEAL_SYNC_QUEUE = "deal_sync"
+DEAL_SYNC_INTERVAL_SECONDS = int(os.getenv("DEAL_SYNC_INTERVAL_SECONDS", "60"))
+# Запас по времени при инкрементальной выборке: правки в ту же секунду не теряются
+DEAL_SYNC_OVERLAP_SECONDS = 60
+
+DEAL_SELECT_FIELDS = ["ID", "CATEGORY_ID", "STAGE_ID", "CONTACT_ID", "ASSIGNED_BY_ID", "DATE_MODIFY"]
+
+
+def snapshot_values(deal: dict) -> dict:
+    """Преобразует сделку из ответа Битрикс24 в значения для таблицы deals."""
+    date_modify = deal.get("DATE_MODIFY")
+    return {
+        "id": int(deal["ID"]),
+        "category_id": str(deal.get("CATEGORY_ID")),
+        "stage_id": deal.get("STAGE_ID"),
+        "contact_id": parse_bitrix_id(deal.get("CONTACT_ID")),
+        "assigned_by_id": parse_bitrix_id(deal.get("ASSIGNED_BY_ID")),
+        "date_modify": datetime.fromisoformat(date_modify) if date_modify else None,
+    }
+
+
+def snapshot_to_deal(snapshot) -> dict:
+    """Обратное преобразование: снимок из БД в словарь с полями как у crm.deal.get."""
+    return {
+        "ID": str(snapshot.id),
+        "CATEGORY_ID": snapshot.category_id,
+        "STAGE_ID": snapshot.stage_id,
+        "CONTACT_ID": str(snapshot.contact_id) if snapshot.contact_id else None,
+        "ASSIGNED_BY_ID": str(snapshot.assigned_by_id) if snapshot.assigned_by_id else None,
+    }
+
+
+async def _sync_pages(db: AsyncSession, filter: dict, mark_handled: bool) -> tuple[int, datetime | None]:
+    """Постранично выгружает сделки по фильтру и сохраняет их в зеркало. Возвращает (кол-во, max DATE_MODIFY)."""
+    total, latest, start = 0, None, 0
+    while start is not None:
+        page = await bitrix_service.list_deals(filter, DEAL_SELECT_FIELDS, start=start)
+        if page is None:
+            raise RuntimeError("Не удалось получить страницу сделок из Битрикс24")
+        deals, start = page
+        snapshots = [snapshot_values(deal) for deal in deals]
+        await db_service.upsert_deal_snapshots(db, snapshots, mark_handled=mark_handled)
+        total += len(snapshots)
+        for item in snapshots:
+            if item["date_modify"] and (latest is None or item["date_modify"] > latest):
+                latest = item["date_modify"]
+    return total, latest
+
+
+async def handle_deal_sync(db: AsyncSession, payload: dict) -> dict:
+    """
+    Задача синхронизации зеркала сделок целевой воронки.
+    Первый запуск выгружает всю воронку, последующие — только сделки с DATE_MODIFY позже курсора.
+    В конце ставит в очередь следующий запуск с курсором в payload. Ожидающая задача хранится в БД,
+    поэтому цепочка переживает перезапуски, а при старте новая задача не создается.
+    """
+    if not TARGET_FUNNEL_ID:
+        return {"status": "ok", "message": "TARGET_FUNNEL_ID is not set"}
+
+    base_filter = {"CATEGORY_ID": TARGET_FUNNEL_ID}
+    cursor = payload.get("cursor")
+
+    if not cursor:
+        # Курсора нет только у самой первой задачи в цепочке (или если цепочка прервалась)
+        print(f"🔄 Первичное наполнение зеркала сделок воронки {TARGET_FUNNEL_ID}...")
+        # Сделки, которые уже стоят на стадиях-триггерах, не должны запускать сценарии при наполнении
+        total, latest = await _sync_pages(db, base_filter, mark_handled=True)
+        mode = "seed"
+    else:
+        previous = datetime.fromisoformat(cursor)
+        since = previous - timedelta(seconds=DEAL_SYNC_OVERLAP_SECONDS)
+        total, latest = await _sync_pages(db, {**base_filter, ">DATE_MODIFY": since.isoformat()}, mark_handled=False)
+        # Курсор никогда не откатывается назад
+        latest = max(latest, previous) if latest else previous
+        mode = "incremental"
+
+    if total:
+        print(f"🔄 Зеркало сделок обновлено ({mode}): {total} сделок.")
+
+    next_cursor = latest.isoformat() if latest else cursor
+    await schedule_deal_sync(db, cursor=next_cursor, delay_seconds=DEAL_SYNC_INTERVAL_SECONDS)
+    return {"status": "ok", "mode": mode, "synced": total}
+
+
+async def schedule_deal_sync(db: AsyncSession, cursor: str = None, delay_seconds: int = 0):
+    """Ставит синхронизацию в очередь (не более одной ожидающей задачи)."""
+    payload = {"cursor": cursor} if cursor else {}
+    await db_service.enqueue_job(db, DEAL_SYNC_QUEUE, payload, delay_seconds=delay_seconds, dedup_key=DEAL_SYNC_QUEUE)
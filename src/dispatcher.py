@@ -0,0 +1,395 @@
+# src/dispatcher.py
+import os
+import json
+import time
+import heapq
+import socket
+import asyncio
+import traceback
+
+from database import db_service
+from database.db import AsyncSessionLocal, async_engine
+from services import llm_service
+import history
+import outbox
+
+# --- НАСТРОЙКИ ДИСПЕТЧЕРА ---
+# Сколько диалогов может обрабатываться одновременно (1 = старый последовательный режим)
+DISPATCHER_CONCURRENCY = int(os.getenv("DISPATCHER_CONCURRENCY", "10"))
+# Опрос БД, пока нет соединения LISTEN (в нормальном режиме воркер просыпается по NOTIFY)
+POLL_INTERVAL_SECONDS = int(os.getenv("DISPATCHER_POLL_INTERVAL_SECONDS", "5"))
+# Страховочная проверка очереди при работающем LISTEN: пропущенные уведомления, истекшие аренды
+SWEEP_INTERVAL_SECONDS = int(os.getenv("DISPATCHER_SWEEP_INTERVAL_SECONDS", "60"))
+# Аренда диалога: если процесс упадет, диалог вернется в очередь по ее истечении
+DISPATCHER_LEASE_SECONDS = int(os.getenv("DISPATCHER_LEASE_SECONDS", "300"))
+# Сколько раз пробуем обработать пачку, прежде чем отбросить ее, и пауза между попытками
+DISPATCHER_MAX_ATTEMPTS = int(os.getenv("DISPATCHER_MAX_ATTEMPTS", "3"))
+DISPATCHER_RETRY_SECONDS = int(os.getenv("DISPATCHER_RETRY_SECONDS", "30"))
+# Сколько при остановке ждем завершения уже взятых диалогов
+DISPATCHER_DRAIN_TIMEOUT_SECONDS = int(os.getenv("DISPATCHER_DRAIN_TIMEOUT_SECONDS", "60"))
+# Имя процесса в claimed_by — видно, какой воркер держит диалог
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# --- СОСТОЯНИЕ ИСПОЛНИТЕЛЯ ---
+# Семафор ограничивает общее число параллельных диалогов,
+# а замок на каждый chat_id гарантирует строгий порядок ходов внутри одного чата.
+_semaphore = None
+_chat_locks: dict[str, asyncio.Lock] = {}
+_chat_waiters: dict[str, int] = {}
+_tasks: set[asyncio.Task] = set()
+
+# --- ТАЙМЕРЫ ДИАЛОГОВ ---
+# Минимальная куча (срок, chat_id): воркер спит ровно до ближайшего срока.
+# В _due_at — актуальный срок чата; устаревшие записи кучи просто пропускаются.
+_due_heap: list[tuple[float, str]] = []
+_due_at: dict[str, float] = {}
+_wakeup = None
+
+stats = {
+    "in_flight": 0,   # диалоги, которые прямо сейчас обрабатываются
+    "queued": 0,      # диалоги, ожидающие свободного слота или своей очереди в чате
+    "processed": 0,
+    "failed": 0,
+    "retried": 0,     # пачки, возвращенные в очередь после ошибки
+    "dropped": 0,     # пачки, отброшенные после DISPATCHER_MAX_ATTEMPTS попыток
+    "notifications": 0,
+    "claim_queries": 0,
+    "listening": False,
+}
+
+
+def get_stats() -> dict:
+    """Возвращает счетчики диспетчера для мониторинга."""
+    return {**stats, "concurrency": DISPATCHER_CONCURRENCY, "worker_id": WORKER_ID, "timers": len(_due_at)}
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    # Семафор создается лениво, чтобы он был привязан к работающему event loop
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(max(1, DISPATCHER_CONCURRENCY))
+    return _semaphore
+
+
+def _get_wakeup() -> asyncio.Event:
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    return _wakeup
+
+
+def schedule_dialog(chat_id: str, delay_seconds: float):
+    """Будит воркер через `delay_seconds`, чтобы забрать диалог, когда истечет его задержка."""
+    due = time.monotonic() + delay_seconds
+    _due_at[chat_id] = due
+    heapq.heappush(_due_heap, (due, chat_id))
+    _get_wakeup().set()
+
+
+async def process_dialog_batch(batch: dict) -> bool:
+    """
+    Обрабатывает одну пачку сообщений одного диалога: LLM -> БД (новое состояние + outbox).
+    Ответ клиенту и действия в CRM отправляют воркеры outbox, а не сам диспетчер.
+    Работает в собственной сессии БД, поэтому может выполняться параллельно с другими диалогами.
+    Возвращает True, если ход сохранен и аренда закрыта в той же транзакции; False — ход ничего
+    не сохранил, и аренду закрывает _finish_claim.
+    """
+    chat_id = batch['chat_id']
+    current_state = batch['current_state']
+    pending_messages = batch['pending']
+
+    db = AsyncSessionLocal()
+    try:
+        print(f"Обработка {len(pending_messages)} сообщений для chat_id: {chat_id} в состоянии '{current_state}'")
+
+        # --- 1. ПОДГОТОВКА КОНТЕКСТА ---
+        # Получаем текущую историю и добавляем к ней новые сообщения от клиента
+        # Новые сообщения клиента сохраняются вместе с ответом бота в конце хода
+        # Время прихода сохраняется в историю — по нему оцениваются политики ожидания (evaluate_debounce.py)
+        new_messages = [
+            {"role": "user", "content": msg['content'], "created_at": msg.get('created_at')} for msg in pending_messages
+        ]
+
+        # В LLM уходит не вся история, а краткое содержание + последние сообщения в пределах бюджета токенов
+        llm_history = await history.build_llm_history(db, batch, new_messages)
+        # Читающая транзакция закрывается: соединение возвращается в пул на время запроса к LLM
+        await db.commit()
+
+        # --- 2. ПОЛУЧЕНИЕ РЕШЕНИЯ ОТ LLM ---
+        # Промпт собирается под состояние диалога: общий префикс из кеша + релевантные блоки базы знаний
+        llm_decision = await llm_service.get_bot_decision(llm_history, state=current_state)
+
+        if not llm_decision:
+            print(f"❌ LLM не вернул решение для диалога {chat_id}. Пропускаем.")
+            return False
+
+        # --- 3. РАЗБОР И ИСПОЛНЕНИЕ КОМАНД ---
+        response_text = llm_decision.get("response_text")
+        action = llm_decision.get("action")
+        action_params = llm_decision.get("action_params", {})
+        new_state = llm_decision.get("new_state", current_state)
+
+        # Получаем ID сделки и менеджера, сохраненные в диалоге
+        deal_id = batch['deal_id']
+        manager_id = batch['manager_id']
+
+        if not deal_id or not manager_id:
+            print(f"КРИТИЧЕСКАЯ ОШИБКА: В диалоге {chat_id} отсутствуют deal_id или manager_id. Невозможно выполнить CRM-действие.")
+            return False
+
+        # --- ШАГ 3.1: ОТВЕТ КЛИЕНТУ (в outbox) ---
+        if response_text:
+            await outbox.enqueue_reply(db, chat_id, response_text)
+            # Ответ попадает в историю вместе с задачей на отправку — outbox доставит его с повторами
+            new_messages.append({"role": "assistant", "content": response_text})
+
+        # --- ШАГ 3.2: ДЕЙСТВИЕ В CRM (в outbox) ---
+        print(f"  - Действие для CRM: {action}")
+        await outbox.enqueue_crm_action(db, action, deal_id, manager_id, action_params)
+
+        # --- 4. ОБНОВЛЕНИЕ ДИАЛОГА В БД ---
+        # Новое состояние, сообщения хода, задачи outbox и удаление обработанных сообщений из очереди
+        # (закрытие аренды) коммитятся одной транзакцией: после сбоя ход либо сохранен целиком, либо повторится
+        await db_service.update_dialog(db, chat_id, new_state, new_messages, commit=False)
+        due_in = await db_service.ack_dialog_claim(db, batch['dialog_id'], batch['last_message_id'])
+        outbox.notify_senders()
+        print(f"  - Диалог {chat_id} переведен в состояние '{new_state}'.")
+        if due_in is not None:
+            # Пока диалог был в работе, клиент дописал еще — их таймер мог сработать впустую
+            schedule_dialog(chat_id, due_in)
+        return True
+    finally:
+        await db.close()
+
+
+async def _finish_claim(batch: dict, failed: bool = False):
+    """
+    Закрывает аренду диалога отдельной транзакцией: после хода без результата удаляет обработанные сообщения,
+    после ошибки возвращает их в очередь с паузой (или отбрасывает, если попытки исчерпаны).
+    Ход с результатом закрывает аренду сам (process_dialog_batch).
+    """
+    db = AsyncSessionLocal()
+    try:
+        if failed and batch['attempts'] < DISPATCHER_MAX_ATTEMPTS:
+            retry_delay = DISPATCHER_RETRY_SECONDS * batch['attempts']
+            await db_service.release_dialog_claim(db, batch['dialog_id'], retry_delay_seconds=retry_delay)
+            schedule_dialog(batch['chat_id'], retry_delay)
+            stats["retried"] += 1
+            return
+        if failed:
+            print(f"❌❌ Пачка диалога {batch['chat_id']} отброшена после {batch['attempts']} попыток.")
+            stats["dropped"] += 1
+        due_in = await db_service.ack_dialog_claim(db, batch['dialog_id'], batch['last_message_id'])
+        if due_in is not None:
+            # Пока диалог был в работе, клиент дописал еще — их таймер мог сработать впустую
+            schedule_dialog(batch['chat_id'], due_in)
+    except Exception as e:
+        # Аренда истечет сама, и диалог вернется в очередь
+        print(f"❌ Не удалось закрыть аренду диалога {batch['chat_id']}: {e}")
+    finally:
+        await db.close()
+
+
+async def _release_claim(batch: dict):
+    db = AsyncSessionLocal()
+    try:
+        await db_service.release_dialog_claim(db, batch['dialog_id'])
+    except Exception as e:
+        print(f"❌ Не удалось вернуть диалог {batch['chat_id']} в очередь: {e}")
+    finally:
+        await db.close()
+
+
+async def _run_serialized(batch: dict):
+    """
+    Выполняет пачку с учетом ограничений: не больше DISPATCHER_CONCURRENCY диалогов сразу
+    и строго по одному ходу за раз для каждого chat_id (в порядке поступления).
+    """
+    chat_id = batch['chat_id']
+    lock = _chat_locks.setdefault(chat_id, asyncio.Lock())
+    _chat_waiters[chat_id] = _chat_waiters.get(chat_id, 0) + 1
+    stats["queued"] += 1
+    queued = True
+    try:
+        async with lock:
+            async with _get_semaphore():
+                stats["queued"] -= 1
+                queued = False
+                stats["in_flight"] += 1
+                try:
+                    acked = await process_dialog_batch(batch)
+                    stats["processed"] += 1
+                    if not acked:
+                        await _finish_claim(batch)
+                except Exception as e:
+                    stats["failed"] += 1
+                    print(f"❌ Ошибка при обработке диалога {chat_id}: {e}")
+                    traceback.print_exc()
+                    await _finish_claim(batch, failed=True)
+                finally:
+                    stats["in_flight"] -= 1
+    except asyncio.CancelledError:
+        # Остановка процесса: сразу отдаем диалог другим воркерам, не дожидаясь истечения аренды
+        await _release_claim(batch)
+        raise
+    finally:
+        if queued:
+            stats["queued"] -= 1
+        # Освободился слот — воркер может взять следующий диалог
+        _get_wakeup().set()
+        # Убираем замок, когда для чата больше никто не ждет, чтобы словарь не рос бесконечно
+        _chat_waiters[chat_id] -= 1
+        if _chat_waiters[chat_id] == 0:
+            del _chat_waiters[chat_id]
+            _chat_locks.pop(chat_id, None)
+
+
+def submit(batch: dict) -> asyncio.Task:
+    """Ставит пачку сообщений диалога в исполнитель и сразу возвращает управление."""
+    task = asyncio.create_task(_run_serialized(batch))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def _claim_and_submit(limit: int) -> int:
+    """Берет в аренду до `limit` созревших диалогов и отправляет их в исполнитель. Возвращает число взятых."""
+    stats["claim_queries"] += 1
+    db = AsyncSessionLocal()
+    try:
+        dialog_batches = await db_service.claim_pending_dialogs(
+            db, WORKER_ID, limit=limit, lease_seconds=DISPATCHER_LEASE_SECONDS
+        )
+
+        for batch in dialog_batches:
+            _due_at.pop(batch['chat_id'], None)
+            # Диалоги, переданные менеджеру, отсеиваются еще в SQL; пустая пачка — сообщения уже забрал другой ход
+            if not batch['pending']:
+                await db_service.ack_dialog_claim(db, batch['dialog_id'], batch['last_message_id'])
+                continue
+
+            # В пачке только простые значения, т.к. задача работает уже в своей сессии БД
+            submit(batch)
+        return len(dialog_batches)
+    finally:
+        await db.close()
+
+
+async def _open_listen_connection(on_notify):
+    # Отдельное соединение вне пула: оно живет, пока работает воркер
+    raw = await async_engine.raw_connection()
+    raw.detach()
+    conn = raw.driver_connection  # asyncpg.Connection
+    await conn.add_listener(db_service.PENDING_MESSAGES_CHANNEL, on_notify)
+    return conn
+
+
+async def _listen_for_new_messages():
+    """
+    Держит LISTEN-соединение и на каждое уведомление о новом сообщении ставит таймер чата.
+    При обрыве переподключается; на это время воркер переходит на опрос БД.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        conn = None
+        try:
+            lost = loop.create_future()
+
+            def on_notify(connection, pid, channel, payload):
+                stats["notifications"] += 1
+                # Задержку выбрала политика ожидания при постановке сообщения
+                message = json.loads(payload)
+                schedule_dialog(message["chat_id"], message["delay"])
+
+            def on_terminated(connection):
+                if not lost.done():
+                    lost.set_exception(ConnectionError("соединение закрыто"))
+
+            conn = await _open_listen_connection(on_notify)
+            conn.add_termination_listener(on_terminated)
+            stats["listening"] = True
+            print(f"👂 Диспетчер слушает канал '{db_service.PENDING_MESSAGES_CHANNEL}'.")
+            # Пока соединения не было, уведомления могли потеряться — проверяем очередь сразу
+            _get_wakeup().set()
+            await lost
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Соединение LISTEN потеряно: {e}. Переподключение через {POLL_INTERVAL_SECONDS} с.")
+        finally:
+            stats["listening"] = False
+            if conn is not None and not conn.is_closed():
+                # terminate, а не close: не ждем сервер, в том числе при отмене задачи
+                conn.terminate()
+        await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+
+async def process_pending_messages_worker():
+    """
+    Главный цикл диспетчера. Не опрашивает БД впустую: спит до ближайшего таймера диалога,
+    уведомления о новом сообщении или освобождения слота. Раз в SWEEP_INTERVAL_SECONDS
+    (или каждые POLL_INTERVAL_SECONDS без LISTEN) все же проверяет очередь целиком.
+    """
+    print(f"🚀 Воркер-ДИСПЕТЧЕР {WORKER_ID} запущен! Параллельных диалогов: до {DISPATCHER_CONCURRENCY}")
+    wakeup = _get_wakeup()
+    listener_task = asyncio.create_task(_listen_for_new_messages())
+    claim_needed = True
+    next_sweep = time.monotonic()
+    try:
+        while True:
+            wakeup.clear()
+            now = time.monotonic()
+
+            # Снимаем с кучи сработавшие таймеры (устаревшие записи пропускаем)
+            while _due_heap and _due_heap[0][0] <= now:
+                due, chat_id = heapq.heappop(_due_heap)
+                if _due_at.get(chat_id) == due:
+                    del _due_at[chat_id]
+                    claim_needed = True
+
+            if now >= next_sweep:
+                claim_needed = True
+                next_sweep = now + (SWEEP_INTERVAL_SECONDS if stats["listening"] else POLL_INTERVAL_SECONDS)
+
+            if claim_needed:
+                # Берем в аренду не больше диалогов, чем есть свободных слотов, — остальные достанутся другим процессам
+                free_slots = DISPATCHER_CONCURRENCY - stats["in_flight"] - stats["queued"]
+                if free_slots > 0:
+                    try:
+                        claimed = await _claim_and_submit(free_slots)
+                        # Взяли ровно столько, сколько просили, — созревших диалогов может быть больше
+                        claim_needed = claimed == free_slots
+                    except Exception as e:
+                        print(f"❌❌❌ КРИТИЧЕСКАЯ ОШИБКА В ВОРКЕРЕ: {e}")
+                        traceback.print_exc()
+                        await asyncio.sleep(POLL_INTERVAL_SECONDS)
+                    continue
+
+            # Спим до ближайшего таймера/проверки или до пробуждения (уведомление, освободившийся слот)
+            next_due = _due_heap[0][0] if _due_heap else next_sweep
+            timeout = max(0.0, min(next_due, next_sweep) - time.monotonic())
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        listener_task.cancel()
+        await asyncio.gather(listener_task, return_exceptions=True)
+        print(f"Воркер-ДИСПЕТЧЕР {WORKER_ID} больше не берет новые диалоги.")
+
+
+async def drain(timeout_seconds: float = DISPATCHER_DRAIN_TIMEOUT_SECONDS):
+    """
+    Плавная остановка: дожидается уже взятых диалогов (не дольше `timeout_seconds`),
+    а незавершенные отменяет — они сразу возвращаются в очередь для других воркеров.
+    Вызывается после остановки process_pending_messages_worker.
+    """
+    if not _tasks:
+        return
+    print(f"⏳ Дожидаемся завершения {len(_tasks)} диалогов (до {timeout_seconds} с)...")
+    _, pending = await asyncio.wait(list(_tasks), timeout=timeout_seconds)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    if pending:
+        print(f"⚠️ {len(pending)} диалогов не успели завершиться и возвращены в очередь.")
@@ -0,0 +1,91 @@
+# src/history.py
+import os
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import db_service
+from services import llm_service
+from utils import estimate_tokens
+
+# --- НАСТРОЙКИ ОКНА ИСТОРИИ ---
+# Сколько последних сообщений всегда уходит в LLM дословно
+HISTORY_WINDOW_MESSAGES = int(os.getenv("HISTORY_WINDOW_MESSAGES", "12"))
+# Жесткий потолок на историю (вместе с кратким содержанием) в токенах
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+# Старые сообщения сжимаются пачками, а не на каждом ходу
+HISTORY_SUMMARY_BATCH = int(os.getenv("HISTORY_SUMMARY_BATCH", "10"))
+# Сколько несжатых сообщений за окном читается за один ход (остальные догоняются на следующих ходах)
+HISTORY_SUMMARY_MAX_BATCH = HISTORY_SUMMARY_BATCH * 4
+
+stats = {
+    "summaries_updated": 0,
+    "summary_failures": 0,
+    "messages_trimmed": 0,  # сообщения, отброшенные из-за бюджета токенов
+}
+
+
+def get_stats() -> dict:
+    return {
+        **stats,
+        "window_messages": HISTORY_WINDOW_MESSAGES,
+        "token_budget": HISTORY_TOKEN_BUDGET,
+    }
+
+
+def _summary_message(summary: str) -> dict:
+    return {"role": "system", "content": f"Краткое содержание предыдущей переписки с клиентом:\n{summary}"}
+
+
+def _message_tokens(message: dict) -> int:
+    # +4 на служебную разметку сообщения в чат-формате
+    return estimate_tokens(message.get("content") or "") + 4
+
+
+async def build_llm_history(db: AsyncSession, dialog: dict, new_messages: list) -> list:
+    """
+    Готовит историю для LLM: краткое содержание старой части + последние HISTORY_WINDOW_MESSAGES сообщений
+    из dialog_messages + новые, еще не сохраненные сообщения хода. Из БД читается только окно.
+    `dialog` — словарь с dialog_id, chat_id, summary и summary_message_id (например, пачка диспетчера).
+    Когда за пределами окна накопилось HISTORY_SUMMARY_BATCH несжатых сообщений, они дописываются
+    в краткое содержание, и оно сохраняется в диалоге. Итог всегда укладывается в HISTORY_TOKEN_BUDGET.
+    """
+    chat_id, dialog_id = dialog['chat_id'], dialog['dialog_id']
+    summary, summary_message_id = dialog['summary'], dialog['summary_message_id']
+
+    window = await db_service.get_dialog_messages(db, dialog_id, after_id=summary_message_id, limit=HISTORY_WINDOW_MESSAGES, newest=True)
+    older = []
+    if len(window) == HISTORY_WINDOW_MESSAGES:
+        # Несжатые сообщения между курсором краткого содержания и окном
+        older = await db_service.get_dialog_messages(
+            db, dialog_id, after_id=summary_message_id, before_id=window[0]["id"], limit=HISTORY_SUMMARY_MAX_BATCH
+        )
+
+    if len(older) >= HISTORY_SUMMARY_BATCH:
+        # Читающая транзакция закрывается: соединение не держится, пока LLM сжимает историю
+        await db.commit()
+        new_summary = await llm_service.summarize_history(summary, older)
+        if new_summary:
+            summary, summary_message_id = new_summary, older[-1]["id"]
+            await db_service.update_dialog_summary(db, chat_id, summary, summary_message_id)
+            stats["summaries_updated"] += 1
+            print(f"  - История диалога {chat_id}: {len(older)} сообщений добавлено в краткое содержание.")
+            older = []
+        else:
+            # Несжатые сообщения пока отправляем как есть — их обрежет бюджет
+            stats["summary_failures"] += 1
+
+    # В LLM уходят только роль и текст (служебные поля вроде created_at отбрасываются)
+    recent = [{"role": msg["role"], "content": msg["content"]} for msg in older + window + list(new_messages)]
+    prefix = [_summary_message(summary)] if summary else []
+    budget = HISTORY_TOKEN_BUDGET - sum(_message_tokens(msg) for msg in prefix)
+
+    # Отбрасываем самые старые сообщения, пока не уложимся в бюджет; последнее сообщение остается всегда
+    used = sum(_message_tokens(msg) for msg in recent)
+    trimmed = 0
+    while len(recent) > 1 and used > budget:
+        used -= _message_tokens(recent.pop(0))
+        trimmed += 1
+    if trimmed:
+        stats["messages_trimmed"] += trimmed
+        print(f"  - История диалога {chat_id}: {trimmed} старых сообщений не вошли в бюджет {HISTORY_TOKEN_BUDGET} токенов.")
+
+    return prefix + recent
@@ -0,0 +1,130 @@
+# src/jobs.py
+import os
+import asyncio
+import traceback
+
+from database import db_service
+from database.db import AsyncSessionLocal
+
+# --- НАСТРОЙКИ ОЧЕРЕДИ ФОНОВЫХ ЗАДАЧ ---
+JOBS_POLL_INTERVAL_SECONDS = float(os.getenv("JOBS_POLL_INTERVAL_SECONDS", "1"))
+JOBS_LEASE_SECONDS = int(os.getenv("JOBS_LEASE_SECONDS", "300"))
+JOBS_RETRY_BASE_SECONDS = int(os.getenv("JOBS_RETRY_BASE_SECONDS", "10"))
+JOBS_RETENTION_HOURS = int(os.getenv("JOBS_RETENTION_HOURS", "72"))
+# Окончательно проваленные задачи храним дольше — по ним разбирают ошибки
+JOBS_FAILED_RETENTION_HOURS = int(os.getenv("JOBS_FAILED_RETENTION_HOURS", "720"))
+# Сколько хранить messageId принятых сообщений Wazzup для защиты от повторной доставки
+INBOUND_MESSAGES_RETENTION_HOURS = int(os.getenv("INBOUND_MESSAGES_RETENTION_HOURS", "72"))
+
+# Счетчики по очередям: {'bitrix_webhook': {'in_flight': 0, 'done': 0, ...}}
+stats: dict[str, dict] = {}
+# Пробуждение воркеров очередей этого процесса: задачу, поставленную здесь же, не ждут до следующего опроса
+_wakeups: dict[str, asyncio.Event] = {}
+
+
+def get_stats() -> dict:
+    """Возвращает счетчики всех очередей текущего процесса."""
+    return {queue: dict(counters) for queue, counters in stats.items()}
+
+
+def notify(queue: str):
+    """Будит воркер очереди `queue` в текущем процессе. Вызывается после коммита новой задачи."""
+    wakeup = _wakeups.get(queue)
+    if wakeup is not None:
+        wakeup.set()
+
+
+def _retry_delay(attempts: int) -> int:
+    # Экспоненциальная пауза: 10с, 20с, 40с ... но не больше часа
+    return min(JOBS_RETRY_BASE_SECONDS * 2 ** (attempts - 1), 3600)
+
+
+async def _run_job(queue: str, handler, job: dict, slot_freed: asyncio.Event):
+    counters = stats[queue]
+    db = AsyncSessionLocal()
+    try:
+        result = await handler(db, job['payload'])
+        await db_service.complete_job(db, job['id'])
+        counters["done"] += 1
+        if result:
+            print(f"  - Задача {queue}#{job['id']} выполнена: {result}")
+    except Exception as e:
+        traceback.print_exc()
+        await db.rollback()
+        if job['attempts'] < job['max_attempts']:
+            delay = _retry_delay(job['attempts'])
+            print(f"❌ Задача {queue}#{job['id']} упала ({e}). Повтор через {delay} с.")
+            await db_service.fail_job(db, job['id'], str(e), retry_delay_seconds=delay)
+            counters["retried"] += 1
+        else:
+            print(f"❌❌ Задача {queue}#{job['id']} окончательно провалена после {job['attempts']} попыток: {e}")
+            await db_service.fail_job(db, job['id'], str(e))
+            counters["failed"] += 1
+    finally:
+        await db.close()
+        counters["in_flight"] -= 1
+        slot_freed.set()
+
+
+async def run_queue_worker(queue: str, handler, concurrency: int):
+    """
+    Бесконечный цикл обработки очереди `queue`: забирает задачи из БД,
+    пока есть свободные слоты (не больше `concurrency` одновременно), и передает их в `handler(db, payload)`.
+    """
+    print(f"🚀 Воркер очереди '{queue}' запущен! Параллельных задач: до {concurrency}")
+    counters = stats.setdefault(queue, {"in_flight": 0, "done": 0, "retried": 0, "failed": 0, "concurrency": concurrency})
+    slot_freed = asyncio.Event()
+    wakeup = _wakeups.setdefault(queue, asyncio.Event())
+    tasks: set[asyncio.Task] = set()
+    try:
+        while True:
+            try:
+                free_slots = concurrency - counters["in_flight"]
+                if free_slots <= 0:
+                    # Все слоты заняты — ждем завершения любой задачи
+                    slot_freed.clear()
+                    await slot_freed.wait()
+                    continue
+
+                # Сбрасываем до запроса: задача, поставленная во время него, разбудит следующее ожидание
+                wakeup.clear()
+                async with AsyncSessionLocal() as db:
+                    claimed = await db_service.claim_jobs(db, queue, limit=free_slots, lease_seconds=JOBS_LEASE_SECONDS)
+
+                if not claimed:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), timeout=JOBS_POLL_INTERVAL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                for job in claimed:
+                    counters["in_flight"] += 1
+                    task = asyncio.create_task(_run_job(queue, handler, job, slot_freed))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            except Exception as e:
+                print(f"❌❌❌ КРИТИЧЕСКАЯ ОШИБКА В ВОРКЕРЕ ОЧЕРЕДИ '{queue}': {e}")
+                traceback.print_exc()
+                await asyncio.sleep(JOBS_POLL_INTERVAL_SECONDS)
+    finally:
+        for task in list(tasks):
+            task.cancel()
+
+
+async def purge_jobs_worker():
+    """Раз в час удаляет старые завершенные задачи и отметки о принятых сообщениях."""
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                deleted = await db_service.purge_finished_jobs(
+                    db, older_than_hours=JOBS_RETENTION_HOURS, failed_older_than_hours=JOBS_FAILED_RETENTION_HOURS
+                )
+                deleted_ids = await db_service.purge_inbound_messages(db, older_than_hours=INBOUND_MESSAGES_RETENTION_HOURS)
+            if deleted:
+                print(f"🧹 Удалено {deleted} завершенных фоновых задач.")
+            if deleted_ids:
+                print(f"🧹 Удалено {deleted_ids} отметок о принятых сообщениях Wazzup.")
+        except Exception as e:
+            print(f"❌ Ошибка при очистке очереди задач: {e}")
+        await asyncio.sleep(3600)
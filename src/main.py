@@ -1,10 +1,25 @@
 # src/main.py
+import os
 import uvicorn
-from app import app # Импортируем наше приложение из app.py
+from dotenv import load_dotenv
+
+# Приложение импортирует каждый процесс uvicorn сам (по строке "app:app"); здесь нужны только настройки
+load_dotenv()
+
+# --- НАСТРОЙКИ ВЕБ-СЕРВЕРА ---
+# reload удобен при разработке, но в продакшене должен быть выключен
+UVICORN_RELOAD = os.getenv("UVICORN_RELOAD", "false").lower() in ("1", "true", "yes")
+# Несколько веб-процессов (несовместимо с reload). Диспетчер в них лучше отключить: EMBEDDED_WORKER=false
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
 
 if __name__ == "__main__":
     # Эта команда запускает сервер uvicorn.
     # host="0.0.0.0" делает сервер доступным извне (понадобится позже)
     # port=8000 - стандартный порт для веб-разработки
-    # reload=True - сервер будет автоматически перезапускаться при изменении кода
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        reload=UVICORN_RELOAD,
+        workers=None if UVICORN_RELOAD else WEB_WORKERS,
+    )
@@ -0,0 +1,113 @@
+# src/outbox.py
+"""
+Исходящие действия диалога (outbox): ответ клиенту в Wazzup и записи в сделку Битрикс24.
+Диспетчер не вызывает внешние API сам: решение LLM записывается задачами в очередь jobs
+в той же транзакции, что и новое состояние диалога (db_service.update_dialog). Отдельные воркеры
+очередей отправляют их с повторами и экспоненциальной паузой, у каждой цели свой предел параллельности.
+Медленный Битрикс24 больше не задерживает следующие диалоги, а падение процесса после ответа LLM
+не теряет действия.
+Доставка "как минимум один раз": повтор после таймаута может продублировать комментарий в сделке.
+Ответы одного чата уходят строго по порядку (ordering_key = chat_id): пока предыдущий ответ
+ждет повтора, следующий не отправляется, иначе клиент увидел бы их не в том порядке, что в истории.
+"""
+import os
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import db_service
+from services import bitrix_service, wazzup_service
+import jobs
+
+WAZZUP_OUTBOX_QUEUE = "wazzup_outbox"
+BITRIX_OUTBOX_QUEUE = "bitrix_outbox"
+
+# --- НАСТРОЙКИ ОТПРАВКИ ---
+# Сколько отправок к каждому сервису идет одновременно (в процессе)
+WAZZUP_OUTBOX_CONCURRENCY = int(os.getenv("WAZZUP_OUTBOX_CONCURRENCY", "10"))
+BITRIX_OUTBOX_CONCURRENCY = int(os.getenv("BITRIX_OUTBOX_CONCURRENCY", "3"))
+# Попыток до окончательного отказа; паузы между ними — JOBS_RETRY_BASE_SECONDS * 2^n
+WAZZUP_OUTBOX_MAX_ATTEMPTS = int(os.getenv("WAZZUP_OUTBOX_MAX_ATTEMPTS", "5"))
+BITRIX_OUTBOX_MAX_ATTEMPTS = int(os.getenv("BITRIX_OUTBOX_MAX_ATTEMPTS", "8"))
+
+CRM_ACTIONS = ("LOG_COMMENT", "CREATE_TASK_AND_LOG", "ESCALATE_TO_MANAGER")
+
+
+class OutboxDeliveryError(Exception):
+    """Внешний сервис не принял действие — задача будет повторена."""
+
+
+# --- ЗАПИСЬ В OUTBOX (без коммита: коммитит вызывающий вместе с диалогом) ---
+async def enqueue_reply(db: AsyncSession, chat_id: str, text: str, delay_seconds: float = 0) -> int | None:
+    """Сообщение клиенту; `delay_seconds` — отложенная отправка (рассылки кампаний идут по расписанию)."""
+    return await db_service.enqueue_job(
+        db, WAZZUP_OUTBOX_QUEUE, {"chat_id": chat_id, "text": text},
+        delay_seconds=delay_seconds, max_attempts=WAZZUP_OUTBOX_MAX_ATTEMPTS, commit=False, ordering_key=chat_id,
+    )
+
+
+async def enqueue_crm_action(db: AsyncSession, action: str, deal_id: int, manager_id: int, action_params: dict) -> int | None:
+    """
+    Записывает действие LLM для сделки. Возвращает ID задачи или None, если делать нечего
+    (неизвестное действие, комментарий без текста и т.п.).
+    """
+    if action not in CRM_ACTIONS:
+        return None
+    comment = action_params.get("comment_text")
+    payload = {
+        "action": action,
+        "deal_id": deal_id,
+        "manager_id": manager_id,
+        "comment": f"[Чат-бот]: {comment}" if comment else None,
+    }
+    if action == "LOG_COMMENT" and not comment:
+        return None
+    if action == "CREATE_TASK_AND_LOG":
+        payload["task_subject"] = action_params.get("task_subject")
+        payload["task_description"] = action_params.get("task_description")
+        if not comment and not (payload["task_subject"] and payload["task_description"]):
+            return None
+    if action == "ESCALATE_TO_MANAGER":
+        payload["reason"] = comment or "Причина эскалации не указана."
+    return await db_service.enqueue_job(
+        db, BITRIX_OUTBOX_QUEUE, payload, max_attempts=BITRIX_OUTBOX_MAX_ATTEMPTS, commit=False,
+    )
+
+
+def notify_senders():
+    """Будит отправителей этого процесса после коммита (в других процессах задачи заберет опрос)."""
+    jobs.notify(WAZZUP_OUTBOX_QUEUE)
+    jobs.notify(BITRIX_OUTBOX_QUEUE)
+
+
+# --- ОТПРАВИТЕЛИ (обработчики очередей jobs) ---
+async def send_reply(db: AsyncSession, payload: dict) -> str:
+    if not await wazzup_service.send_message(payload["chat_id"], payload["text"]):
+        raise OutboxDeliveryError(f"Wazzup не принял сообщение для {payload['chat_id']}")
+    return f"ответ отправлен в чат {payload['chat_id']}"
+
+
+async def run_crm_action(db: AsyncSession, payload: dict) -> str:
+    action, deal_id, manager_id = payload["action"], payload["deal_id"], payload["manager_id"]
+    if action == "LOG_COMMENT":
+        ok = await bitrix_service.add_comment_to_deal(deal_id, payload["comment"])
+    elif action == "CREATE_TASK_AND_LOG":
+        # Комментарий и дело уходят в Битрикс24 одним batch-запросом
+        ok = await bitrix_service.add_comment_and_create_activity(
+            deal_id, manager_id, payload["comment"], payload.get("task_subject"), payload.get("task_description")
+        )
+    elif action == "ESCALATE_TO_MANAGER":
+        ok = await bitrix_service.escalate_deal_to_manager(
+            deal_id, manager_id, payload["reason"], comment_text=payload["comment"]
+        )
+    else:
+        return f"неизвестное действие {action} пропущено"
+    if not ok:
+        raise OutboxDeliveryError(f"Битрикс24 не выполнил {action} для сделки {deal_id}")
+    return f"{action} для сделки {deal_id}"
+
+
+def sender_workers() -> list:
+    """Корутины воркеров outbox для запуска рядом с остальными очередями задач."""
+    return [
+        jobs.run_queue_worker(WAZZUP_OUTBOX_QUEUE, send_reply, WAZZUP_OUTBOX_CONCURRENCY),
+        jobs.run_queue_worker(BITRIX_OUTBOX_QUEUE, run_crm_action, BITRIX_OUTBOX_CONCURRENCY),
+    ]
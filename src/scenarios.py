@@ -0,0 +1,329 @@
+# src/scenarios.py
+import os
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import db_service
+from services import bitrix_service, wazzup_service, llm_service
+from utils import normalize_phone
+import deal_sync
+
+# --- ЗАГРУЗКА НАСТРОЕК ИЗ .ENV ---
+# ID воронки "Постоянные" (согласно вашему .env)
+TARGET_FUNNEL_ID = os.getenv("TARGET_FUNNEL_ID") 
+# Первая стадия в этой воронке, которая будет триггером
+WELCOME_STAGE_ID = f"C{TARGET_FUNNEL_ID}:NEW" 
+NEW_LOT_STAGE_ID = os.getenv("NEW_LOT_STAGE_ID")
+TOUCH_TODAY_STAGE_ID = os.getenv("TOUCH_TODAY_STAGE_ID")
+
+TRIGGER_STAGE_IDS = {WELCOME_STAGE_ID, NEW_LOT_STAGE_ID, TOUCH_TODAY_STAGE_ID}
+
+# Имя очереди фоновых задач для событий ONCRMDEALUPDATE
+BITRIX_WEBHOOK_QUEUE = "bitrix_webhook"
+
+# --- РЕЖИМ КАМПАНИИ ---
+# Переходы на эти стадии менеджеры делают массово (сотни сделок разом): сделки собираются в пачку,
+# и первые сообщения готовит и рассылает кампания (campaigns.py), а не отдельный сценарий на каждую
+CAMPAIGN_QUEUE = "campaign"
+CAMPAIGN_MODE = os.getenv("CAMPAIGN_MODE", "true").lower() in ("1", "true", "yes")
+CAMPAIGN_STAGE_IDS = {NEW_LOT_STAGE_ID, TOUCH_TODAY_STAGE_ID}
+# Сколько ждем остальные события массового перевода, прежде чем запустить кампанию
+CAMPAIGN_COLLECT_SECONDS = int(os.getenv("CAMPAIGN_COLLECT_SECONDS", "15"))
+
+# --- ЗАЩИТА ОТ ПОВТОРНЫХ СОБЫТИЙ ---
+# Пауза перед обработкой события: за это время "хвост" из правок той же сделки склеится в одну задачу
+DEAL_EVENT_SETTLE_SECONDS = int(os.getenv("DEAL_EVENT_SETTLE_SECONDS", "3"))
+# Окно, в течение которого сценарий для пары (сделка, стадия) повторно не запускается
+DEAL_STAGE_DEDUP_WINDOW_SECONDS = int(os.getenv("DEAL_STAGE_DEDUP_WINDOW_SECONDS", "600"))
+
+stats = {
+    "coalesced": 0,                # события, склеенные с уже ожидающей задачей (без запроса в Битрикс24)
+    "snapshot_hits": 0,            # стадия взята из свежего зеркала сделок (без запроса в Битрикс24)
+    "bitrix_fetches": 0,           # зеркало устарело, сделка запрошена из Битрикс24
+    "no_stage_change": 0,          # стадия не менялась с прошлого решения
+    "repeat_stage_suppressed": 0,  # повторы по той же стадии (без вызова LLM)
+    "campaign_queued": 0,          # сделки, переданные кампании вместо отдельного сценария
+}
+
+
+def get_stats() -> dict:
+    """Счетчики подавленных событий Битрикс24 в текущем процессе."""
+    return dict(stats)
+
+
+async def enqueue_deal_update(db: AsyncSession, deal_id: int, event: str) -> int | None:
+    """
+    Ставит событие по сделке в очередь. Пока по сделке уже есть необработанная задача,
+    новые события склеиваются с ней: задача все равно прочитает актуальное состояние сделки.
+    Возвращает ID задачи или None, если событие было склеено.
+    """
+    # replace_pending: ожидающая задача получает время последнего события,
+    # чтобы проверка свежести зеркала учитывала все склеенные правки
+    job_id = await db_service.enqueue_job(
+        db, BITRIX_WEBHOOK_QUEUE, {"deal_id": deal_id, "event": event},
+        delay_seconds=DEAL_EVENT_SETTLE_SECONDS,
+        dedup_key=f"deal:{deal_id}",
+        replace_pending=True,
+    )
+    if job_id is None:
+        stats["coalesced"] += 1
+    return job_id
+
+
+async def handle_deal_update(db: AsyncSession, payload: dict) -> dict:
+    """
+    Фоновая обработка события ONCRMDEALUPDATE: определяет стадию сделки
+    и запускает соответствующий сценарий (приветствие, новый лот, касание).
+    Вызывается воркером очереди задач, а не самим вебхуком.
+    """
+    deal_id = payload['deal_id']
+
+    # --- 1. ТЕКУЩЕЕ СОСТОЯНИЕ СДЕЛКИ ---
+    # Если зеркало синхронизировано уже после получения события, в Битрикс24 не ходим
+    snapshot, is_fresh = await db_service.get_deal_snapshot(db, deal_id, fresh_since=payload.get('enqueued_at'))
+    if is_fresh:
+        stats["snapshot_hits"] += 1
+        deal_details = deal_sync.snapshot_to_deal(snapshot)
+    else:
+        stats["bitrix_fetches"] += 1
+        deal_details = await bitrix_service.get_deal_details(deal_id)
+        if not deal_details:
+            # Ошибка связи с Битрикс24 — пусть очередь повторит задачу позже
+            raise RuntimeError(f"Не удалось получить детали сделки {deal_id}")
+        # В зеркале храним только сделки целевой воронки (и те, что из нее ушли)
+        if snapshot or str(deal_details.get("CATEGORY_ID")) == TARGET_FUNNEL_ID:
+            await db_service.upsert_deal_snapshots(db, [deal_sync.snapshot_values(deal_details)])
+
+    current_funnel_id = str(deal_details.get("CATEGORY_ID"))
+    current_stage = deal_details.get("STAGE_ID")
+    if current_funnel_id != TARGET_FUNNEL_ID:
+        return {"status": "ok", "message": "Deal is not in the target funnel"}
+
+    # --- 2. БЫЛ ЛИ РЕАЛЬНЫЙ ПЕРЕХОД НА НОВУЮ СТАДИЮ ---
+    # Большинство ONCRMDEALUPDATE — правки полей без смены стадии
+    handled_stage_id = snapshot.handled_stage_id if snapshot else None
+    if current_stage == handled_stage_id:
+        stats["no_stage_change"] += 1
+        return {"status": "ok", "message": "Stage has not changed"}
+
+    if current_stage not in TRIGGER_STAGE_IDS:
+        await db_service.mark_deal_stage_handled(db, deal_id, current_stage)
+        return {"status": "ok", "message": "No scenario for this stage"}
+
+    # Битрикс24 шлет ONCRMDEALUPDATE на каждую правку поля: сценарий для пары (сделка, стадия)
+    # запускается не чаще одного раза за окно, причем проверка общая для всех процессов.
+    if not await db_service.claim_deal_stage_trigger(db, deal_id, current_stage, DEAL_STAGE_DEDUP_WINDOW_SECONDS):
+        stats["repeat_stage_suppressed"] += 1
+        print(f"⏭️ Сценарий для сделки {deal_id} на стадии '{current_stage}' уже запускался недавно. Пропускаем.")
+        return {"status": "ok", "message": "Duplicate stage event suppressed"}
+
+    if CAMPAIGN_MODE and current_stage in CAMPAIGN_STAGE_IDS:
+        # Сделку заберет кампания по стадии (по занятому триггеру); одна ожидающая задача на стадию
+        await db_service.enqueue_job(
+            db, CAMPAIGN_QUEUE, {"stage_id": current_stage},
+            delay_seconds=CAMPAIGN_COLLECT_SECONDS, dedup_key=f"campaign:{current_stage}",
+        )
+        stats["campaign_queued"] += 1
+        return {"status": "ok", "message": "Deal queued for campaign"}
+
+    try:
+        # Контакт, менеджер (если их нет в кэше) и последнее дело — одним batch-запросом
+        deal_context = await bitrix_service.get_deal_context(
+            deal_id, include_activity=current_stage == NEW_LOT_STAGE_ID, deal=deal_details
+        )
+        if not deal_context:
+            raise RuntimeError(f"Не удалось получить контакт и менеджера сделки {deal_id}")
+        result = await _run_scenario(db, deal_id, deal_context)
+    except Exception:
+        # Снимаем отметку, чтобы повтор задачи смог запустить сценарий снова
+        await db.rollback()
+        await db_service.release_deal_stage_trigger(db, deal_id, current_stage)
+        raise
+
+    await db_service.mark_deal_stage_handled(db, deal_id, current_stage)
+    return result
+
+
+def contact_card(deal_context: dict) -> tuple[str, str, str]:
+    """(имя клиента, телефон, имя менеджера) из контекста сделки. Телефон у контакта должен быть."""
+    contact_details = deal_context['contact']
+    client_name = contact_details.get("NAME", "Уважаемый клиент")
+    client_phone = normalize_phone(contact_details["PHONE"][0].get("VALUE"))
+    manager = deal_context['manager']
+    manager_name = f"{manager.get('NAME', '')} {manager.get('LAST_NAME', '')}".strip() if manager else "Ваш менеджер"
+    return client_name, client_phone, manager_name
+
+
+def scenario_instruction(stage_id: str, client_name: str, manager_name: str, debtor_name_info: str = None) -> tuple[dict, str]:
+    """Инструкция для LLM и состояние промпта для первого сообщения клиенту на стадии-триггере."""
+    if stage_id == NEW_LOT_STAGE_ID:
+        state = "initiate_new_lot_dialog"
+        content = f"{state}. ИМЯ_КЛИЕНТА: {client_name}. ИМЯ_МЕНЕДЖЕРА: {manager_name}. НАЗВАНИЕ_ДОЛЖНИКА: {debtor_name_info}."
+    elif stage_id == TOUCH_TODAY_STAGE_ID:
+        state = "initiate_touch_today_dialog"
+        content = f"{state}. ИМЯ_КЛИЕНТА: {client_name}. ИМЯ_МЕНЕДЖЕРА: {manager_name}."
+    else:
+        state = "initiate_dialog"
+        content = f"{state}. ИМЯ_КЛИЕНТА: {client_name}. ИМЯ_МЕНЕДЖЕРА: {manager_name}."
+    return {"role": "system", "content": content}, state
+
+
+async def _run_scenario(db: AsyncSession, deal_id: int, deal_context: dict) -> dict:
+    """Запускает сценарий, соответствующий текущей стадии сделки."""
+    deal_details = deal_context['deal']
+    current_funnel_id = str(deal_details.get("CATEGORY_ID"))
+    current_stage = deal_details.get("STAGE_ID")
+
+    # --- Сценарий №1: Приветствие на стадии NEW ---
+    if current_funnel_id == TARGET_FUNNEL_ID and current_stage == WELCOME_STAGE_ID:
+        print(f"✅✅✅ ТРИГГЕР СЦЕНАРИЯ №1 СРАБОТАЛ: Сделка {deal_id} перешла на стадию '{WELCOME_STAGE_ID}'.")
+
+        # --- Сбор данных ---
+        contact_id = int(deal_details.get("CONTACT_ID"))
+        manager_id = int(deal_details.get("ASSIGNED_BY_ID"))
+        
+        contact_details = deal_context['contact']
+        if not (contact_details and contact_details.get("PHONE")):
+            print(f"⚠️ ОСТАНОВКА: У контакта {contact_id} для сделки {deal_id} нет номера телефона.")
+            return {"status": "ok", "message": "Contact has no phone number"}
+        
+        client_name, client_phone, manager_name = contact_card(deal_context)
+        
+        print(f"  - Клиент: {client_name} ({client_phone})")
+        print(f"  - Менеджер: {manager_name} ({manager_id})")
+
+        # --- Запуск LLM ---
+        initial_instruction, prompt_state = scenario_instruction(current_stage, client_name, manager_name)
+        llm_decision = await llm_service.get_bot_decision([initial_instruction], state=prompt_state)
+
+        if not llm_decision:
+            print(f"❌ ОСТАНОВКА: LLM не вернул решение для инициации диалога по сделке {deal_id}.")
+            return {"status": "error", "message": "LLM failed to provide initial decision"}
+        
+        # --- Исполнение и сохранение (общий блок) ---
+        response_text = llm_decision.get("response_text")
+        action = llm_decision.get("action")
+        action_params = llm_decision.get("action_params", {})
+        new_state = llm_decision.get("new_state")
+        
+        if response_text:
+            success = await wazzup_service.send_message(client_phone, response_text)
+            if not success:
+                await bitrix_service.add_comment_to_deal(deal_id, f"[Чат-бот] Ошибка! Не удалось отправить сообщение на номер {client_phone}.")
+                return {"status": "ok", "message": "Wazzup send failed"}
+        
+        if action == "LOG_COMMENT" and action_params.get("comment_text"):
+            await bitrix_service.add_comment_to_deal(deal_id, f"[Чат-бот]: {action_params['comment_text']}")
+
+        # Диалог создается/обновляется и получает сообщение в одной транзакции (коммит — в update_dialog)
+        await db_service.get_or_create_dialog(db, client_phone, deal_id, manager_id, current_funnel_id, commit=False)
+        # ДОБАВЛЯЕМ в историю новое сообщение (прежние сообщения не перечитываются и не перезаписываются)
+        new_messages = [{"role": "assistant", "content": response_text}] if response_text else []
+        await db_service.update_dialog(db, client_phone, new_state, new_messages)
+        print(f"✅ Сценарий №1 для сделки {deal_id} успешно запущен.")
+
+    # --- Сценарий №2: Уведомление о новом лоте ---
+    elif current_funnel_id == TARGET_FUNNEL_ID and current_stage == NEW_LOT_STAGE_ID:
+        print(f"✅✅✅ ТРИГГЕР СЦЕНАРИЯ №2 СРАБОТАЛ: Сделка {deal_id} перешла на стадию 'Новый лот' ({NEW_LOT_STAGE_ID}).")
+        
+        # --- Сбор данных ---
+        contact_id = int(deal_details.get("CONTACT_ID"))
+        manager_id = int(deal_details.get("ASSIGNED_BY_ID"))
+        contact_details = deal_context['contact']
+        
+        if not (contact_details and contact_details.get("PHONE")):
+            print(f"⚠️ ОСТАНОВКА: У контакта {contact_id} нет номера телефона.")
+            return {"status": "ok", "message": "Contact has no phone number"}
+        
+        client_name, client_phone, manager_name = contact_card(deal_context)
+        
+        latest_activity = deal_context['activity']
+        if not latest_activity or not latest_activity.get("DESCRIPTION"):
+            print(f"⚠️ ОСТАНОВКА: Не найдено дело с описанием для сделки {deal_id}.")
+            await bitrix_service.add_comment_to_deal(deal_id, "[Чат-бот] Ошибка: не удалось запустить сценарий 'Новый лот', т.к. к сделке не привязано дело с описанием.")
+            return {"status": "ok", "message": "No activity with description"}
+        
+        debtor_name_info = latest_activity["DESCRIPTION"]
+        
+        print(f"  - Клиент: {client_name} ({client_phone})")
+        print(f"  - Менеджер: {manager_name} ({manager_id})")
+        print(f"  - Инфо о лоте: {debtor_name_info}")
+
+        # --- Запуск LLM ---
+        initial_instruction, prompt_state = scenario_instruction(current_stage, client_name, manager_name, debtor_name_info)
+        llm_decision = await llm_service.get_bot_decision([initial_instruction], state=prompt_state)
+        
+        if not llm_decision:
+            print(f"❌ ОСТАНОВКА: LLM не вернул решение для сценария 'Новый лот' по сделке {deal_id}.")
+            return {"status": "error", "message": "LLM failed"}
+
+        # --- Исполнение и сохранение (общий блок) ---
+        response_text = llm_decision.get("response_text")
+        action = llm_decision.get("action")
+        action_params = llm_decision.get("action_params", {})
+        new_state = llm_decision.get("new_state")
+        
+        if response_text:
+            success = await wazzup_service.send_message(client_phone, response_text)
+            if not success:
+                await bitrix_service.add_comment_to_deal(deal_id, f"[Чат-бот] Ошибка! Не удалось отправить сообщение на номер {client_phone}.")
+                return {"status": "ok", "message": "Wazzup send failed"}
+        
+        if action == "LOG_COMMENT" and action_params.get("comment_text"):
+            await bitrix_service.add_comment_to_deal(deal_id, f"[Чат-бот]: {action_params['comment_text']}")
+
+        # Диалог создается/обновляется и получает сообщение в одной транзакции (коммит — в update_dialog)
+        await db_service.get_or_create_dialog(db, client_phone, deal_id, manager_id, current_funnel_id, commit=False)
+        # ДОБАВЛЯЕМ в историю новое сообщение (прежние сообщения не перечитываются и не перезаписываются)
+        new_messages = [{"role": "assistant", "content": response_text}] if response_text else []
+        await db_service.update_dialog(db, client_phone, new_state, new_messages)
+        print(f"✅ Сценарий 'Новый лот' для сделки {deal_id} успешно запущен.")
+
+    # --- Сценарий №3: Касание сегодня ---
+    elif current_funnel_id == TARGET_FUNNEL_ID and current_stage == TOUCH_TODAY_STAGE_ID:
+        print(f"✅✅✅ ТРИГГЕР СЦЕНАРИЯ №3 СРАБОТАЛ: Сделка {deal_id} перешла на стадию 'Касание сегодня' ({TOUCH_TODAY_STAGE_ID}).")
+        
+        # --- Сбор данных ---
+        contact_id = int(deal_details.get("CONTACT_ID"))
+        manager_id = int(deal_details.get("ASSIGNED_BY_ID"))
+        contact_details = deal_context['contact']
+        
+        if not (contact_details and contact_details.get("PHONE")):
+            print(f"⚠️ ОСТАНОВКА: У контакта {contact_id} нет номера телефона.")
+            return {"status": "ok", "message": "Contact has no phone number"}
+        
+        client_name, client_phone, manager_name = contact_card(deal_context)
+        
+        print(f"  - Клиент: {client_name} ({client_phone})")
+        print(f"  - Менеджер: {manager_name} ({manager_id})")
+
+        # --- Запуск LLM ---
+        initial_instruction, prompt_state = scenario_instruction(current_stage, client_name, manager_name)
+        llm_decision = await llm_service.get_bot_decision([initial_instruction], state=prompt_state)
+        
+        if not llm_decision:
+            print(f"❌ ОСТАНОВКА: LLM не вернул решение для сценария 'Касание сегодня' по сделке {deal_id}.")
+            return {"status": "error", "message": "LLM failed"}
+
+        # --- Исполнение и сохранение (общий блок) ---
+        response_text = llm_decision.get("response_text")
+        action = llm_decision.get("action")
+        action_params = llm_decision.get("action_params", {})
+        new_state = llm_decision.get("new_state")
+        
+        if response_text:
+            success = await wazzup_service.send_message(client_phone, response_text)
+            if not success:
+                await bitrix_service.add_comment_to_deal(deal_id, f"[Чат-бот] Ошибка! Не удалось отправить сообщение на номер {client_phone}.")
+                return {"status": "ok", "message": "Wazzup send failed"}
+        
+        if action == "LOG_COMMENT" and action_params.get("comment_text"):
+            await bitrix_service.add_comment_to_deal(deal_id, f"[Чат-бот]: {action_params['comment_text']}")
+
+        # Диалог создается/обновляется и получает сообщение в одной транзакции (коммит — в update_dialog)
+        await db_service.get_or_create_dialog(db, client_phone, deal_id, manager_id, current_funnel_id, commit=False)
+        # ДОБАВЛЯЕМ в историю новое сообщение (прежние сообщения не перечитываются и не перезаписываются)
+        new_messages = [{"role": "assistant", "content": response_text}] if response_text else []
+        await db_service.update_dialog(db, client_phone, new_state, new_messages)
+        print(f"✅ Сценарий 'Касание сегодня' для сделки {deal_id} успешно запущен.")
+
+    return {"status": "ok", "message": "Webhook processed"}
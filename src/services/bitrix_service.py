@@ -1,21 +1,328 @@
 import os
-import requests
+import time
+import httpx
 from datetime import datetime, timedelta
+from urllib.parse import quote
+
+from services.http_client import get_client
+from services.cache_service import TTLCache
+from services import rate_limiter
+from utils import parse_bitrix_id
 
 # Получаем базовый URL вебхука из переменных окружения
 BASE_URL = os.getenv("BITRIX_WEBHOOK_URL")
 
+# --- КЭШ СПРАВОЧНЫХ ДАННЫХ ---
+# Менеджеры, контакты и стадии меняются редко, а запрашиваются на каждом вебхуке.
+_user_cache = TTLCache("bitrix_users",
+                       ttl_seconds=float(os.getenv("BITRIX_USER_CACHE_TTL_SECONDS", "21600")),
+                       max_size=int(os.getenv("BITRIX_USER_CACHE_SIZE", "1000")))
+_contact_cache = TTLCache("bitrix_contacts",
+                          ttl_seconds=float(os.getenv("BITRIX_CONTACT_CACHE_TTL_SECONDS", "1800")),
+                          max_size=int(os.getenv("BITRIX_CONTACT_CACHE_SIZE", "5000")))
+_stage_cache = TTLCache("bitrix_stages",
+                        ttl_seconds=float(os.getenv("BITRIX_STAGE_CACHE_TTL_SECONDS", "21600")),
+                        max_size=100)
+# Последние известные связи сделки: deal_id -> (CONTACT_ID, ASSIGNED_BY_ID).
+# Позволяют не запрашивать контакт и менеджера повторно, если они уже в кэше.
+_deal_links_cache = TTLCache("bitrix_deal_links",
+                             ttl_seconds=float(os.getenv("BITRIX_CONTACT_CACHE_TTL_SECONDS", "1800")),
+                             max_size=int(os.getenv("BITRIX_CONTACT_CACHE_SIZE", "5000")))
+
+# Какие события Битрикс24 сбрасывают какие кэши
+CACHE_INVALIDATION_EVENTS = {
+    "ONCRMCONTACTUPDATE": _contact_cache,
+    "ONCRMCONTACTDELETE": _contact_cache,
+    "ONCRMDEALCATEGORYUPDATE": _stage_cache,
+    "ONCRMDEALCATEGORYDELETE": _stage_cache,
+}
+
+
+def invalidate_cache_for_event(event: str, data: dict) -> bool:
+    """
+    Сбрасывает кэш по входящему событию Битрикс24 (например, ONCRMCONTACTUPDATE).
+    Для событий по стадиям сбрасывается весь кэш стадий. Возвращает True, если событие относилось к кэшу.
+    """
+    cache = CACHE_INVALIDATION_EVENTS.get(event)
+    if cache is None:
+        return False
+    if cache is _stage_cache:
+        cache.clear()
+    else:
+        entity_id = parse_bitrix_id(data.get("data", {}).get("FIELDS", {}).get("ID"))
+        if entity_id:
+            cache.invalidate(entity_id)
+    print(f"🧹 Кэш '{cache.name}' сброшен по событию {event}")
+    return True
+
 
-def get_deals(limit: int = 5):
+async def _post(method: str, params: dict, raise_for_status: bool = True) -> dict:
     """
-    Получает 'limit' последних сделок из Битрикс24.
+    Вызывает метод REST API Битрикс24 через общий пул соединений и возвращает JSON ответа.
+    Вызов проходит через общий для всех процессов лимит запросов; отказ QUERY_LIMIT_EXCEEDED
+    не возвращается вызывающему, а повторяется после общей паузы, пока Битрикс24 не примет запрос.
+    Если отказы идут дольше RATE_LIMIT_MAX_WAIT_SECONDS, выбрасывается rate_limiter.RateLimitWaitExceeded —
+    задача очереди, в которой идет вызов, будет повторена.
+    """
+    waiting_since, rejections = time.monotonic(), 0
+    while True:
+        await rate_limiter.acquire("bitrix")
+        response = await get_client("bitrix").post(f"{BASE_URL}{method}.json", json=params)
+        if response.status_code != 503 or b"QUERY_LIMIT_EXCEEDED" not in response.content:
+            break
+        rejections += 1
+        await rate_limiter.back_off("bitrix", rejections=rejections, waiting_since=waiting_since)
+    if raise_for_status:
+        response.raise_for_status()
+    data = response.json()
+    if isinstance(data, dict) and isinstance(data.get("time"), dict):
+        await rate_limiter.observe_bitrix_time(method, data["time"])
+    return data
+
+
+# --- ПАКЕТНЫЕ ЗАПРОСЫ (метод batch) ---
+# Битрикс24 выполняет до 50 команд за один HTTP-запрос. Команды могут ссылаться
+# на результаты предыдущих через $result[имя_команды][ПОЛЕ].
+BATCH_MAX_COMMANDS = 50
+# Списочные методы (*.list) отдают не больше 50 записей за вызов
+LIST_PAGE_SIZE = 50
+
+
+def _encode_query(params: dict, prefix: str = None) -> list[str]:
+    """
+    Кодирует вложенные параметры в строку запроса в стиле PHP http_build_query:
+    {'filter': {'OWNER_ID': 1}, 'select': ['ID']} -> filter[OWNER_ID]=1&select[0]=ID
+    Ссылки вида $result[...] оставляем без экранирования, иначе Битрикс24 их не подставит.
+    """
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    parts = []
+    for key, value in items:
+        full_key = f"{prefix}[{key}]" if prefix else str(key)
+        if isinstance(value, (dict, list, tuple)):
+            parts.extend(_encode_query(value, full_key))
+            continue
+        value = "" if value is None else str(value)
+        if not value.startswith("$result"):
+            value = quote(value, safe="")
+        parts.append(f"{quote(full_key, safe='[]')}={value}")
+    return parts
+
+
+def _build_command(method: str, params: dict) -> str:
+    """Собирает одну команду batch: 'crm.deal.get?id=1'."""
+    query = "&".join(_encode_query(params))
+    return f"{method}?{query}" if query else method
+
+
+def _activity_params(deal_id: int, responsible_id: int, subject: str, description: str) -> dict:
+    """Параметры для crm.activity.todo.add (дедлайн — конец текущего дня с запасом в 3 часа)."""
+    deadline_time = (datetime.now() + timedelta(hours=3)).strftime('%Y-%m-%dT23:59:59')
+    return {
+        "ownerTypeId": 2,
+        "ownerId": deal_id,
+        "responsibleId": responsible_id,
+        "deadline": deadline_time,
+        "title": subject,
+        "description": description,
+    }
+
+
+def _latest_activity_params(deal_id: int) -> dict:
+    """Параметры crm.activity.list: дела сделки, новые первыми (берется первое)."""
+    return {
+        'order': {"ID": "DESC"},
+        'filter': {"OWNER_TYPE_ID": 2, "OWNER_ID": deal_id},
+        'select': ["ID", "DESCRIPTION"],
+    }
+
+
+def _comment_params(deal_id: int, comment_text: str) -> dict:
+    """Параметры для crm.timeline.comment.add."""
+    return {'fields': {"ENTITY_ID": deal_id, "ENTITY_TYPE": "deal", "COMMENT": comment_text}}
+
+
+async def call_batch(commands: dict, halt: bool = False) -> dict | None:
+    """
+    Выполняет несколько методов одним запросом batch.
+    commands: {'имя': (метод, параметры), ...} — порядок выполнения совпадает с порядком ключей.
+    Возвращает {'result': {имя: результат}, 'errors': {имя: ошибка}} или None при сетевой ошибке.
+    При halt=True Битрикс24 прерывает пакет на первой ошибке.
     """
     if not BASE_URL:
         print("❌ Ошибка: URL вебхука для Битрикс24 не задан в .env")
         return None
+    if len(commands) > BATCH_MAX_COMMANDS:
+        raise ValueError(f"В одном batch допускается не более {BATCH_MAX_COMMANDS} команд, передано {len(commands)}")
 
-    # Формируем полный URL для метода crm.deal.list
-    method_url = f"{BASE_URL}crm.deal.list.json"
+    params = {
+        'halt': 1 if halt else 0,
+        'cmd': {name: _build_command(method, method_params) for name, (method, method_params) in commands.items()},
+    }
+    try:
+        data = await _post("batch", params)
+    except httpx.HTTPError as e:
+        print(f"❌ Ошибка при выполнении batch-запроса к Битрикс24 ({', '.join(commands)}): {e}")
+        return None
+
+    if 'result' not in data:
+        print("Ошибка batch-запроса к Битрикс24:", data)
+        return None
+
+    # Пустые коллекции PHP отдает списком, а не словарем
+    results = data['result'].get('result') or {}
+    errors = data['result'].get('result_error') or {}
+    if isinstance(results, list):
+        results = {}
+    if isinstance(errors, list):
+        errors = {}
+    for name, error in errors.items():
+        print(f"⚠️ Команда batch '{name}' завершилась ошибкой: {error}")
+    return {'result': results, 'errors': errors}
+
+
+async def get_deal_context(deal_id: int, include_activity: bool = False, deal: dict = None) -> dict | None:
+    """
+    Одним запросом получает сделку, ее контакт, ответственного менеджера
+    и (по запросу) последнее дело по сделке.
+    Если поля сделки уже известны (`deal`, например из локального снимка), сама сделка не запрашивается.
+    Контакт и менеджер, уже лежащие в кэше, повторно не запрашиваются.
+    Возвращает {'deal', 'contact', 'manager', 'activity'} или None, если сделку получить не удалось.
+    """
+    commands = {}
+    if deal is None:
+        commands['deal'] = ("crm.deal.get", {'id': deal_id})
+        known_contact_id, known_manager_id = _deal_links_cache.get(deal_id) or (None, None)
+        contact_ref, manager_ref = "$result[deal][CONTACT_ID]", "$result[deal][ASSIGNED_BY_ID]"
+    else:
+        known_contact_id, known_manager_id = parse_bitrix_id(deal.get("CONTACT_ID")), parse_bitrix_id(deal.get("ASSIGNED_BY_ID"))
+        contact_ref, manager_ref = known_contact_id, known_manager_id
+
+    # Если связи сделки уже известны и есть в кэше — обходимся без лишних команд
+    cached_contact = _contact_cache.get(known_contact_id) if known_contact_id else None
+    cached_manager = _user_cache.get(known_manager_id) if known_manager_id else None
+    if cached_contact is None and contact_ref:
+        commands['contact'] = ("crm.contact.get", {'id': contact_ref, 'select': ["NAME", "PHONE"]})
+    if cached_manager is None and manager_ref:
+        commands['manager'] = ("user.get", {'ID': manager_ref})
+    if include_activity:
+        commands['activity'] = ("crm.activity.list", _latest_activity_params(deal_id))
+
+    results = {}
+    if commands:
+        batch = await call_batch(commands)
+        if not batch or (deal is None and not batch['result'].get('deal')):
+            print(f"Ошибка при получении деталей сделки {deal_id} через batch.")
+            return None
+        results = batch['result']
+    if deal is None:
+        deal = results['deal']
+    contact_id = parse_bitrix_id(deal.get("CONTACT_ID"))
+    manager_id = parse_bitrix_id(deal.get("ASSIGNED_BY_ID"))
+    _deal_links_cache.set(deal_id, (contact_id, manager_id))
+
+    # user.get и crm.activity.list возвращают списки — берем первый элемент
+    if 'contact' in commands:
+        contact = results.get('contact') or None
+        if contact and contact_id:
+            _contact_cache.set(contact_id, contact)
+    elif contact_id == known_contact_id:
+        contact = cached_contact
+    else:
+        # Контакт у сделки сменился — догружаем нового отдельно
+        contact = await get_contact_details(contact_id) if contact_id else None
+
+    if 'manager' in commands:
+        managers = results.get('manager') or []
+        manager = managers[0] if managers else None
+        if manager and manager_id:
+            _user_cache.set(manager_id, manager)
+    elif manager_id == known_manager_id:
+        manager = cached_manager
+    else:
+        manager = await get_user_details(manager_id) if manager_id else None
+
+    activities = results.get('activity') or []
+    return {
+        'deal': deal,
+        'contact': contact,
+        'manager': manager,
+        'activity': activities[0] if activities else None,
+    }
+
+
+async def get_deal_contexts(deals: list[dict], include_activity: bool = False) -> dict[int, dict]:
+    """
+    Массовый вариант get_deal_context для кампаний: контакты, менеджеры и (по запросу) последние дела
+    сотен сделок за несколько batch-запросов. Контакты запрашиваются списками crm.contact.list
+    по 50 ID в команде, менеджеры — командой user.get на каждого, дела — командой на сделку.
+    Уже закэшированные контакты и менеджеры не запрашиваются, полученные кладутся в кэш.
+    Возвращает {deal_id: {'deal', 'contact', 'manager', 'activity'}}; при сетевой ошибке — RuntimeError.
+    """
+    links = {}
+    for deal in deals:
+        deal_id = int(deal["ID"])
+        links[deal_id] = (parse_bitrix_id(deal.get("CONTACT_ID")), parse_bitrix_id(deal.get("ASSIGNED_BY_ID")))
+        _deal_links_cache.set(deal_id, links[deal_id])
+
+    contacts, managers = {}, {}
+    for contact_id, manager_id in links.values():
+        if contact_id and contact_id not in contacts:
+            contacts[contact_id] = _contact_cache.get(contact_id)
+        if manager_id and manager_id not in managers:
+            managers[manager_id] = _user_cache.get(manager_id)
+
+    commands = {}
+    missing_contacts = sorted(contact_id for contact_id, contact in contacts.items() if contact is None)
+    for i in range(0, len(missing_contacts), LIST_PAGE_SIZE):
+        commands[f"contacts_{i}"] = ("crm.contact.list", {
+            'filter': {"ID": missing_contacts[i:i + LIST_PAGE_SIZE]},
+            'select': ["ID", "NAME", "PHONE"],
+        })
+    for manager_id in sorted(manager_id for manager_id, manager in managers.items() if manager is None):
+        commands[f"manager_{manager_id}"] = ("user.get", {'ID': manager_id})
+    if include_activity:
+        for deal_id in links:
+            commands[f"activity_{deal_id}"] = ("crm.activity.list", _latest_activity_params(deal_id))
+
+    results = {}
+    names = list(commands)
+    for i in range(0, len(names), BATCH_MAX_COMMANDS):
+        batch = await call_batch({name: commands[name] for name in names[i:i + BATCH_MAX_COMMANDS]})
+        if not batch:
+            raise RuntimeError(f"Не удалось получить контакты и менеджеров для {len(deals)} сделок")
+        results.update(batch['result'])
+
+    for name, value in results.items():
+        if name.startswith("contacts_"):
+            for contact in value or []:
+                contacts[int(contact["ID"])] = contact
+                _contact_cache.set(int(contact["ID"]), contact)
+        elif name.startswith("manager_") and value:
+            # user.get возвращает список
+            managers[int(name.removeprefix("manager_"))] = value[0]
+            _user_cache.set(int(name.removeprefix("manager_")), value[0])
+
+    contexts = {}
+    for deal in deals:
+        deal_id = int(deal["ID"])
+        contact_id, manager_id = links[deal_id]
+        activities = results.get(f"activity_{deal_id}") or []
+        contexts[deal_id] = {
+            'deal': deal,
+            'contact': contacts.get(contact_id),
+            'manager': managers.get(manager_id),
+            'activity': activities[0] if activities else None,
+        }
+    return contexts
+
+
+async def get_deals(limit: int = 5):
+    """
+    Получает 'limit' последних сделок из Битрикс24.
+    """
+    if not BASE_URL:
+        print("❌ Ошибка: URL вебхука для Битрикс24 не задан в .env")
+        return None
 
     # Параметры для запроса: сортируем по ID по убыванию, чтобы получить самые новые
     params = {
@@ -24,11 +331,7 @@ def get_deals(limit: int = 5):
     }
 
     try:
-        # Отправляем POST-запрос
-        response = requests.post(method_url, json=params)
-        response.raise_for_status()  # Вызовет ошибку, если HTTP-статус не 2xx
-
-        data = response.json()
+        data = await _post("crm.deal.list", params)
 
         if 'result' in data and data['result']:
             # API вернет страницу результатов, мы берем нужное количество
@@ -38,12 +341,38 @@ def get_deals(limit: int = 5):
             print("Ответ API:", data)
             return []
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"❌ Ошибка при запросе к API Битрикс24: {e}")
         return None
 
 
-def get_deal_details(deal_id: int):
+async def list_deals(filter: dict, select: list, start: int = 0) -> tuple[list, int | None] | None:
+    """
+    Получает одну страницу (до 50 сделок) из crm.deal.list, отсортированную по ID.
+    Возвращает (сделки, start_следующей_страницы) или None при ошибке.
+    """
+    if not BASE_URL:
+        print("❌ Ошибка: URL вебхука для Битрикс24 не задан в .env")
+        return None
+
+    params = {
+        'order': {"ID": "ASC"},
+        'filter': filter,
+        'select': select,
+        'start': start,
+    }
+    try:
+        data = await _post("crm.deal.list", params)
+        if 'result' not in data:
+            print("Ошибка при получении списка сделок:", data)
+            return None
+        return data['result'], data.get('next')
+    except httpx.HTTPError as e:
+        print(f"❌ Ошибка при запросе списка сделок: {e}")
+        return None
+
+
+async def get_deal_details(deal_id: int):
     """
     Получает детальную информацию о сделке по ее ID.
     """
@@ -51,25 +380,22 @@ def get_deal_details(deal_id: int):
         print("❌ Ошибка: URL вебхука для Битрикс24 не задан в .env")
         return None
 
-    method_url = f"{BASE_URL}crm.deal.get.json"
     params = {'id': deal_id}
 
     try:
-        response = requests.post(method_url, json=params)
-        response.raise_for_status()
-        data = response.json()
+        data = await _post("crm.deal.get", params)
 
         if 'result' in data:
             return data['result']
         else:
             print(f"Ошибка при получении деталей сделки {deal_id}:", data)
             return None
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Ошибка при запросе деталей сделки {deal_id}: {e}")
         return None
 
 
-def get_contact_details(contact_id: int):
+async def get_contact_details(contact_id: int):
     """
     Получает детальную информацию о контакте по его ID.
     Целенаправленно запрашивает имя и телефон.
@@ -77,57 +403,85 @@ def get_contact_details(contact_id: int):
     if not BASE_URL:
         return None
 
-    method_url = f"{BASE_URL}crm.contact.get.json"
+    cached = _contact_cache.get(contact_id)
+    if cached is not None:
+        return cached
+
     params = {
         'id': contact_id,
         'select': ["NAME", "PHONE"]  # Явно запрашиваем только нужные поля
     }
 
     try:
-        response = requests.post(method_url, json=params)
-        response.raise_for_status()
-        data = response.json()
-        return data.get('result')
-    except requests.exceptions.RequestException as e:
+        data = await _post("crm.contact.get", params)
+        contact = data.get('result')
+        if contact:
+            _contact_cache.set(contact_id, contact)
+        return contact
+    except httpx.HTTPError as e:
         print(f"Ошибка при запросе контакта {contact_id}: {e}")
         return None
 
 
-def get_user_details(user_id: int):
+async def get_user_details(user_id: int):
     """
     Получает информацию о пользователе (менеджере) по его ID.
     """
     if not BASE_URL:
         return None
 
-    method_url = f"{BASE_URL}user.get.json"
+    cached = _user_cache.get(user_id)
+    if cached is not None:
+        return cached
+
     params = {'ID': user_id}
     try:
-        response = requests.post(method_url, json=params)
-        response.raise_for_status()
-        data = response.json()
+        data = await _post("user.get", params)
 
         # Метод user.get возвращает массив, даже если пользователь один
         if 'result' in data and len(data['result']) > 0:
+            _user_cache.set(user_id, data['result'][0])
             return data['result'][0]
         else:
             # Более информативное сообщение, если пользователь не найден
             print(f"ПРЕДУПРЕЖДЕНИЕ: Ответ от Битрикс24 не содержит данных для пользователя {user_id}.")
             return None
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Ошибка при запросе пользователя {user_id}: {e}")
         return None
 
 
-def get_latest_activity_for_deal(deal_id: int):
+async def get_deal_stages(funnel_id: str):
+    """
+    Получает список стадий воронки (crm.dealcategory.stage.list) с кэшированием.
+    """
+    if not BASE_URL:
+        return None
+
+    cached = _stage_cache.get(str(funnel_id))
+    if cached is not None:
+        return cached
+
+    try:
+        data = await _post("crm.dealcategory.stage.list", {'id': funnel_id})
+        if data.get('result'):
+            _stage_cache.set(str(funnel_id), data['result'])
+            return data['result']
+        print(f"⚠️ Не удалось получить стадии воронки {funnel_id}:", data)
+        return None
+    except httpx.HTTPError as e:
+        print(f"Ошибка при запросе стадий воронки {funnel_id}: {e}")
+        return None
+
+
+async def get_latest_activity_for_deal(deal_id: int):
     """
     Получает самое последнее дело (активность), связанное со сделкой.
     """
     if not BASE_URL:
         return None
 
-    method_url = f"{BASE_URL}crm.activity.list.json"
     params = {
         'order': {"ID": "DESC"},  # Сортируем по ID по убыванию, чтобы самое новое было первым
         'filter': {
@@ -138,9 +492,7 @@ def get_latest_activity_for_deal(deal_id: int):
     }
 
     try:
-        response = requests.post(method_url, json=params)
-        response.raise_for_status()
-        data = response.json()
+        data = await _post("crm.activity.list", params)
 
         # API возвращает список, нам нужен только первый (самый новый) элемент
         if 'result' in data and data['result']:
@@ -149,12 +501,12 @@ def get_latest_activity_for_deal(deal_id: int):
             print(f"ПРЕДУПРЕЖДЕНИЕ: Для сделки {deal_id} не найдено связанных дел/активностей.")
             return None
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Ошибка при запросе дел для сделки {deal_id}: {e}")
         return None
 
 
-def create_activity_for_deal(deal_id: int, responsible_id: int, subject: str, description: str):
+async def create_activity_for_deal(deal_id: int, responsible_id: int, subject: str, description: str):
     """
     Создает новое универсальное дело (crm.activity.todo.add), привязанное к сделке.
     Возвращает ID созданного дела или None в случае ошибки.
@@ -162,21 +514,11 @@ def create_activity_for_deal(deal_id: int, responsible_id: int, subject: str, de
     if not BASE_URL:
         return None
 
-    method_url = f"{BASE_URL}crm.activity.todo.add.json"
-    deadline_time = (datetime.now() + timedelta(hours=3)).strftime('%Y-%m-%dT23:59:59')
-
-    params = {
-        "ownerTypeId": 2,
-        "ownerId": deal_id,
-        "responsibleId": responsible_id,
-        "deadline": deadline_time,
-        "title": subject,
-        "description": description,
-    }
+    params = _activity_params(deal_id, responsible_id, subject, description)
 
     try:
-        response = requests.post(method_url, json=params)
-        data = response.json()
+        # Статус не проверяем: текст ошибки Битрикс24 приходит в теле ответа
+        data = await _post("crm.activity.todo.add", params, raise_for_status=False)
 
         # --- ГЛАВНОЕ ИСПРАВЛЕНИЕ ЗДЕСЬ ---
         # Правильно извлекаем ID из ответа {'result': {'id': ...}}
@@ -190,43 +532,34 @@ def create_activity_for_deal(deal_id: int, responsible_id: int, subject: str, de
             print(f"⚠️ Не удалось создать дело. Ошибка: {error_detail}")
             return None
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"❌ Ошибка при создании дела для сделки {deal_id}: {e}")
         return None
 
 
-def add_comment_to_deal(deal_id: int, comment_text: str) -> bool:
+async def add_comment_to_deal(deal_id: int, comment_text: str) -> bool:
     """
     Добавляет комментарий в таймлайн сделки.
     Используется для логирования действий бота.
     """
     if not BASE_URL:
         return False
-    method_url = f"{BASE_URL}crm.timeline.comment.add.json"
-    params = {
-        'fields': {
-            "ENTITY_ID": deal_id,
-            "ENTITY_TYPE": "deal",
-            "COMMENT": comment_text
-        }
-    }
+    params = _comment_params(deal_id, comment_text)
     try:
-        response = requests.post(method_url, json=params)
-        response.raise_for_status()
+        await _post("crm.timeline.comment.add", params)
         print(f"✅ Комментарий успешно добавлен к сделке {deal_id}")
         return True
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"❌ Ошибка при добавлении комментария к сделке {deal_id}: {e}")
         return False
 
 
-def move_deal_to_stage(deal_id: int, stage_id: str) -> bool:
+async def move_deal_to_stage(deal_id: int, stage_id: str) -> bool:
     """
     Перемещает сделку на указанную стадию.
     """
     if not BASE_URL:
         return False
-    method_url = f"{BASE_URL}crm.deal.update.json"
     params = {
         'id': deal_id,
         'fields': {
@@ -234,45 +567,72 @@ def move_deal_to_stage(deal_id: int, stage_id: str) -> bool:
         }
     }
     try:
-        response = requests.post(method_url, json=params)
-        response.raise_for_status()
+        await _post("crm.deal.update", params)
         print(f"✅ Сделка {deal_id} успешно перемещена на стадию {stage_id}")
         return True
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"❌ Ошибка при перемещении сделки {deal_id}: {e}")
         return False
 
 
-def escalate_deal_to_manager(deal_id: int, manager_id: int, reason: str):
+async def add_comment_and_create_activity(deal_id: int, responsible_id: int, comment_text: str, subject: str, description: str) -> bool:
+    """
+    Добавляет комментарий в таймлайн и создает дело менеджеру одним batch-запросом.
     """
-    Выполняет полную процедуру эскалации:
+    commands = {}
+    if comment_text:
+        commands['comment'] = ("crm.timeline.comment.add", _comment_params(deal_id, comment_text))
+    if subject and description:
+        commands['activity'] = ("crm.activity.todo.add", _activity_params(deal_id, responsible_id, subject, description))
+    if not commands:
+        return True
+
+    batch = await call_batch(commands)
+    if not batch or batch['errors']:
+        print(f"❌ Не удалось записать комментарий/дело для сделки {deal_id}")
+        return False
+    print(f"✅ Комментарий и дело записаны в сделку {deal_id} одним запросом")
+    return True
+
+
+async def escalate_deal_to_manager(deal_id: int, manager_id: int, reason: str, comment_text: str = None) -> bool:
+    """
+    Выполняет полную процедуру эскалации одним batch-запросом:
     1. Создает дело для менеджера с причиной.
     2. Перемещает сделку на стадию 'Касание сегодня'.
+    3. (опционально) Добавляет комментарий в таймлайн.
+    Пакет прерывается на первой ошибке, поэтому без созданного дела сделка не перемещается.
+    Возвращает True, если дело для менеджера создано.
     """
     print(f"--- НАЧАЛО ПРОЦЕДУРЫ ЭСКАЛАЦИИ для сделки {deal_id} ---")
 
-    # 1. Формируем и создаем дело
+    # 1. Формируем дело
     subject = f"Эскалация от чат-бота: Сделка №{deal_id}"
     description = (f"Требуется внимание менеджера.\n"
                    f"Причина эскалации: {reason}")
-
-    activity_created = create_activity_for_deal(
-        deal_id=deal_id,
-        responsible_id=manager_id,
-        subject=subject,
-        description=description
-    )
-
-    if not activity_created:
-        print("   - ❗️ Не удалось создать дело для эскалации.")
-        # Можно добавить логику уведомления администратора
-        return
+    commands = {
+        'activity': ("crm.activity.todo.add", _activity_params(deal_id, manager_id, subject, description)),
+    }
 
     # 2. Перемещаем сделку (ID стадии берем из .env)
     escalation_stage_id = os.getenv("TOUCH_TODAY_STAGE_ID")
     if escalation_stage_id:
-        move_deal_to_stage(deal_id, escalation_stage_id)
+        commands['move'] = ("crm.deal.update", {'id': deal_id, 'fields': {"STAGE_ID": escalation_stage_id}})
     else:
         print("   - ❗️ Не удалось переместить сделку: переменная TOUCH_TODAY_STAGE_ID не найдена в .env")
 
-    print(f"--- ПРОЦЕДУРА ЭСКАЛАЦИИ ЗАВЕРШЕНА ---")
\ No newline at end of file
+    if comment_text:
+        commands['comment'] = ("crm.timeline.comment.add", _comment_params(deal_id, comment_text))
+
+    batch = await call_batch(commands, halt=True)
+    if not batch or not (batch['result'].get('activity') or {}).get('id'):
+        print("   - ❗️ Не удалось создать дело для эскалации.")
+        # Можно добавить логику уведомления администратора
+        return False
+
+    print(f"   - ✅ Дело {batch['result']['activity']['id']} создано для менеджера {manager_id}")
+    if batch['errors']:
+        print(f"   - ❗️ Часть шагов эскалации не выполнена: {', '.join(batch['errors'])}")
+
+    print(f"--- ПРОЦЕДУРА ЭСКАЛАЦИИ ЗАВЕРШЕНА ---")
+    return True
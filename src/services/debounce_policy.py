@@ -0,0 +1,131 @@
+# src/services/debounce_policy.py
+import os
+import re
+from dataclasses import dataclass
+
+# --- НАСТРОЙКИ ОЖИДАНИЯ СЕРИИ СООБЩЕНИЙ ---
+DEBOUNCE_POLICY = os.getenv("DEBOUNCE_POLICY", "adaptive")
+# Фиксированная задержка старой схемы (политика 'fixed')
+PENDING_DELAY_SECONDS = float(os.getenv("PENDING_DELAY_SECONDS", "10"))
+DEBOUNCE_MIN_SECONDS = float(os.getenv("DEBOUNCE_MIN_SECONDS", "2"))
+# Пауза для клиента, чья манера писать еще не известна (как у прежнего фиксированного окна)
+DEBOUNCE_DEFAULT_SECONDS = float(os.getenv("DEBOUNCE_DEFAULT_SECONDS", "10"))
+# Сколько максимум ждем с первого сообщения серии, как бы клиент ни продолжал писать
+DEBOUNCE_MAX_WAIT_SECONDS = float(os.getenv("DEBOUNCE_MAX_WAIT_SECONDS", "30"))
+
+# Короткие законченные ответы: "Да", "Нет, спасибо", "Ок"
+_SHORT_ANSWER_RE = re.compile(
+    r"^(да|нет|ок|окей|хорошо|спасибо|понятно|договорились|ага|угу|конечно|давайте|не надо)[\s,.!)]*"
+    r"(спасибо|да|нет)?[\s.!)]*$",
+    re.IGNORECASE,
+)
+
+
+@dataclass(frozen=True)
+class ChatTiming:
+    """Что известно о чате в момент прихода сообщения. Все величины — в секундах."""
+    since_last_message: float | None  # пауза после предыдущего сообщения клиента (даже уже обработанного)
+    burst_elapsed: float | None       # сколько прошло с первого необработанного сообщения серии
+    typical_gap: float | None         # выученная типичная пауза клиента внутри серии
+
+
+@dataclass(frozen=True)
+class DebounceDecision:
+    delay_seconds: float              # через сколько забрать диалог, если клиент больше ничего не пришлет
+    typical_gap: float | None         # обновленная типичная пауза (сохраняется в диалоге)
+
+
+class FixedDebounce:
+    """Прежнее поведение: одинаковая пауза после каждого сообщения для всех."""
+    name = "fixed"
+
+    def __init__(self, delay_seconds: float = PENDING_DELAY_SECONDS):
+        self.delay_seconds = delay_seconds
+
+    def decide(self, timing: ChatTiming, text: str) -> DebounceDecision:
+        return DebounceDecision(self.delay_seconds, timing.typical_gap)
+
+
+class AdaptiveDebounce:
+    """
+    Адаптивная пауза:
+    - законченное по виду сообщение ("Да", вопрос, фраза с точкой) забирается почти сразу;
+    - если клиент пишет серией, окно растягивается по его выученной паузе между сообщениями;
+    - общее ожидание с первого сообщения серии не превышает max_wait.
+    Типичная пауза учится экспоненциальным средним по реальным паузам внутри серий.
+    """
+    name = "adaptive"
+
+    def __init__(self, min_delay: float = DEBOUNCE_MIN_SECONDS, default_delay: float = DEBOUNCE_DEFAULT_SECONDS,
+                 max_wait: float = DEBOUNCE_MAX_WAIT_SECONDS, gap_multiplier: float = 2.0, learning_rate: float = 0.3):
+        self.min_delay = min_delay
+        self.default_delay = default_delay
+        self.max_wait = max_wait
+        self.gap_multiplier = gap_multiplier
+        self.learning_rate = learning_rate
+
+    @staticmethod
+    def looks_complete(text: str) -> bool:
+        text = (text or "").strip()
+        if not text:
+            return False
+        if _SHORT_ANSWER_RE.match(text):
+            return True
+        # Перечисление (двоеточие, запятая, "и" в конце) — клиент явно продолжает
+        if text.endswith((":", ",", "-", "—")) or text.lower().endswith((" и", " а также")):
+            return False
+        return text.endswith(("?", "!", ".", ")"))
+
+    def _learn(self, timing: ChatTiming) -> float | None:
+        gap = timing.since_last_message
+        # Учимся только на паузах внутри серии: если предыдущее сообщение уже обработано, между ними был
+        # ход бота, и пауза — время ответа клиента, а не набора. Паузы длиннее потолка ожидания — новая реплика
+        if gap is None or timing.burst_elapsed is None or gap > self.max_wait:
+            return timing.typical_gap
+        if timing.typical_gap is None:
+            return gap
+        return timing.typical_gap + self.learning_rate * (gap - timing.typical_gap)
+
+    def decide(self, timing: ChatTiming, text: str) -> DebounceDecision:
+        typical_gap = self._learn(timing)
+        in_burst = timing.burst_elapsed is not None
+
+        if typical_gap is not None:
+            # Ждем чуть дольше обычной паузы клиента, но не меньше минимальной
+            delay = max(self.min_delay, typical_gap * self.gap_multiplier)
+        else:
+            delay = self.default_delay
+
+        # Внутри серии законченность отдельного сообщения не важна: ждем обычную паузу клиента,
+        # и каждое новое сообщение продлевает окно
+        if self.looks_complete(text) and not in_burst:
+            # Законченное сообщение забираем быстро; клиента, который обычно дописывает, ждем его типичную паузу
+            delay = min(delay, max(self.min_delay, typical_gap or 0.0))
+
+        # Потолок общего ожидания с первого сообщения серии
+        elapsed = timing.burst_elapsed or 0.0
+        delay = max(0.0, min(delay, self.max_wait - elapsed))
+        return DebounceDecision(round(delay, 2), typical_gap)
+
+
+POLICIES = {
+    FixedDebounce.name: FixedDebounce,
+    AdaptiveDebounce.name: AdaptiveDebounce,
+}
+
+
+def register_policy(policy_class):
+    """Подключает свою политику: класс с атрибутом name и методом decide(timing, text)."""
+    POLICIES[policy_class.name] = policy_class
+    return policy_class
+
+
+_policy = None
+
+
+def get_policy():
+    """Политика, выбранная в DEBOUNCE_POLICY (создается один раз на процесс)."""
+    global _policy
+    if _policy is None:
+        _policy = POLICIES[DEBOUNCE_POLICY]()
+    return _policy
@@ -0,0 +1,38 @@
+# src/services/http_client.py
+import os
+import httpx
+
+# --- ОБЩИЕ HTTP-КЛИЕНТЫ ДЛЯ ВНЕШНИХ API ---
+# Один долгоживущий httpx.AsyncClient на каждый сервис: соединения (TCP/TLS)
+# переиспользуются между запросами, а event loop никогда не блокируется.
+HTTP_TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT_SECONDS", "15"))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "5"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10"))
+
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def get_client(name: str) -> httpx.AsyncClient:
+    """
+    Возвращает общий клиент для сервиса `name` ('bitrix', 'wazzup', ...).
+    Клиент создается при первом обращении и живет до close_all_clients().
+    """
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+        )
+        _clients[name] = client
+    return client
+
+
+async def close_all_clients():
+    """Закрывает все пулы соединений. Вызывается при остановке приложения."""
+    for name, client in list(_clients.items()):
+        await client.aclose()
+        _clients.pop(name, None)
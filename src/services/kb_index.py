@@ -0,0 +1,74 @@
+# src/services/kb_index.py
+import math
+import re
+from collections import Counter
+
+from utils import estimate_tokens
+
+# Слова короче не несут смысла для поиска ("и", "по", "на" ...)
+MIN_TERM_LENGTH = 3
+# Грубый стемминг для русского: отрезаем окончания, оставляя начало слова
+STEM_LENGTH = 6
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _terms(text: str) -> list[str]:
+    words = _WORD_RE.findall(text.lower().replace("ё", "е"))
+    return [word[:STEM_LENGTH] for word in words if len(word) >= MIN_TERM_LENGTH and not word.isdigit()]
+
+
+def _weights(counts: Counter, idf: dict) -> dict[str, float]:
+    # Сублинейный TF * IDF с L2-нормировкой, чтобы длинные блоки не выигрывали за счет размера
+    weights = {term: (1 + math.log(count)) * idf[term] for term, count in counts.items() if term in idf}
+    norm = math.sqrt(sum(w * w for w in weights.values()))
+    return {term: w / norm for term, w in weights.items()} if norm else {}
+
+
+class KnowledgeIndex:
+    """
+    Локальный TF-IDF индекс по блокам базы знаний. Строится один раз на версию библиотеки промптов
+    и после этого только читается, поэтому безопасен для параллельных диалогов.
+    """
+
+    def __init__(self, blocks: dict[str, str]):
+        self.blocks = dict(blocks)
+        self.tokens = {marker: estimate_tokens(text) for marker, text in self.blocks.items()}
+        # Название маркера (#ТАРИФЫ#) тоже участвует в поиске
+        doc_terms = {marker: Counter(_terms(f"{marker.strip('#').replace('_', ' ')} {text}")) for marker, text in self.blocks.items()}
+
+        doc_freq = Counter()
+        for counts in doc_terms.values():
+            doc_freq.update(counts.keys())
+        total = len(self.blocks)
+        self.idf = {term: math.log((total + 1) / (df + 1)) + 1 for term, df in doc_freq.items()}
+        self.vectors = {marker: _weights(counts, self.idf) for marker, counts in doc_terms.items()}
+
+    def search(self, query: str) -> list[tuple[str, float]]:
+        """Блоки, похожие на запрос, по убыванию косинусной близости."""
+        query_vector = _weights(Counter(_terms(query)), self.idf)
+        if not query_vector:
+            return []
+        scored = []
+        for marker, vector in self.vectors.items():
+            score = sum(weight * vector.get(term, 0.0) for term, weight in query_vector.items())
+            if score > 0:
+                scored.append((marker, score))
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored
+
+    def select(self, query: str, token_budget: int, min_score: float = 0.0) -> list[str]:
+        """
+        Маркеры самых релевантных блоков, суммарно укладывающихся в бюджет токенов.
+        Блок, который не влезает, пропускается — следующий по релевантности может оказаться короче.
+        """
+        selected, used = [], 0
+        for marker, score in self.search(query):
+            if score < min_score:
+                break
+            cost = self.tokens[marker]
+            if used + cost > token_budget:
+                continue
+            selected.append(marker)
+            used += cost
+        return selected
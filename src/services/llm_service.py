@@ -1,9 +1,14 @@
 # src/services/llm_service.py
 import os
 import json
+import time
+import hashlib
 import httpx
+from collections import OrderedDict
+from dataclasses import dataclass, replace
 from openai import AsyncOpenAI
 from services import prompt_service # Убедитесь, что prompt_service импортируется
+from utils import estimate_tokens
 
 # --- 1. КОНФИГУРАЦИЯ КЛИЕНТА ---
 # (Этот блок остается без изменений)
@@ -132,24 +137,140 @@ JSON_FORMAT_INSTRUCTION = """
         - `new_state`: "escalated".
         - `action`: "ESCALATE_TO_MANAGER", `action_params`: `comment_text`="Клиент просит связаться или негативит после 'касания'. Требуется внимание. Последнее сообщение: [ТЕКСТ ПОСЛЕДНЕГО СООБЩЕНИЯ]".
 """
-# --- 3. НОВАЯ УНИВЕРСАЛЬНАЯ ФУНКЦИЯ ---
+# --- 3. СБОРКА СИСТЕМНОГО ПРОМПТА ---
 
-async def get_bot_decision(conversation_history: list, system_prompt: str) -> dict | None:
+# Сколько токенов базы знаний можно добавить к промпту за один ход
+KB_TOKEN_BUDGET = int(os.getenv("KB_TOKEN_BUDGET", "1500"))
+# Блоки с меньшей близостью к запросу не добавляются даже при свободном бюджете
+KB_MIN_SCORE = float(os.getenv("KB_MIN_SCORE", "0.05"))
+# По скольким последним репликам ищем релевантные блоки
+KB_QUERY_MESSAGES = 3
+
+KB_SECTION_HEADER = (
+    "Ниже предоставлена дополнительная информация (база знаний), которую ты должен использовать для ответа на вопросы клиента. "
+    "Не упоминай базу знаний напрямую, просто используй факты из нее."
+)
+
+
+@dataclass(frozen=True)
+class CompiledPrompt:
+    """Системный промпт: статичный префикс для версии библиотеки и состояния + подобранные блоки базы знаний."""
+    version: str  # sha256 статичного префикса (первые 12 символов)
+    library_version: str
+    text: str
+    kb_markers: tuple = ()
+
+
+# Префиксы текущей версии библиотеки по состояниям диалога
+_compiled_prefixes: dict[str | None, CompiledPrompt] = {}
+_compiled_library_version: str | None = None
+
+# Статистика кеширования промпта OpenAI по версиям: {version: {'calls': ..., 'prompt_tokens': ..., 'cached_tokens': ...}}
+MAX_TRACKED_PROMPT_VERSIONS = 10
+prompt_cache_stats: OrderedDict[str, dict] = OrderedDict()
+
+
+def compile_prompt_prefix(snapshot: prompt_service.PromptSnapshot, state: str | None = None) -> CompiledPrompt:
+    """
+    Статичная часть промпта: общие блоки, JSON-инструкция и блоки состояния — именно в таком порядке,
+    чтобы самый длинный общий префикс был одинаковым для всех диалогов. Для одной версии библиотеки
+    и одного состояния текст всегда байт-в-байт одинаковый — это условие попадания в кеш OpenAI.
+    """
+    text = "\n\n".join(block for _, block in snapshot.core_blocks()) + JSON_FORMAT_INSTRUCTION
+    state_blocks = snapshot.state_blocks(state)
+    if state_blocks:
+        text += "\n\n" + "\n\n".join(block for _, block in state_blocks)
+    return CompiledPrompt(
+        version=hashlib.sha256(text.encode("utf-8")).hexdigest()[:12],
+        library_version=snapshot.version,
+        text=text,
+    )
+
+
+def _get_prompt_prefix(snapshot: prompt_service.PromptSnapshot, state: str | None) -> CompiledPrompt:
+    global _compiled_library_version
+    if _compiled_library_version != snapshot.version:
+        _compiled_prefixes.clear()
+        _compiled_library_version = snapshot.version
+    prefix = _compiled_prefixes.get(state)
+    if prefix is None:
+        prefix = _compiled_prefixes[state] = compile_prompt_prefix(snapshot, state)
+        print(f"🧩 Системный промпт для состояния '{state}' собран: версия {prefix.version}, ~{estimate_tokens(prefix.text)} токенов.")
+    return prefix
+
+
+def build_system_prompt(state: str | None = None, conversation_history: list | None = None) -> CompiledPrompt:
+    """
+    Промпт для конкретного хода: префикс состояния из кеша + блоки базы знаний,
+    подобранные по последним репликам в пределах KB_TOKEN_BUDGET. Динамическая часть всегда в конце.
+    """
+    snapshot = prompt_service.get_snapshot()
+    prefix = _get_prompt_prefix(snapshot, state)
+
+    query = " ".join(
+        msg["content"] for msg in (conversation_history or [])[-KB_QUERY_MESSAGES:]
+        if msg.get("role") in ("user", "system") and msg.get("content")
+    )
+    pinned = {marker for marker, _ in snapshot.state_blocks(state)}
+    markers = [m for m in snapshot.kb_index.select(query, KB_TOKEN_BUDGET, KB_MIN_SCORE) if m not in pinned]
+    if not markers:
+        return prefix
+
+    kb_text = "\n".join(f"\n--- ИНФОРМАЦИЯ ПО ТЕМЕ '{marker}' ---\n{snapshot.kb_blocks[marker]}" for marker in markers)
+    return replace(prefix, text=f"{prefix.text}\n\n{KB_SECTION_HEADER}\n{kb_text}", kb_markers=tuple(markers))
+
+
+def _record_prompt_usage(version: str, prompt_tokens: int, cached_tokens: int, latency_seconds: float):
+    counters = prompt_cache_stats.get(version)
+    if counters is None:
+        counters = prompt_cache_stats[version] = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "latency_seconds": 0.0}
+        while len(prompt_cache_stats) > MAX_TRACKED_PROMPT_VERSIONS:
+            prompt_cache_stats.popitem(last=False)
+    counters["calls"] += 1
+    counters["prompt_tokens"] += prompt_tokens
+    counters["cached_tokens"] += cached_tokens
+    counters["latency_seconds"] += latency_seconds
+
+
+def get_stats() -> dict:
+    """Размер промпта, доля кешированных входных токенов и время ответа по версиям статичного префикса."""
+    versions = {}
+    for version, counters in prompt_cache_stats.items():
+        total, calls = counters["prompt_tokens"], counters["calls"]
+        versions[version] = {
+            "calls": calls,
+            "cached_ratio": round(counters["cached_tokens"] / total, 3) if total else 0.0,
+            "avg_prompt_tokens": round(total / calls) if calls else 0,
+            "avg_latency_seconds": round(counters["latency_seconds"] / calls, 2) if calls else 0.0,
+        }
+    return {
+        "library_version": _compiled_library_version,
+        "compiled_prefixes": {str(state): prefix.version for state, prefix in _compiled_prefixes.items()},
+        "prompt_versions": versions,
+    }
+
+
+# --- 4. НОВАЯ УНИВЕРСАЛЬНАЯ ФУНКЦИЯ ---
+
+async def get_bot_decision(conversation_history: list, state: str | None = None, system_prompt: CompiledPrompt | None = None) -> dict | None:
     """
     Получает от LLM решение в формате JSON, включающее ответ, новое состояние и действие.
+    По умолчанию промпт собирается под текущее состояние диалога (`state`): для первого хода
+    сценария это команда запуска, например 'initiate_new_lot_dialog'.
     """
     if not client:
         print("❌ Ошибка: OpenAI клиент не инициализирован.")
         return None
 
-    full_system_prompt = system_prompt + JSON_FORMAT_INSTRUCTION
+    system_prompt = system_prompt or build_system_prompt(state, conversation_history)
 
     messages_for_llm = [
-        {"role": "system", "content": full_system_prompt}
+        {"role": "system", "content": system_prompt.text}
     ] + conversation_history
 
     try:
-        print(f"Запрос решения от LLM с {len(messages_for_llm)} сообщениями в контексте...")
+        print(f"Запрос решения от LLM с {len(messages_for_llm)} сообщениями в контексте (блоков базы знаний: {len(system_prompt.kb_markers)})...")
+        started = time.monotonic()
         response = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=messages_for_llm,
@@ -157,6 +278,7 @@ async def get_bot_decision(conversation_history: list, system_prompt: str) -> di
             response_format={"type": "json_object"}
         )
         
+        latency_seconds = time.monotonic() - started
         response_content = response.choices[0].message.content
         print(f"✅ LLM вернул решение: {response_content}")
 
@@ -166,13 +288,15 @@ async def get_bot_decision(conversation_history: list, system_prompt: str) -> di
         # Безопасно получаем кешированные токены, если они есть
         cached_tokens = 0
         if hasattr(usage, "prompt_tokens_details") and usage.prompt_tokens_details is not None:
-            cached_tokens = getattr(usage.prompt_tokens_details, "cached_tokens", 0)
+            cached_tokens = getattr(usage.prompt_tokens_details, "cached_tokens", 0) or 0
+        _record_prompt_usage(system_prompt.version, usage.prompt_tokens, cached_tokens, latency_seconds)
 
         print("\n--- 📊 Статистика по токенам ---")
         print(f"   - Всего использовано: {usage.total_tokens} токенов")
         print(f"   - Токены запроса (Input): {usage.prompt_tokens}")
         print(f"   - Токены ответа (Output): {usage.completion_tokens}")
         print(f"   - Кешированные токены (Input): {cached_tokens}")
+        print(f"   - Версия системного промпта: {system_prompt.version}")
         
         if usage.prompt_tokens > 0:
             cache_percent = (cached_tokens / usage.prompt_tokens) * 100
@@ -192,4 +316,41 @@ async def get_bot_decision(conversation_history: list, system_prompt: str) -> di
             "action_params": {
                 "comment_text": f"Критическая ошибка при обращении к OpenAI: {e}. Требуется срочное вмешательство."
             }
-        }
\ No newline at end of file
+        }
+
+# --- 5. СЖАТИЕ СТАРОЙ ЧАСТИ ИСТОРИИ ---
+
+SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "400"))
+
+SUMMARY_INSTRUCTION = (
+    "Ты ведешь краткое досье переписки менеджера с клиентом. Тебе дано текущее краткое содержание "
+    "и следующие сообщения переписки. Обнови краткое содержание так, чтобы в нем остались только факты, "
+    "важные для продолжения разговора: имена, должники, договоренности, обещания, вопросы без ответа, настроение клиента. "
+    "Пиши по-русски, сжато, без вступлений. Верни только обновленный текст."
+)
+
+
+async def summarize_history(previous_summary: str | None, messages: list) -> str | None:
+    """Дополняет краткое содержание диалога новыми сообщениями. Возвращает None при ошибке."""
+    if not client:
+        return None
+
+    transcript = "\n".join(
+        f"{'Клиент' if msg.get('role') == 'user' else 'Менеджер' if msg.get('role') == 'assistant' else 'Система'}: {msg.get('content')}"
+        for msg in messages
+    )
+    try:
+        response = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": SUMMARY_INSTRUCTION},
+                {"role": "user", "content": f"Текущее краткое содержание:\n{previous_summary or '(пусто)'}\n\nНовые сообщения:\n{transcript}"},
+            ],
+            temperature=0.2,
+            max_tokens=SUMMARY_MAX_TOKENS,
+        )
+        summary = (response.choices[0].message.content or "").strip()
+        return summary or None
+    except Exception as e:
+        print(f"❌ Ошибка при сжатии истории диалога: {e}")
+        return None
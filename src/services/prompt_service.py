@@ -3,19 +3,111 @@
 import os
 import time
 import re
+import json
+import asyncio
+import hashlib
+from dataclasses import dataclass
+from types import MappingProxyType
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from pathlib import Path
 
+from services.kb_index import KnowledgeIndex
+
 # --- Настройки ---
 MAIN_DOC_ID = os.getenv("GOOGLE_DOC_ID", "1b_EfaKe-iqZG4beYI9lVrCwj2tOMDvK5WqaevJopXVM") 
 KNOWLEDGE_BASE_DOC_ID = os.getenv("KNOWLEDGE_BASE_DOC_ID", "1TE1PJWGfSFksvcuh1Nyova91BaeegRlUBmVVeBAZ8iw")
 SCOPES = ['https://www.googleapis.com/auth/documents.readonly']
 SERVICE_ACCOUNT_FILE = Path(__file__).parent.parent.parent / 'credentials.json'
-CACHE_TTL_SECONDS = 120
+# Как часто фоновая задача перечитывает документы
+PROMPT_REFRESH_INTERVAL_SECONDS = int(os.getenv("PROMPT_REFRESH_INTERVAL_SECONDS", "120"))
+# Последний удачно загруженный снимок — для холодного старта без Google
+PROMPT_SNAPSHOT_FILE = Path(os.getenv("PROMPT_SNAPSHOT_FILE", Path(__file__).parent.parent.parent / 'prompt_snapshot.json'))
+
+DEFAULT_PROMPT_LIBRARY = {"#ROLE_AND_STYLE#": "Ты - вежливый ассистент."}
+
+# Блоки, нужные только в определенных состояниях диалога (или командах запуска сценария).
+# По умолчанию — блоки сценариев из llm_service: приветствие, должники, новый лот, касание.
+# Кроме того, блок с именем состояния (#AWAITING_NEW_LOT_RESPONSE#, #INITIATE_DIALOG#) всегда относится к нему.
+# Блоки основного документа, не закрепленные за состоянием, отправляются всегда.
+DEFAULT_PROMPT_STATE_BLOCKS = {
+    "initiate_dialog": ["#WELCOME#"],
+    "awaiting_initial_response": ["#WELCOME#"],
+    "awaiting_debtor_clarification": ["#DEBTORS#"],
+    "awaiting_debtor_details": ["#DEBTORS#"],
+    "initiate_new_lot_dialog": ["#NEW_LOT#"],
+    "awaiting_new_lot_response": ["#NEW_LOT#"],
+    "initiate_touch_today_dialog": ["#TOUCH_TODAY#"],
+    "awaiting_touch_today_response": ["#TOUCH_TODAY#"],
+}
+# Переопределение карты в формате JSON: {"awaiting_new_lot_response": ["#NEW_LOT#"], ...}
+PROMPT_STATE_BLOCKS: dict[str, list[str]] = json.loads(os.getenv("PROMPT_STATE_BLOCKS", "null")) or DEFAULT_PROMPT_STATE_BLOCKS
+# Состояния и команды запуска, для которых работает соглашение об имени блока
+PROMPT_STATES = (
+    "initiate_dialog", "initiate_new_lot_dialog", "initiate_touch_today_dialog",
+    "awaiting_initial_response", "awaiting_debtor_clarification", "awaiting_debtor_details",
+    "awaiting_new_lot_response", "awaiting_touch_today_response",
+    "general_conversation", "scenario_complete", "escalated",
+)
+
+
+def _state_markers(state: str | None) -> list[str]:
+    """Маркеры блоков состояния: по карте PROMPT_STATE_BLOCKS и по соглашению #ИМЯ_СОСТОЯНИЯ#."""
+    if not state:
+        return []
+    markers = list(PROMPT_STATE_BLOCKS.get(state, []))
+    named = f"#{state.upper()}#"
+    return markers if named in markers else markers + [named]
+
+
+_STATE_SCOPED_MARKERS = {marker for state in {*PROMPT_STATES, *PROMPT_STATE_BLOCKS} for marker in _state_markers(state)}
+
+
+@dataclass(frozen=True)
+class PromptSnapshot:
+    """Неизменяемая версия библиотеки промптов. Заменяется целиком, поэтому читатели всегда видят согласованный набор."""
+    main_blocks: MappingProxyType
+    kb_blocks: MappingProxyType
+    library: MappingProxyType
+    loaded_at: float
+    source: str  # 'google' | 'disk' | 'default'
+    version: str  # хэш содержимого: одинаковые документы дают одинаковую версию
+
+    kb_index: KnowledgeIndex  # поиск по блокам базы знаний, которых нет в основном документе
 
-_cached_prompt_library = None
-_cache_timestamp = 0
+    def core_blocks(self) -> list[tuple[str, str]]:
+        """
+        Блоки основного документа, которые нужны в любом состоянии, в порядке следования в документе.
+        Порядок не зависит от того, как собирался словарь, поэтому текст стабилен для кеша OpenAI.
+        """
+        return [(marker, self.library[marker]) for marker in self.main_blocks if marker not in _STATE_SCOPED_MARKERS]
+
+    def state_blocks(self, state: str | None) -> list[tuple[str, str]]:
+        """Блоки, закрепленные за состоянием диалога (PROMPT_STATE_BLOCKS или блок с именем состояния)."""
+        return [(marker, self.library[marker]) for marker in _state_markers(state) if marker in self.library]
+
+
+def _make_snapshot(main_blocks: dict, kb_blocks: dict, loaded_at: float, source: str) -> PromptSnapshot:
+    # Блоки базы знаний перекрывают одноименные блоки основного документа, как и раньше
+    content = json.dumps([list(main_blocks.items()), sorted(kb_blocks.items())], ensure_ascii=False)
+    return PromptSnapshot(
+        main_blocks=MappingProxyType(dict(main_blocks)),
+        kb_blocks=MappingProxyType(dict(kb_blocks)),
+        library=MappingProxyType({**main_blocks, **kb_blocks}),
+        loaded_at=loaded_at,
+        source=source,
+        version=hashlib.sha256(content.encode("utf-8")).hexdigest()[:12],
+        kb_index=KnowledgeIndex({marker: text for marker, text in kb_blocks.items() if marker not in main_blocks}),
+    )
+
+
+_snapshot: PromptSnapshot | None = None
+
+stats = {
+    "refreshes": 0,
+    "refresh_failures": 0,
+    "last_refresh_seconds": None,
+}
 
 def _get_text_from_element(element):
     """Извлекает чистый текст из элемента Google Doc."""
@@ -56,14 +148,17 @@ def _get_text_from_cell(cell: dict) -> str:
                 cell_text += _get_text_from_element(element)
     return cell_text.replace('\n', ' ') # Убираем переносы строк внутри ячейки
 
-def _read_and_parse_doc(document_id: str) -> dict:
+def _build_docs_service():
+    creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+    return build('docs', 'v1', credentials=creds)
+
+def _read_and_parse_doc(document_id: str, service=None) -> dict:
     """Читает и парсит ОДИН Google Doc, включая таблицы."""
     if not document_id: return {}
         
     print(f"Читаю Google Doc с ID: ...{document_id[-10:]}")
     try:
-        creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-        service = build('docs', 'v1', credentials=creds)
+        service = service or _build_docs_service()
         document = service.documents().get(documentId=document_id).execute()
         content = document.get('body').get('content')
         
@@ -97,28 +192,112 @@ def _read_and_parse_doc(document_id: str) -> dict:
         return {}
 
 
+def _load_from_google() -> tuple[dict, dict]:
+    """Блокирующее чтение обоих документов. Вызывается только из отдельного потока."""
+    try:
+        service = _build_docs_service()
+    except Exception as e:
+        print(f"❌ ОШИБКА при подключении к Google Docs API: {e}")
+        return {}, {}
+    return _read_and_parse_doc(MAIN_DOC_ID, service), _read_and_parse_doc(KNOWLEDGE_BASE_DOC_ID, service)
+
+
+def _save_snapshot_to_disk(snapshot: PromptSnapshot):
+    data = {
+        "main_blocks": dict(snapshot.main_blocks),
+        "kb_blocks": dict(snapshot.kb_blocks),
+        "loaded_at": snapshot.loaded_at,
+    }
+    # Свой временный файл у каждого процесса: воркеры могут сохранять снимок одновременно
+    tmp_path = PROMPT_SNAPSHOT_FILE.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        tmp_path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        # Атомарная замена: при падении посреди записи на диске останется прежний снимок
+        os.replace(tmp_path, PROMPT_SNAPSHOT_FILE)
+    except OSError as e:
+        print(f"⚠️ Не удалось сохранить снимок промптов в {PROMPT_SNAPSHOT_FILE}: {e}")
+
+
+def _load_snapshot_from_disk() -> PromptSnapshot | None:
+    try:
+        data = json.loads(PROMPT_SNAPSHOT_FILE.read_text(encoding="utf-8"))
+        snapshot = _make_snapshot(data["main_blocks"], data["kb_blocks"], data["loaded_at"], "disk")
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        print(f"⚠️ Снимок промптов на диске поврежден ({e}), игнорирую.")
+        return None
+    if not snapshot.library:
+        return None
+    print(f"📄 Библиотека промптов загружена из локального снимка. Блоков: {len(snapshot.library)}")
+    return snapshot
+
+
+def get_snapshot() -> PromptSnapshot:
+    """
+    Текущая версия библиотеки промптов. Никогда не ходит в сеть:
+    до первой загрузки из Google отдает снимок с диска, а если его нет — аварийный промпт.
+    """
+    global _snapshot
+    if _snapshot is None:
+        _snapshot = _load_snapshot_from_disk() or _make_snapshot(DEFAULT_PROMPT_LIBRARY, {}, 0, "default")
+    return _snapshot
+
+
 def get_prompt_library():
-    """Читает Основной Промпт и Базу Знаний, объединяет их и кэширует."""
-    # ... (Эта функция остается БЕЗ ИЗМЕНЕНИЙ!)
-    global _cached_prompt_library, _cache_timestamp
-    if _cached_prompt_library and (time.time() - _cache_timestamp < CACHE_TTL_SECONDS):
-        return _cached_prompt_library
-    print("Кэш библиотеки промптов устарел, обновляю из Google Docs...")
-    
-    merged_library = {}
-    main_prompts = _read_and_parse_doc(MAIN_DOC_ID)
-    merged_library.update(main_prompts)
-    kb_prompts = _read_and_parse_doc(KNOWLEDGE_BASE_DOC_ID)
-    merged_library.update(kb_prompts)
-
-    if not merged_library:
-        print("❌ Не удалось загрузить ни одного блока промптов.")
-        if _cached_prompt_library:
-            print("⚠️ Возвращаю старую версию библиотеки из кэша.")
-            return _cached_prompt_library
-        return {"#ROLE_AND_STYLE#": "Ты - вежливый ассистент."}
-
-    print(f"✅ Библиотека промптов успешно загружена. Всего найдено блоков: {len(merged_library)}")
-    _cached_prompt_library = merged_library
-    _cache_timestamp = time.time()
-    return merged_library
\ No newline at end of file
+    """Словарь блоков промптов {маркер: текст} (только для чтения) из текущего снимка."""
+    return get_snapshot().library
+
+
+async def refresh_prompt_library() -> bool:
+    """
+    Перечитывает документы в отдельном потоке и атомарно подменяет снимок.
+    Если документ не прочитался, его блоки берутся из предыдущего снимка. Возвращает True, если содержимое изменилось.
+    """
+    global _snapshot
+    started = time.monotonic()
+    main_blocks, kb_blocks = await asyncio.to_thread(_load_from_google)
+    stats["last_refresh_seconds"] = round(time.monotonic() - started, 2)
+
+    previous = get_snapshot()
+    if previous.source != "default":
+        main_blocks = main_blocks or dict(previous.main_blocks)
+        kb_blocks = kb_blocks or dict(previous.kb_blocks)
+
+    if not main_blocks and not kb_blocks:
+        stats["refresh_failures"] += 1
+        print("❌ Не удалось загрузить ни одного блока промптов. Продолжаю работать со старой версией.")
+        return False
+
+    # Индекс базы знаний строится вместе со снимком, вне event loop
+    snapshot = await asyncio.to_thread(_make_snapshot, main_blocks, kb_blocks, time.time(), "google")
+    changed = snapshot.version != previous.version
+    _snapshot = snapshot
+    stats["refreshes"] += 1
+    if changed:
+        print(f"✅ Библиотека промптов обновлена. Всего блоков: {len(snapshot.library)}")
+        await asyncio.to_thread(_save_snapshot_to_disk, snapshot)
+    return changed
+
+
+async def run_prompt_refresher():
+    """Фоновая задача: периодически обновляет библиотеку промптов, не задерживая обработку диалогов."""
+    print(f"🚀 Фоновое обновление промптов запущено! Интервал: {PROMPT_REFRESH_INTERVAL_SECONDS} с")
+    while True:
+        try:
+            await refresh_prompt_library()
+        except Exception as e:
+            stats["refresh_failures"] += 1
+            print(f"❌ Ошибка при обновлении библиотеки промптов: {e}")
+        await asyncio.sleep(PROMPT_REFRESH_INTERVAL_SECONDS)
+
+
+def get_stats() -> dict:
+    snapshot = get_snapshot()
+    return {
+        **stats,
+        "source": snapshot.source,
+        "version": snapshot.version,
+        "blocks": len(snapshot.library),
+        "age_seconds": round(time.time() - snapshot.loaded_at) if snapshot.loaded_at else None,
+    }
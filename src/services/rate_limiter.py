@@ -0,0 +1,244 @@
+# src/services/rate_limiter.py
+"""
+Общий для всех процессов лимит запросов к внешним API — "ведро токенов" в Postgres (rate_limit_buckets).
+Через него проходят все вызовы bitrix_service._post и wazzup_service.send_message.
+Вызов сверх лимита не падает, а ждет своей очереди; если сервис все же ответил
+"слишком много запросов", пауза ставится всем процессам сразу и вызов повторяется.
+Для Битрикс24 скорость дополнительно снижается по подсказке time.operating из ответов.
+Токены берутся из БД блоками (по числу ожидающих вызовов процесса), поэтому под нагрузкой
+один запрос к БД обслуживает несколько вызовов. Если БД недоступна, работает локальное ведро процесса.
+"""
+import os
+import time
+import asyncio
+from collections import deque
+
+from database import db_service
+from database.db import AsyncSessionLocal
+
+# --- НАСТРОЙКИ ЛИМИТОВ ---
+# (запросов в секунду, сколько запросов можно сделать подряд без пауз)
+# Битрикс24 пропускает ~2 запроса в секунду на портал; часть запаса оставляем другим интеграциям
+RATE_LIMITS = {
+    "bitrix": (float(os.getenv("BITRIX_RATE_LIMIT_PER_SECOND", "2")), float(os.getenv("BITRIX_RATE_LIMIT_BURST", "10"))),
+    "wazzup": (float(os.getenv("WAZZUP_RATE_LIMIT_PER_SECOND", "10")), float(os.getenv("WAZZUP_RATE_LIMIT_BURST", "20"))),
+    # Рассылки кампаний: WhatsApp-канал не должен отправлять сотни первых сообщений разом
+    "wazzup_campaign": (float(os.getenv("CAMPAIGN_SENDS_PER_MINUTE", "20")) / 60, 1.0),
+}
+# Сколько токенов процесс берет из БД за один запрос (не больше, чем вызовов ждет в этот момент).
+# Рассылки кампаний расписываются поштучно: лишний токен сдвинул бы расписание всех процессов.
+RATE_LIMIT_BLOCK_SIZES = {
+    "bitrix": int(os.getenv("BITRIX_RATE_LIMIT_BLOCK", "5")),
+    "wazzup": int(os.getenv("WAZZUP_RATE_LIMIT_BLOCK", "10")),
+    "wazzup_campaign": 1,
+}
+# Неиспользованный токен блока, время которого прошло больше чем на столько секунд, выбрасываем:
+# иначе после простоя он добавился бы к полному ведру и превысил бы допустимую пачку запросов
+RATE_LIMIT_SLOT_TTL_SECONDS = 1.0
+# Пауза после отказа сервиса по лимиту: растет вдвое с каждым отказом подряд, но не больше максимума
+RATE_LIMIT_BACKOFF_SECONDS = float(os.getenv("RATE_LIMIT_BACKOFF_SECONDS", "2"))
+RATE_LIMIT_MAX_BACKOFF_SECONDS = float(os.getenv("RATE_LIMIT_MAX_BACKOFF_SECONDS", "60"))
+# Сколько вызов ждет повторов после отказов. Дольше — задача очереди возвращается в очередь
+# (RateLimitWaitExceeded), а не держит аренду: меньше JOBS_LEASE_SECONDS
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("RATE_LIMIT_MAX_WAIT_SECONDS", "240"))
+# Битрикс24 ограничивает суммарное время выполнения каждого метода: 480 с за 10 минут
+BITRIX_OPERATING_LIMIT_SECONDS = float(os.getenv("BITRIX_OPERATING_LIMIT_SECONDS", "480"))
+# Как часто множитель скорости записывается в БД, даже если он не изменился (для других процессов),
+# и не чаще какого интервала записывается его изменение
+RATE_FACTOR_SYNC_SECONDS = 60
+RATE_FACTOR_MIN_WRITE_SECONDS = 5
+
+stats = {
+    name: {
+        "calls": 0,
+        "waited": 0,              # вызовы, которые ждали своей очереди
+        "wait_seconds_total": 0.0,
+        "max_wait_seconds": 0.0,
+        "db_round_trips": 0,      # запросы к БД за блоками токенов
+        "expired_tokens": 0,      # токены блока, которые не понадобились вовремя
+        "rejected": 0,            # ответы сервиса "слишком много запросов" (вызов повторен)
+        "db_errors": 0,           # БД недоступна — вызов прошел через локальное ведро процесса
+        "rate_factor": 1.0,
+    }
+    for name in RATE_LIMITS
+}
+
+
+class RateLimitWaitExceeded(Exception):
+    """Сервис отклоняет вызовы по лимиту дольше RATE_LIMIT_MAX_WAIT_SECONDS — задача будет повторена очередью."""
+
+
+class _LocalBucket:
+    """Ведро токенов одного процесса — запасной лимит, пока общее ведро в БД недоступно."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, rate_factor: float):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate * rate_factor)
+        self.updated_at = now
+
+    def take(self, rate_factor: float) -> float:
+        self._refill(rate_factor)
+        self.tokens -= 1
+        effective_rate = self.rate * rate_factor
+        return -self.tokens / effective_rate if self.tokens < 0 and effective_rate > 0 else 0.0
+
+    def delay(self, seconds: float, rate_factor: float):
+        self._refill(rate_factor)
+        self.tokens = min(self.tokens, -seconds * self.rate * rate_factor)
+
+
+# Полученные из БД, но еще не выданные токены процесса: моменты (time.monotonic), с которых по ним можно звонить
+_slots: dict[str, deque] = {name: deque() for name in RATE_LIMITS}
+_locks: dict[str, asyncio.Lock] = {}
+# Сколько вызовов процесса сейчас ждут токен — столько и берем из БД за раз
+_demand: dict[str, int] = {name: 0 for name in RATE_LIMITS}
+_local_buckets = {name: _LocalBucket(rate, capacity) for name, (rate, capacity) in RATE_LIMITS.items()}
+_db_unavailable: set[str] = set()
+
+# Последняя подсказка time.operating по каждому методу Битрикс24: метод -> (operating, operating_reset_at)
+_bitrix_operating: dict[str, tuple[float, float]] = {}
+_factor_synced_at = 0.0
+_synced_factor = 1.0
+
+
+def get_stats() -> dict:
+    return {
+        name: {
+            **counters,
+            "rate_per_second": RATE_LIMITS[name][0],
+            "burst": RATE_LIMITS[name][1],
+            "block_size": RATE_LIMIT_BLOCK_SIZES[name],
+            "wait_seconds_total": round(counters["wait_seconds_total"], 2),
+            "max_wait_seconds": round(counters["max_wait_seconds"], 2),
+        }
+        for name, counters in stats.items()
+    }
+
+
+def _next_slot(name: str) -> float | None:
+    slots = _slots[name]
+    stale_before = time.monotonic() - RATE_LIMIT_SLOT_TTL_SECONDS
+    while slots and slots[0] < stale_before:
+        slots.popleft()
+        stats[name]["expired_tokens"] += 1
+    return slots.popleft() if slots else None
+
+
+async def _refill_slots(name: str):
+    """Берет блок токенов из общего ведра, а если БД недоступна — один токен из локального."""
+    rate, capacity = RATE_LIMITS[name]
+    counters = stats[name]
+    count = max(1, min(RATE_LIMIT_BLOCK_SIZES[name], _demand[name]))
+    try:
+        async with AsyncSessionLocal() as db:
+            waits = await db_service.take_rate_limit_tokens(db, name, rate, capacity, count)
+        counters["db_round_trips"] += 1
+        if name in _db_unavailable:
+            _db_unavailable.discard(name)
+            print(f"✅ Общий лимит запросов '{name}' снова доступен.")
+    except Exception as e:
+        counters["db_errors"] += 1
+        if name not in _db_unavailable:
+            _db_unavailable.add(name)
+            print(f"⚠️ Общий лимит запросов '{name}' недоступен ({e}), работает локальный лимит процесса.")
+        waits = [_local_buckets[name].take(counters["rate_factor"])]
+    now = time.monotonic()
+    _slots[name].extend(now + wait for wait in waits)
+
+
+async def reserve(name: str) -> float:
+    """
+    Занимает место в очереди лимита `name`, не дожидаясь его: возвращает, через сколько секунд
+    можно делать вызов. Так кампания расписывает отправки по времени, а не спит сама.
+    """
+    counters = stats[name]
+    counters["calls"] += 1
+    _demand[name] += 1
+    try:
+        async with _locks.setdefault(name, asyncio.Lock()):
+            slot = _next_slot(name)
+            if slot is None:
+                await _refill_slots(name)
+                slot = _next_slot(name)
+    finally:
+        _demand[name] -= 1
+    wait = max(0.0, slot - time.monotonic()) if slot is not None else 0.0
+    if wait > 0:
+        counters["waited"] += 1
+        counters["wait_seconds_total"] += wait
+        counters["max_wait_seconds"] = max(counters["max_wait_seconds"], wait)
+    return wait
+
+
+async def acquire(name: str):
+    """Ждет, пока вызов к сервису `name` уложится в лимит."""
+    wait = await reserve(name)
+    if wait > 0:
+        await asyncio.sleep(wait)
+
+
+async def back_off(name: str, seconds: float = None, rejections: int = 1, waiting_since: float = None):
+    """
+    Сервис отклонил вызов по лимиту: ставим общую паузу всем процессам.
+    Без подсказки сервиса (`seconds`) пауза растет с числом отказов подряд (`rejections`).
+    Если вызов ждет повторов с `waiting_since` (time.monotonic) дольше RATE_LIMIT_MAX_WAIT_SECONDS,
+    выбрасывает RateLimitWaitExceeded — задача очереди будет повторена позже.
+    """
+    if seconds is None:
+        seconds = min(RATE_LIMIT_BACKOFF_SECONDS * 2 ** (rejections - 1), RATE_LIMIT_MAX_BACKOFF_SECONDS)
+    counters = stats[name]
+    counters["rejected"] += 1
+    if waiting_since is not None and time.monotonic() - waiting_since + seconds > RATE_LIMIT_MAX_WAIT_SECONDS:
+        raise RateLimitWaitExceeded(f"'{name}' отклоняет запросы по лимиту дольше {RATE_LIMIT_MAX_WAIT_SECONDS:.0f} с")
+    print(f"⏳ '{name}' отклонил запрос по лимиту, пауза {seconds} с для всех процессов.")
+    # Токены, взятые до отказа, больше не годятся
+    _slots[name].clear()
+    _local_buckets[name].delay(seconds, counters["rate_factor"])
+    try:
+        async with AsyncSessionLocal() as db:
+            await db_service.delay_rate_limit_bucket(db, name, seconds)
+    except Exception as e:
+        counters["db_errors"] += 1
+        print(f"⚠️ Не удалось записать паузу лимита '{name}': {e}")
+
+
+async def observe_bitrix_time(method: str, time_info: dict):
+    """
+    Подстраивает скорость под нагрузку на портал по блоку time ответа Битрикс24.
+    Пока любой метод израсходовал меньше половины бюджета operating, скорость полная,
+    дальше она линейно снижается до 10% у самого предела.
+    """
+    global _factor_synced_at, _synced_factor
+    operating = time_info.get("operating")
+    if operating is None:
+        return
+    now = time.time()
+    _bitrix_operating[method] = (float(operating), float(time_info.get("operating_reset_at") or now + 600))
+    for known_method, (_, reset_at) in list(_bitrix_operating.items()):
+        if reset_at <= now:
+            del _bitrix_operating[known_method]
+    usage = max((spent for spent, _ in _bitrix_operating.values()), default=0.0) / BITRIX_OPERATING_LIMIT_SECONDS
+    factor = round(min(1.0, max(0.1, 2 * (1 - usage))), 1)
+
+    counters = stats["bitrix"]
+    if factor != counters["rate_factor"]:
+        print(f"⚙️ Скорость запросов к Битрикс24: x{factor} (operating {usage:.0%} от лимита).")
+        counters["rate_factor"] = factor
+    # В БД пишем редко: изменение — не чаще RATE_FACTOR_MIN_WRITE_SECONDS, подтверждение — раз в RATE_FACTOR_SYNC_SECONDS
+    since_sync = now - _factor_synced_at
+    if since_sync < (RATE_FACTOR_MIN_WRITE_SECONDS if factor != _synced_factor else RATE_FACTOR_SYNC_SECONDS):
+        return
+    _factor_synced_at = now
+    try:
+        async with AsyncSessionLocal() as db:
+            await db_service.set_rate_limit_factor(db, "bitrix", factor)
+        _synced_factor = factor
+    except Exception as e:
+        counters["db_errors"] += 1
+        print(f"⚠️ Не удалось обновить скорость лимита Битрикс24: {e}")
@@ -1,13 +1,24 @@
 # src/services/wazzup_service.py
 import os
-import requests
+import time
+import httpx
+
+from services.http_client import get_client
+from services import rate_limiter
 
 # Загружаем URL, ключ и ID канала из .env
 API_URL = os.getenv("WAZZUP_API_URL")
 API_KEY = os.getenv("WAZZUP_API_KEY")
 CHANNEL_ID = os.getenv("WAZZUP_CHANNEL_ID") # <-- Новая переменная
 
-def send_message(phone_number: str, text: str) -> bool:
+def _retry_after(response: httpx.Response) -> float | None:
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+async def send_message(phone_number: str, text: str) -> bool:
     """
     Универсальная функция для отправки текстового сообщения через Wazzup.
     """
@@ -33,14 +44,23 @@ def send_message(phone_number: str, text: str) -> bool:
 
     try:
         print(f"Отправка сообщения на номер {phone_number} через канал {CHANNEL_ID}...")
-        response = requests.post(url, headers=headers, json=payload)
+        # Общий лимит запросов; на 429 — общая пауза (по Retry-After, если он есть) и повтор, пока Wazzup
+        # не примет сообщение. Слишком долгие отказы — RateLimitWaitExceeded, задачу повторит очередь
+        waiting_since, rejections = time.monotonic(), 0
+        while True:
+            await rate_limiter.acquire("wazzup")
+            response = await get_client("wazzup").post(url, headers=headers, json=payload)
+            if response.status_code != 429:
+                break
+            rejections += 1
+            await rate_limiter.back_off("wazzup", _retry_after(response), rejections=rejections, waiting_since=waiting_since)
         response.raise_for_status()
 
         print("✅ Сообщение успешно отправлено через Wazzup.")
         return True
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"❌ Ошибка при отправке сообщения через Wazzup: {e}")
-        if e.response:
+        if isinstance(e, httpx.HTTPStatusError):
             print(f"   Ответ сервера Wazzup: {e.response.text}")
         return False
\ No newline at end of file
@@ -1,6 +1,7 @@
 # src/utils.py
 from starlette.datastructures import FormData
 import re
+import math
 
 def parse_form_data(data: FormData) -> dict:
     """
@@ -29,4 +30,17 @@ def normalize_phone(phone_number: str) -> str:
     if not phone_number:
         return ""
 # re.sub(r'\D', '', ...) находит все не-цифры (\D) и заменяет их на пустую строку
-    return re.sub(r'\D', '', phone_number)
\ No newline at end of file
+    return re.sub(r'\D', '', phone_number)
+
+
+def parse_bitrix_id(value) -> int | None:
+    """Битрикс24 отдает ID строками, а пустые связи — как None/''/'0'. Возвращает int или None."""
+    try:
+        return int(value) or None
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов без токенизатора: для русского текста ~3 символа на токен."""
+    return math.ceil(len(text) / 3) if text else 0
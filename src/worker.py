@@ -0,0 +1,99 @@
+# src/worker.py
+"""
+Отдельный процесс диспетчера диалогов — без веб-сервера.
+Запуск из папки src:  python -m worker
+Число процессов задается WORKER_PROCESSES; в веб-процессах встроенный диспетчер
+отключается через EMBEDDED_WORKER=false.
+Ответы клиентам и действия в CRM воркер только записывает в outbox — отправляют их
+воркеры очередей веб-процесса (см. outbox.py).
+"""
+import os
+from dotenv import load_dotenv
+load_dotenv()
+import time
+import signal
+import asyncio
+import multiprocessing
+
+import dispatcher
+from database.db import async_engine
+from services import http_client, prompt_service
+
+# --- НАСТРОЙКИ ПУЛА ВОРКЕРОВ ---
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+
+
+async def run_worker():
+    """Один процесс диспетчера: работает до SIGTERM/SIGINT, затем плавно дорабатывает взятые диалоги."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    # Промпты берутся из локального снимка; ждем Google только если снимка еще нет
+    if prompt_service.get_snapshot().source == "default":
+        await prompt_service.refresh_prompt_library()
+    refresher_task = asyncio.create_task(prompt_service.run_prompt_refresher())
+    dispatcher_task = asyncio.create_task(dispatcher.process_pending_messages_worker())
+
+    await stop.wait()
+    print(f"Воркер {dispatcher.WORKER_ID} останавливается...")
+    # Сначала перестаем брать новые диалоги, потом дожидаемся текущих
+    dispatcher_task.cancel()
+    await asyncio.gather(dispatcher_task, return_exceptions=True)
+    await dispatcher.drain()
+
+    refresher_task.cancel()
+    await asyncio.gather(refresher_task, return_exceptions=True)
+    await http_client.close_all_clients()
+    await async_engine.dispose()
+    print(f"Воркер {dispatcher.WORKER_ID} остановлен.")
+
+
+def _run_process():
+    asyncio.run(run_worker())
+
+
+def main():
+    if WORKER_PROCESSES <= 1:
+        _run_process()
+        return
+
+    # spawn, а не fork: каждый процесс заново создает пулы соединений с БД и HTTP-клиенты
+    ctx = multiprocessing.get_context("spawn")
+    processes = []
+    stopping = False
+
+    def start_process():
+        process = ctx.Process(target=_run_process, daemon=False)
+        process.start()
+        return process
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    print(f"🚀 Запускаю {WORKER_PROCESSES} процессов диспетчера...")
+    processes = [start_process() for _ in range(WORKER_PROCESSES)]
+
+    while not stopping:
+        for i, process in enumerate(processes):
+            if not process.is_alive():
+                print(f"⚠️ Процесс диспетчера {process.pid} завершился (код {process.exitcode}), перезапускаю.")
+                processes[i] = start_process()
+        time.sleep(1)
+
+    # Передаем SIGTERM дочерним процессам и ждем, пока они доработают
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join()
+    print("Все процессы диспетчера остановлены.")
+
+
+if __name__ == "__main__":
+    main()
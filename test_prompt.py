@@ -1,6 +1,7 @@
 # test_prompt.py
 import os
 import json
+import asyncio
 from dotenv import load_dotenv
 
 def run_prompt_test():
@@ -29,6 +30,7 @@ def run_prompt_test():
     # --- 2. СБОРКА ПРОМПТА (повторяем логику из llm_service.py) ---
 
     # 2.1. Получаем динамические промпты из Google Docs (включая таблицы)
+    asyncio.run(prompt_service.refresh_prompt_library())
     prompt_library = prompt_service.get_prompt_library()
     
     # 2.2. Получаем и персонализируем системный промпт
@@ -1,4 +1,5 @@
 # test_wazzup.py
+import asyncio
 from dotenv import load_dotenv
 
 # --- ИСПРАВЛЕНИЕ: СНАЧАЛА ЗАГРУЖАЕМ .ENV ---
@@ -22,7 +23,7 @@ def run_test():
         print("\n!!! ПОЖАЛУЙСТА, ОТКРОЙТЕ ФАЙЛ test_wazzup.py И УКАЖИТЕ СВОЙ РЕАЛЬНЫЙ НОМЕР ТЕЛЕФОНА ДЛЯ ТЕСТА !!!\n")
         return
 
-    success = wazzup_service.send_message(test_phone_number, test_message)
+    success = asyncio.run(wazzup_service.send_message(test_phone_number, test_message))
 
     if success:
         print("\nТест завершен успешно!")